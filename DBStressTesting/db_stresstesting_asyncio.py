@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# Scripts are mainly used for stress testing of different databases,
+# The way to test is to use Python modules to connect database then
+# Repeatedly run the workload operations.
+#
+# Unlike the gevent script, the concurrency is real: the statements are
+# sent through SQLAlchemy's asyncio engine and native asyncio drivers
+# (aiomysql, asyncpg, aiosqlite), and up to <concurrency> statements are
+# in flight at the same time, bounded by a semaphore.
+#
+# Requires python3.7+ and SQLAlchemy 1.4 or 2.x.
+#
+# You can use this script in the following ways:
+# such as:
+#
+#    python3 db_stresstesting_asyncio.py -i <mysql_server_ipaddr> -u root \
+#           -p <root_password> -P 3306 -d <database_name> \
+#           -t [mysql|postgresql|sqlite] -n <operation_count> \
+#           -c <concurrency> [-w mixed -k zipfian] \
+#           [-C "clean test db table"|-D "open debug" ]
+
+import asyncio
+import logging
+import sys
+import time
+
+from sqlalchemy import func, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import db_stresstesting_common as common
+from db_stresstesting_common import Base, StressTestTable
+import db_stresstesting_metrics as metrics
+import db_stresstesting_reset as reset
+import db_stresstesting_workload as workloads
+
+ASYNC_DB_CONNECT_URI = {
+    "mysql": "mysql+aiomysql://{user}:{password}@{ip}:{port}/{db}",
+    "postgresql": "postgresql+asyncpg://{user}:{password}@{ip}:{port}/{db}",
+    "sqlite": "sqlite+aiosqlite:///{db}",
+}
+
+# COPY and the ORM unit of work are not available on the async engine
+ASYNC_BULK_METHODS = ("executemany", "values")
+ASYNC_DEFAULT_BULK_METHOD = {"mysql": "values",
+                             "postgresql": "values",
+                             "sqlite": "executemany"}
+DEFAULT_CONCURRENCY = 1000
+# sqlite runs one writer at a time, more connections only wait for its
+# lock and fail once their busy timeout is over.
+SQLITE_MAX_CONCURRENCY = 8
+
+
+def parse_args():
+    """The function define how to use this scipt andProvide help manual"""
+
+    p = common.get_option_parser()
+    p.add_option("-n", "--num", type="int", dest="total",
+                 help="Enter the total number of test database operations.")
+    p.add_option("-c", "--concurrency", type="int", dest="concurrency",
+                 help="Number of statements in flight at the same time,"
+                 " default is %d, at most %d on sqlite"
+                 % (DEFAULT_CONCURRENCY, SQLITE_MAX_CONCURRENCY))
+    # The inserts are Core statements, there is no other insert path
+    p.set_defaults(insert_path="core")
+
+    kwargs = common.parse_args(
+        p, required=("total", "db"),
+        default_bulk_method=dict(common.DEFAULT_BULK_METHOD,
+                                 **ASYNC_DEFAULT_BULK_METHOD))
+    if kwargs["bulk_method"] not in ASYNC_BULK_METHODS:
+        p.error("--bulk-method must be one of [%s] with the asyncio driver"
+                % "|".join(ASYNC_BULK_METHODS))
+    if kwargs["insert_path"] != "core":
+        p.error("--insert-path must be core with the asyncio driver")
+    if kwargs["reset_method"] == "delete" or kwargs["partitions"]:
+        p.error("Parallel deletes and partitioned tables need the threaded"
+                " drivers")
+    if kwargs["concurrency"] is None:
+        kwargs["concurrency"] = DEFAULT_CONCURRENCY
+    if kwargs["concurrency"] < 1:
+        p.error("--concurrency must be at least 1")
+    if (kwargs["db_type"] == "sqlite" and
+            kwargs["concurrency"] > SQLITE_MAX_CONCURRENCY):
+        kwargs["concurrency"] = SQLITE_MAX_CONCURRENCY
+        if kwargs["pool_size"] is not None:
+            kwargs["pool_size"] = min(kwargs["pool_size"],
+                                      SQLITE_MAX_CONCURRENCY)
+    return kwargs
+
+
+def get_connect_uri(kwargs):
+    if kwargs["db_type"] not in ASYNC_DB_CONNECT_URI:
+        raise ValueError("No asyncio driver for database type %s, Such as "
+                         "[%s]" % (kwargs["db_type"],
+                                   "|".join(sorted(ASYNC_DB_CONNECT_URI))))
+    return ASYNC_DB_CONNECT_URI[kwargs["db_type"]].format(**kwargs)
+
+
+class TimedAsyncQueuePool(common.TimedPool, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool which reports how long a checkout waited"""
+
+
+def get_engine(uri, pool_options, debug=False, sqlite_options=None):
+    # aiosqlite defaults to a NullPool, pool the connections as the other
+    # databases do.
+    args = dict(pool_options, poolclass=TimedAsyncQueuePool)
+    if uri.startswith("sqlite"):
+        args["connect_args"] = dict(common.SQLITE_CONNECT_ARGS)
+    if common.is_memory_uri(uri):
+        # One shared connection, see common.get_engine_args
+        args.update(pool_size=1, max_overflow=0, pool_recycle=-1)
+    engine = create_async_engine(uri, echo=debug, **args)
+    if engine.dialect.name == "sqlite":
+        common.set_sqlite_pragmas(engine.sync_engine,
+                                  sqlite_options or
+                                  common.get_sqlite_options({}))
+    return engine
+
+
+def get_pool_options(kwargs):
+    # Every in flight statement holds a connection, so by default the pool
+    # is sized to the concurrency instead of queueing on checkout.
+    if kwargs["pool_size"] is None:
+        return common.get_pool_options(kwargs,
+                                       pool_size=kwargs["concurrency"],
+                                       max_overflow=0)
+    return common.get_pool_options(kwargs)
+
+
+async def create_database(engine, indexes=()):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(common.create_indexes, indexes)
+
+
+async def drop_database(engine):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+
+async def query_data(engine, column=None):
+    async with engine.connect() as conn:
+        if column is None:
+            stmt = func.count("*").select().select_from(StressTestTable)
+        else:
+            stmt = func.max(column).select()
+        result = await conn.execute(stmt)
+        return result.scalar() or 0
+
+
+async def bulk_insert(conn, values, row_width, bulk_method, data=None):
+    rows = [common.new_row(data, k, row_width) for k in values]
+    table = StressTestTable.__table__
+    if bulk_method == "values":
+        await conn.execute(table.insert().values(rows))
+    else:
+        await conn.execute(table.insert(), rows)
+    return len(rows)
+
+
+async def execute_operation(engine, workload, op, key, kwargs, data=None):
+    """Execute one workload operation on its own connection
+
+    data are the rows generated before the run, if any. Return the number
+    of rows the operation handled.
+    """
+
+    row_width = kwargs["row_width"]
+    rows = 1
+
+    async with engine.begin() as conn:
+        if op == "read":
+            result = await conn.execute(common.read_statement(key))
+            result.first()
+        elif op == "insert":
+            row = common.new_row(data, workload.next_value(), row_width)
+            result = await conn.execute(common.insert_statement(
+                row["k"], row["payload"], row["date_time"]))
+            workload.inserted(result.inserted_primary_key[0])
+        elif op == "update":
+            row = common.new_row(data, workload.next_value(), row_width)
+            await conn.execute(common.update_statement(
+                key, row["k"], row["payload"]))
+        elif op == "scan":
+            result = await conn.execute(common.scan_statement(
+                key, workload.profile.scan_length))
+            rows = len(result.fetchall())
+        elif op == "bulk":
+            rows = await bulk_insert(conn, [workload.next_value() for _
+                                            in range(kwargs["batch_size"])],
+                                     row_width, kwargs["bulk_method"], data)
+            workload.inserted_rows(rows)
+    return rows
+
+
+async def run_operation(engine, workload, stats, kwargs, num, data=None):
+    op, key = workload.next_operation()
+    start = time.time()
+    try:
+        rows = await execute_operation(engine, workload, op, key, kwargs,
+                                       data)
+    except Exception as err:
+        stats.record(op, time.time() - start, error=True)
+        logging.exception(">>> The %d operation failed: %s" % (num, err))
+        return
+    stats.record(op, time.time() - start, rows=rows)
+    workloads.log_operation(num, op, key, kwargs["log_sample"])
+
+
+async def run_workload(engine, workload, stats, total, concurrency, kwargs,
+                       data=None):
+    """Keep up to <concurrency> operations in flight until <total> ran"""
+
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = set()
+
+    async def worker(num):
+        try:
+            await run_operation(engine, workload, stats, kwargs, num, data)
+        finally:
+            semaphore.release()
+
+    for num in range(total):
+        await semaphore.acquire()
+        task = asyncio.ensure_future(worker(num))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def stress_test(connect_uri, **kwargs):
+    engine = get_engine(connect_uri, get_pool_options(kwargs),
+                        kwargs["debug"], common.get_sqlite_options(kwargs))
+    pool_stats = common.PoolStats()
+    pool_stats.attach(engine.sync_engine)
+    try:
+        await create_database(engine, kwargs["indexes"])
+        profile = workloads.get_profile(kwargs["workload"],
+                                        kwargs["key_dist"],
+                                        kwargs["scan_length"])
+        max_key = await query_data(engine, StressTestTable.id)
+        workload = workloads.Workload(profile, max_key, kwargs["seed"])
+        data = common.generate_rows(kwargs)
+        stats = workloads.WorkloadStats()
+        # The reporter thread only copies the stats the event loop
+        # records, it never blocks the loop.
+        reporter = metrics.new_reporter(stats.copy, kwargs).start()
+
+        start_time = time.time()
+        try:
+            await run_workload(engine, workload, stats, kwargs["total"],
+                               kwargs["concurrency"], kwargs, data)
+        finally:
+            elapsed = time.time() - start_time
+            reporter.stop()
+            print(common.describe_workload(profile, kwargs))
+            for line in stats.report(elapsed):
+                print(line)
+            print(pool_stats.report())
+
+        db_total = await query_data(engine)
+        print("A total of %d data in Streetest_table table" % db_total)
+    finally:
+        await engine.dispose()
+
+
+async def truncate_table(engine):
+    table = StressTestTable.__table__
+    async with engine.begin() as conn:
+        if not await conn.run_sync(reset.table_exists, table):
+            return
+        for statement in reset.truncate_statements(engine.dialect, table):
+            await conn.execute(text(statement))
+
+
+async def clean_table(connect_uri, kwargs):
+    engine = get_engine(connect_uri, common.get_pool_options({}),
+                        sqlite_options=common.get_sqlite_options(kwargs))
+    try:
+        if kwargs["reset_method"] == "drop":
+            await drop_database(engine)
+        else:
+            await truncate_table(engine)
+    finally:
+        await engine.dispose()
+
+
+@common.timer
+def do_stress_test(connect_uri, **kwargs):
+    """Start stress test database opeartion"""
+
+    try:
+        asyncio.run(stress_test(connect_uri, **kwargs))
+    except KeyboardInterrupt:
+        print("Quitting.....")
+        sys.exit(0)
+
+
+def main():
+    kwargs = parse_args()
+    connect_uri = get_connect_uri(kwargs)
+    common.setup_logging()
+    if kwargs["clean_table"] is False:
+        asyncio.run(clean_table(connect_uri, kwargs))
+        sys.exit(0)
+
+    do_stress_test(connect_uri, **kwargs)
+
+
+if __name__ == "__main__":
+    main()
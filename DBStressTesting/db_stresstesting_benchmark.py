@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# Scripts are mainly used for stress testing of different databases,
+# The way to test is to use Python modules to connect database then
+# Repeatedly run the workload operations.
+#
+# This script reruns a suite of named scenarios (workloads, concurrency
+# levels, batch sizes) with the do_stress_test of the multi thread script,
+# keeps the results in a local SQLite results database and compares them
+# with a stored baseline:
+#
+#    python db_stresstesting_benchmark.py -t sqlite -d /tmp/stress.db \
+#           --label before-upgrade --set-baseline
+#    python db_stresstesting_benchmark.py -t sqlite -d /tmp/stress.db \
+#           --label after-upgrade [--scenarios mixed-c8,bulk-b1000] \
+#           [--repeat 5] [--results-db benchmark_results.db]
+#
+# Every scenario is run --repeat times from an empty table. The throughput
+# and p99 latency samples of the run are compared with the baseline ones
+# with Welch's t-test, a change is flagged as regression when it is
+# significant (p < --alpha) and worse than --threshold percent. The script
+# exits with status 1 when a regression is found.
+#
+# Use --list to print the scenarios, and --show to print the stored runs.
+
+from __future__ import print_function
+
+from datetime import datetime
+import json
+import math
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy import Column, DateTime, Float, Integer, String, Text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext import declarative
+
+import db_stresstesting_common as common
+from db_stresstesting_common import do_clean_table
+import db_stresstesting_multi_thread as multi_thread
+import db_stresstesting_workload as workloads
+
+ResultsBase = declarative.declarative_base()
+
+# Options of every scenario, overriding the command line ones. preload is
+# the number of rows loaded before the measured operations.
+SCENARIOS = {
+    "insert-c1": {"workload": "insert", "thread_count": 1, "total": 2000},
+    "insert-c8": {"workload": "insert", "thread_count": 8, "total": 4000},
+    "mixed-c8": {"workload": "mixed", "thread_count": 8, "total": 4000,
+                 "preload": 10000},
+    "read-heavy-c16": {"workload": "read-heavy", "thread_count": 16,
+                       "total": 8000, "preload": 10000},
+    "scan-c4": {"workload": "scan", "thread_count": 4, "total": 1000,
+                "preload": 10000},
+    "bulk-b100": {"workload": "bulk-load", "thread_count": 1, "total": 100,
+                  "batch_size": 100},
+    "bulk-b1000": {"workload": "bulk-load", "thread_count": 1, "total": 20,
+                   "batch_size": 1000},
+}
+
+METRICS = (
+    # name, label, True if higher is better
+    ("ops_per_sec", "ops/s", True),
+    ("p99", "p99(ms)", False),
+)
+
+
+class BenchmarkResult(ResultsBase):
+    """One repetition of a scenario"""
+
+    __tablename__ = "benchmark_result"
+
+    id = Column(Integer, primary_key=True)
+    label = Column(String(100), index=True)
+    scenario = Column(String(100), index=True)
+    repeat = Column(Integer)
+    created = Column(DateTime, default=datetime.utcnow)
+    db_type = Column(String(30))
+    config = Column(Text)
+    total = Column(Integer)
+    errors = Column(Integer)
+    elapsed = Column(Float)
+    ops_per_sec = Column(Float)
+    p50 = Column(Float)
+    p99 = Column(Float)
+
+
+class Baseline(ResultsBase):
+    """The label the runs of a scenario are compared with"""
+
+    __tablename__ = "benchmark_baseline"
+
+    scenario = Column(String(100), primary_key=True)
+    label = Column(String(100))
+
+
+def parse_args():
+    """The function define how to use this scipt andProvide help manual"""
+
+    p = common.get_option_parser()
+    common.add_phase_options(p)
+    p.add_option("--scenarios", dest="scenarios",
+                 help="Comma separated scenarios to run, default is all")
+    p.add_option("--repeat", type="int", dest="repeat", default=5,
+                 help="Runs of every scenario, default is 5")
+    p.add_option("--label", dest="label",
+                 default=datetime.now().strftime("%Y%m%d-%H%M%S"),
+                 help="Name of the results of this run, default is the"
+                 " current time")
+    p.add_option("--baseline", dest="baseline",
+                 help="Label to compare with, default is the stored"
+                 " baseline of every scenario")
+    p.add_option("--set-baseline", action="store_true", dest="set_baseline",
+                 default=False,
+                 help="Store the results of this run as the new baseline")
+    p.add_option("--results-db", dest="results_db",
+                 default="benchmark_results.db",
+                 help="SQLite file of the results,"
+                 " default is benchmark_results.db")
+    p.add_option("--alpha", type="float", dest="alpha", default=0.05,
+                 help="Significance level of the comparison,"
+                 " default is 0.05")
+    p.add_option("--threshold", type="float", dest="threshold", default=5.0,
+                 help="Smallest change in percent flagged as regression,"
+                 " default is 5")
+    p.add_option("--list", action="store_true", dest="list", default=False,
+                 help="Print the scenarios and exit")
+    p.add_option("--show", action="store_true", dest="show", default=False,
+                 help="Print the stored results and exit")
+
+    options, args = p.parse_args()
+    if options.list or options.show:
+        return vars(options)
+    kwargs = common.parse_args(p, required=("db",))
+    if kwargs["scenarios"]:
+        kwargs["scenarios"] = kwargs["scenarios"].split(",")
+        unknown = set(kwargs["scenarios"]) - set(SCENARIOS)
+        if unknown:
+            p.error("Unknown scenarios %s, Such as [%s]"
+                    % (", ".join(sorted(unknown)),
+                       "|".join(sorted(SCENARIOS))))
+    else:
+        kwargs["scenarios"] = sorted(SCENARIOS)
+    if kwargs["repeat"] < 2:
+        p.error("--repeat must be at least 2 to compare runs")
+    return kwargs
+
+
+def get_results_session(path):
+    engine = create_engine("sqlite:///%s" % path)
+    ResultsBase.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def get_scenario_kwargs(kwargs, name):
+    scenario_kwargs = dict(kwargs)
+    scenario_kwargs.update(SCENARIOS[name])
+    # The suite prints its own comparison, no live progress per run
+    scenario_kwargs.update(progress_interval=0, metrics_json=None,
+                           metrics_prom=None)
+    return scenario_kwargs
+
+
+def preload(connect_uri, kwargs, rows):
+    """Load rows into the test table before the measured operations"""
+
+    test_obj = common.new_test_obj(connect_uri, kwargs, data_rows=False,
+                                   pool_size=1)
+    workload = workloads.Workload(workloads.PROFILES["bulk-load"])
+    while rows > 0:
+        batch = min(rows, kwargs["batch_size"])
+        test_obj.bulk_insert([workload.next_value() for _ in range(batch)])
+        rows -= batch
+    test_obj.dispose()
+
+
+def run_scenario(connect_uri, kwargs, name, repeat):
+    """Run one repetition of a scenario from an empty table"""
+
+    scenario_kwargs = get_scenario_kwargs(kwargs, name)
+    if not common.is_memory_uri(connect_uri):
+        do_clean_table(connect_uri, kwargs)
+    if scenario_kwargs.get("preload"):
+        if common.is_memory_uri(connect_uri):
+            raise ValueError("Scenario %s preloads rows, it needs a database"
+                             " file" % name)
+        preload(connect_uri, scenario_kwargs, scenario_kwargs["preload"])
+
+    stats, elapsed = multi_thread.do_stress_test(connect_uri,
+                                                 **scenario_kwargs)
+    latency = workloads.LatencyHistogram()
+    for histogram in stats.histograms.values():
+        latency.merge(histogram)
+    return BenchmarkResult(
+        label=kwargs["label"], scenario=name, repeat=repeat,
+        db_type=kwargs["db_type"],
+        config=json.dumps(SCENARIOS[name], sort_keys=True),
+        total=latency.count, errors=sum(stats.errors.values()),
+        elapsed=elapsed, ops_per_sec=latency.count / elapsed,
+        p50=latency.percentile(50) * 1000,
+        p99=latency.percentile(99) * 1000)
+
+
+def mean(values):
+    return sum(values) / float(len(values))
+
+
+def variance(values):
+    m = mean(values)
+    return sum((value - m) ** 2 for value in values) / (len(values) - 1)
+
+
+def betacf(a, b, x):
+    # Continued fraction of the incomplete beta function (Lentz's method)
+    tiny = 1e-30
+    c = 1.0
+    d = 1.0 - (a + b) * x / (a + 1.0)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 201):
+        m2 = 2 * m
+        for aa in (m * (b - m) * x / ((a + m2 - 1) * (a + m2)),
+                   -(a + m) * (a + b + m) * x / ((a + m2) * (a + m2 + 1))):
+            d = 1.0 + aa * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + aa / c
+            c = c if abs(c) > tiny else tiny
+            h *= d * c
+        if abs(d * c - 1.0) < 3e-12:
+            break
+    return h
+
+
+def betai(a, b, x):
+    """Regularized incomplete beta function I_x(a, b)"""
+
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    bt = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                  a * math.log(x) + b * math.log(1.0 - x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return bt * betacf(a, b, x) / a
+    return 1.0 - bt * betacf(b, a, 1.0 - x) / b
+
+
+def welch_test(a, b):
+    """Return the two sided p-value of Welch's t-test of two samples"""
+
+    se2 = variance(a) / len(a) + variance(b) / len(b)
+    if se2 == 0:
+        return 1.0 if mean(a) == mean(b) else 0.0
+    t = (mean(a) - mean(b)) / math.sqrt(se2)
+    df = se2 ** 2 / ((variance(a) / len(a)) ** 2 / (len(a) - 1) +
+                     (variance(b) / len(b)) ** 2 / (len(b) - 1))
+    return betai(df / 2.0, 0.5, df / (df + t * t))
+
+
+def compare(baseline, current, higher_is_better, alpha, threshold):
+    """Return (change in percent, p-value, verdict) of two samples"""
+
+    before, after = mean(baseline), mean(current)
+    change = (after - before) * 100.0 / before if before else 0.0
+    p_value = welch_test(baseline, current)
+    worse = -change if higher_is_better else change
+    if p_value >= alpha or abs(change) < threshold:
+        verdict = "same"
+    elif worse > 0:
+        verdict = "REGRESSION"
+    else:
+        verdict = "improved"
+    return change, p_value, verdict
+
+
+def get_baseline_label(session, kwargs, name):
+    if kwargs["baseline"]:
+        return kwargs["baseline"]
+    baseline = session.query(Baseline).get(name)
+    return baseline.label if baseline else None
+
+
+def query_samples(session, label, name, metric):
+    return [getattr(result, metric) for result
+            in session.query(BenchmarkResult).filter_by(label=label,
+                                                        scenario=name)]
+
+
+def print_comparison(session, kwargs):
+    """Print the comparison with the baselines, return the regressions"""
+
+    regressions = 0
+    print("%-16s %-8s %-20s %12s %12s %9s %8s  %s" % (
+        "scenario", "metric", "baseline", "before", "after", "change",
+        "p-value", "verdict"))
+    for name in kwargs["scenarios"]:
+        label = get_baseline_label(session, kwargs, name)
+        for metric, title, higher_is_better in METRICS:
+            current = query_samples(session, kwargs["label"], name, metric)
+            baseline = (query_samples(session, label, name, metric)
+                        if label and label != kwargs["label"] else [])
+            if len(baseline) < 2:
+                print("%-16s %-8s %-20s %12s %12.3f" % (
+                    name, title, label or "-", "-", mean(current)))
+                continue
+            change, p_value, verdict = compare(
+                baseline, current, higher_is_better, kwargs["alpha"],
+                kwargs["threshold"])
+            regressions += verdict == "REGRESSION"
+            print("%-16s %-8s %-20s %12.3f %12.3f %+8.1f%% %8.4f  %s" % (
+                name, title, label, mean(baseline), mean(current), change,
+                p_value, verdict))
+    return regressions
+
+
+def print_scenarios():
+    for name in sorted(SCENARIOS):
+        print("%-16s %s" % (name, ", ".join(
+            "%s=%s" % item for item in sorted(SCENARIOS[name].items()))))
+
+
+def print_results(session):
+    baselines = dict((baseline.scenario, baseline.label)
+                     for baseline in session.query(Baseline))
+    print("%-20s %-16s %6s %12s %12s %8s" % (
+        "label", "scenario", "runs", "ops/s", "p99(ms)", "errors"))
+    groups = {}
+    for result in session.query(BenchmarkResult).order_by(
+            BenchmarkResult.created):
+        groups.setdefault((result.label, result.scenario), []).append(result)
+    for (label, name), results in sorted(
+            groups.items(), key=lambda item: item[1][0].created):
+        print("%-20s %-16s %6d %12.1f %12.3f %8d%s" % (
+            label, name, len(results),
+            mean([result.ops_per_sec for result in results]),
+            mean([result.p99 for result in results]),
+            sum(result.errors for result in results),
+            "  (baseline)" if baselines.get(name) == label else ""))
+
+
+@common.timer
+def do_benchmark(connect_uri, **kwargs):
+    """Run the scenarios, store and compare their results"""
+
+    session = get_results_session(kwargs["results_db"])
+    try:
+        for name in kwargs["scenarios"]:
+            for repeat in range(kwargs["repeat"]):
+                print("Scenario %s, run %d/%d" % (name, repeat + 1,
+                                                  kwargs["repeat"]))
+                session.add(run_scenario(connect_uri, kwargs, name, repeat))
+                session.commit()
+            if kwargs["set_baseline"]:
+                session.merge(Baseline(scenario=name, label=kwargs["label"]))
+                session.commit()
+    except KeyboardInterrupt:
+        print("Quitting.....")
+        sys.exit(0)
+
+    print("Results %s stored in %s" % (kwargs["label"],
+                                       kwargs["results_db"]))
+    regressions = print_comparison(session, kwargs)
+    session.close()
+    return regressions
+
+
+def main():
+    kwargs = parse_args()
+    if kwargs["list"]:
+        print_scenarios()
+        sys.exit(0)
+    if kwargs["show"]:
+        print_results(get_results_session(kwargs["results_db"]))
+        sys.exit(0)
+
+    connect_uri = common.get_connect_uri(kwargs)
+    common.setup_logging()
+    if kwargs["clean_table"] is False:
+        do_clean_table(connect_uri, kwargs)
+        sys.exit(0)
+
+    if do_benchmark(connect_uri, **kwargs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
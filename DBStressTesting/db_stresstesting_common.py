@@ -0,0 +1,915 @@
+# Common parts of the database stress testing scripts.
+#
+# The drivers (multi thread, multi process, gevent ...) only differ in the
+# way they generate concurrency, so the test table, the StressTestDB class
+# and the command line options are defined once here and imported by every
+# db_stresstesting_*.py script.
+#
+# Code is kept compatible with python2 and python3.
+
+from __future__ import print_function
+
+import csv
+from datetime import datetime
+import functools
+import logging
+import optparse
+import os
+import threading
+import time
+
+from sqlalchemy import bindparam, create_engine, event, inspect
+from sqlalchemy import func, Column, Index, Integer, String
+from sqlalchemy import insert, update
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.ext import declarative
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import db_stresstesting_data as data
+import db_stresstesting_reset as reset
+import db_stresstesting_workload as workloads
+from db_stresstesting_workload import LatencyHistogram
+
+Base = declarative.declarative_base()
+
+DB_CONNECT_URI = {"mysql": "mysql://{user}:{password}@{ip}:{port}/{db}",
+                  "oracle": "oracle://{user}:{password}@{ip}:{port}/{db}",
+                  "sqlserver": "mssql+pymssql://{user}:{password}@{ip}:{port}",
+                  "postgresql": "postgresql://{user}:{password}@{ip}:{port}"
+                                "/{db}",
+                  "sqlite": "sqlite:///{db}"}
+
+DB_DEFAULT_PORT = {"mysql": 3306,
+                   "oracle": 1521,
+                   "sqlserver": 1433,
+                   "postgresql": 5432}
+
+# Ways to load a batch of rows, and the database types supporting them:
+#
+#    orm          session.add_all() then commit, the ORM unit of work
+#    executemany  one prepared INSERT executed with many parameter sets
+#    values       one INSERT statement with a multi-row VALUES clause
+#    copy         PostgreSQL COPY FROM STDIN of a CSV buffer
+BULK_METHODS = {"orm": tuple(DB_CONNECT_URI),
+                "executemany": tuple(DB_CONNECT_URI),
+                "values": ("mysql", "postgresql", "sqlite"),
+                "copy": ("postgresql",)}
+
+# How the 'insert' workload operation inserts its row: through the ORM
+# unit of work, a cached compiled Core insert, or a DBAPI cursor with the
+# SQL compiled once (and prepared on the server by PostgreSQL).
+INSERT_PATHS = ("orm", "core", "raw")
+
+DEFAULT_BULK_METHOD = {"mysql": "values",
+                       "oracle": "executemany",
+                       "sqlserver": "executemany",
+                       "postgresql": "copy",
+                       "sqlite": "executemany"}
+
+SQLITE_JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal",
+                        "off")
+SQLITE_SYNCHRONOUS = ("off", "normal", "full", "extra")
+
+# The payload column is declared with the widest size every supported
+# database accepts for a VARCHAR, the real row width is chosen per run.
+MAX_ROW_WIDTH = 4000
+DEFAULT_ROW_WIDTH = 30
+
+# Secondary indexes which can be created for read path and index
+# contention tests.
+INDEXABLE_COLUMNS = ("k", "date_time")
+
+DEFAULT_POOL_OPTIONS = {"pool_size": 100,
+                        "max_overflow": 10,
+                        "pool_timeout": 30,
+                        "pool_recycle": 7200,
+                        "pool_pre_ping": False}
+
+# Seconds a sqlite connection waits for the lock of another writer
+SQLITE_CONNECT_ARGS = {"check_same_thread": False, "timeout": 30}
+
+
+def timer(func):
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start_time = time.time()
+        result = func(*args, **kwargs)
+        end_time = time.time()
+        print("Timer: %s" % (end_time - start_time))
+        return result
+
+    return wrapper
+
+
+def setup_logging(log_name="db_stresstesting.log", log_dir=None):
+    """Edit log configure file && output format
+
+    The log is written to log_name in log_dir, the current directory by
+    default, or without the debug messages to stderr when log_name is None.
+    """
+
+    options = dict(level=logging.INFO,
+                   format="%(asctime)s %(filename)"
+                          "s[line:%(lineno)d] {%(threadName)s} "
+                          "%(levelname)s %(message)s",
+                   datefmt="%a, %d %b %Y %H:%M:%S")
+    if log_name is not None:
+        options.update(level=logging.DEBUG,
+                       filename=os.path.join(log_dir or os.getcwd(),
+                                             log_name),
+                       filemode="w")
+    logging.basicConfig(**options)
+
+
+def get_option_parser():
+    """Define the options shared by all stress test scripts"""
+
+    usage = "usage: %prog [options] arg1 ... arg2"
+    p = optparse.OptionParser(usage=usage)
+
+    p.add_option("-i", "--ip", dest="ip",
+                 help="Input an ip connect address.")
+    p.add_option("-u", "--user", type="string", dest="user",
+                 help="Input connect database test user.")
+    p.add_option("-p", "--password", dest="password",
+                 help="Input connect database user password")
+    p.add_option("-P", "--port", type="int", dest="port",
+                 help="Input connect database port number, default is the "
+                 "one of the database type, such as 3306 for mysql")
+    p.add_option("-d", "--db", dest="db",
+                 help="Input connect database name, the file path or "
+                 ":memory: for sqlite.")
+    p.add_option("-t", "--type", dest="db_type", default="mysql",
+                 choices=sorted(DB_CONNECT_URI),
+                 help="Input connect database type."
+                 "Such as [%s], default is mysql"
+                 % "|".join(sorted(DB_CONNECT_URI)))
+    p.add_option("-C", "--clean", action="store_false", dest="clean_table",
+                 help="Clean test database table")
+    p.add_option("--reset-method", dest="reset_method", default="auto",
+                 choices=reset.RESET_METHODS,
+                 help="How -C cleans the test table. Such as [%s], default"
+                 " is auto, truncate" % "|".join(reset.RESET_METHODS))
+    p.add_option("--reset-threads", type="int", dest="reset_threads",
+                 default=4,
+                 help="Parallel statements of a reset, default is 4")
+    p.add_option("--reset-chunk", type="int", dest="reset_chunk",
+                 default=10000,
+                 help="Rows of one DELETE of the delete reset method,"
+                 " default is 10000")
+    p.add_option("--partitions", type="int", dest="partitions", default=0,
+                 help="Create the test table hash partitioned on id in"
+                 " this many partitions (postgresql, mysql)")
+    p.add_option("-D", "--debug", action="store_true", dest="debug",
+                 default=False,
+                 help="Open sqlalchemy debug mode, The default is False")
+    p.add_option("-w", "--workload", dest="workload", default="insert",
+                 help="Workload profile name or operation mix, such as "
+                 "'mixed' or 'read=70,insert=20,update=10,scan=0', "
+                 "default is insert")
+    p.add_option("-k", "--key-dist", dest="key_dist",
+                 help="Key distribution of the workload operations, "
+                 "[uniform|zipfian|latest], default is the one of "
+                 "the workload profile")
+    p.add_option("--scan-length", type="int", dest="scan_length",
+                 default=100,
+                 help="Number of rows read by a range scan, default is 100")
+    p.add_option("--row-width", type="int", dest="row_width",
+                 default=DEFAULT_ROW_WIDTH,
+                 help="Width of the test table payload column, "
+                 "default is %d" % DEFAULT_ROW_WIDTH)
+    p.add_option("--index", action="append", dest="indexes", default=[],
+                 choices=INDEXABLE_COLUMNS,
+                 help="Create a secondary index on the column, can be "
+                 "given more than once. Such as [%s]"
+                 % "|".join(INDEXABLE_COLUMNS))
+    p.add_option("--pool-size", type="int", dest="pool_size",
+                 help="Number of connections kept in the pool, "
+                 "default is %d" % DEFAULT_POOL_OPTIONS["pool_size"])
+    p.add_option("--max-overflow", type="int", dest="max_overflow",
+                 default=DEFAULT_POOL_OPTIONS["max_overflow"],
+                 help="Number of connections opened beyond the pool size, "
+                 "default is %d" % DEFAULT_POOL_OPTIONS["max_overflow"])
+    p.add_option("--pool-timeout", type="float", dest="pool_timeout",
+                 default=DEFAULT_POOL_OPTIONS["pool_timeout"],
+                 help="Seconds to wait for a pooled connection, "
+                 "default is %d" % DEFAULT_POOL_OPTIONS["pool_timeout"])
+    p.add_option("--pool-recycle", type="int", dest="pool_recycle",
+                 default=DEFAULT_POOL_OPTIONS["pool_recycle"],
+                 help="Seconds after which a connection is recycled, "
+                 "default is %d" % DEFAULT_POOL_OPTIONS["pool_recycle"])
+    p.add_option("--pre-ping", action="store_true", dest="pool_pre_ping",
+                 default=False,
+                 help="Test connections for liveness on checkout")
+    p.add_option("--bulk-method", dest="bulk_method",
+                 choices=sorted(BULK_METHODS),
+                 help="How the 'bulk' workload operation loads its rows. "
+                 "Such as [%s], default is the fastest one of the "
+                 "database type" % "|".join(sorted(BULK_METHODS)))
+    p.add_option("--insert-path", dest="insert_path", default="orm",
+                 choices=INSERT_PATHS,
+                 help="How the 'insert' workload operation inserts its row."
+                 " Such as [%s], default is orm" % "|".join(INSERT_PATHS))
+    p.add_option("--seed", type="int", dest="seed",
+                 help="Seed of the workload and of the generated rows,"
+                 " default is random")
+    p.add_option("--data-rows", type="int", dest="data_rows", default=0,
+                 help="Generate this many rows before the test starts,"
+                 " default is 0, rows are made on the fly")
+    p.add_option("--payload", dest="payload", default="pad",
+                 choices=data.PAYLOAD_KINDS,
+                 help="Content of the generated payloads. Such as [%s],"
+                 " default is pad" % "|".join(data.PAYLOAD_KINDS))
+    p.add_option("--row-width-max", type="int", dest="row_width_max",
+                 help="Generate payloads from --row-width up to this width")
+    p.add_option("--k-cardinality", type="int", dest="k_cardinality",
+                 help="Distinct values of the generated k column")
+    p.add_option("--date-span", type="int", dest="date_span", default=0,
+                 help="Spread the generated date_time over this many"
+                 " seconds")
+    p.add_option("--batch-size", type="int", dest="batch_size",
+                 default=1000,
+                 help="Rows loaded by one 'bulk' operation, default is 1000")
+    p.add_option("--sqlite-journal", dest="sqlite_journal", default="wal",
+                 choices=SQLITE_JOURNAL_MODES,
+                 help="SQLite journal_mode pragma, default is wal")
+    p.add_option("--sqlite-sync", dest="sqlite_sync", default="normal",
+                 choices=SQLITE_SYNCHRONOUS,
+                 help="SQLite synchronous pragma, default is normal")
+    p.add_option("--progress-interval", type="float",
+                 dest="progress_interval", default=1.0,
+                 help="Seconds between two progress lines, 0 disables"
+                 " them, default is 1")
+    p.add_option("--metrics-json", dest="metrics_json",
+                 help="Write the metrics of every interval to a newline"
+                 " delimited JSON file")
+    p.add_option("--metrics-prom", dest="metrics_prom",
+                 help="Keep the metrics in a Prometheus text format file")
+    p.add_option("--log-sample", type="int", dest="log_sample", default=0,
+                 help="Log one operation out of N to the log file,"
+                 " default is 0, none")
+
+    return p
+
+
+def add_phase_options(p):
+    """Add the options of the phased runs, see new_phases"""
+
+    p.add_option("--warmup", type="float", dest="warmup", default=0.0,
+                 help="Seconds of unmeasured warmup, the longest warmup"
+                 " with --steady-state, default is 0")
+    p.add_option("--steady-state", action="store_true", dest="steady_state",
+                 default=False,
+                 help="End the warmup once the throughput is steady")
+    p.add_option("--steady-cv", type="float", dest="steady_cv",
+                 default=0.05,
+                 help="Largest throughput variation (stddev / mean) of a"
+                 " steady state, default is 0.05")
+    p.add_option("--steady-window", type="float", dest="steady_window",
+                 default=1.0,
+                 help="Seconds of a throughput sample, default is 1")
+    p.add_option("--duration", type="float", dest="duration",
+                 help="Seconds of measurement, default is until the"
+                 " operations run out")
+    p.add_option("--cooldown", type="float", dest="cooldown", default=0.0,
+                 help="Seconds of unmeasured operations after a --duration"
+                 " measurement, default is 0")
+
+
+def add_fault_options(p):
+    """Add the options of the fault injection, see new_injector"""
+
+    p.add_option("--churn", type="int", dest="churn", default=0,
+                 help="Reconnect every Nth connection checkout, N is at"
+                 " least 2")
+    p.add_option("--kill-every", type="float", dest="kill_every",
+                 default=0.0,
+                 help="Kill the connections of the pool every N seconds")
+    p.add_option("--proxy-latency", type="float", dest="proxy_latency",
+                 default=0.0,
+                 help="Connect through a local proxy adding N milliseconds"
+                 " to every packet")
+    p.add_option("--proxy-jitter", type="float", dest="proxy_jitter",
+                 default=0.0,
+                 help="Random +/- milliseconds added to --proxy-latency")
+    p.add_option("--outage-at", type="float", dest="outage_at",
+                 help="Cut the proxy connections N seconds into the run")
+    p.add_option("--outage-for", type="float", dest="outage_for",
+                 default=5.0,
+                 help="Seconds the proxy refuses connections after"
+                 " --outage-at, default is 5")
+
+
+def parse_args(p, required=("db",), default_bulk_method=None):
+    """Parse the command line and return the options as a dict"""
+
+    options, args = p.parse_args()
+
+    for name in required:
+        if getattr(options, name) is None:
+            p.error("Pls %s -h|--help" % p.get_prog_name())
+
+    if not 0 < options.row_width <= MAX_ROW_WIDTH:
+        p.error("--row-width must be between 1 and %d" % MAX_ROW_WIDTH)
+    if options.row_width_max is not None and not (
+            options.row_width <= options.row_width_max <= MAX_ROW_WIDTH):
+        p.error("--row-width-max must be between --row-width and %d"
+                % MAX_ROW_WIDTH)
+
+    if options.reset_threads < 1 or options.reset_chunk < 1:
+        p.error("--reset-threads and --reset-chunk must be at least 1")
+    if (options.partitions and
+            options.db_type not in reset.PARTITION_DIALECTS):
+        p.error("--partitions is not supported by %s" % options.db_type)
+
+    if options.port is None:
+        options.port = DB_DEFAULT_PORT.get(options.db_type)
+    if options.bulk_method is None:
+        options.bulk_method = (default_bulk_method or
+                               DEFAULT_BULK_METHOD)[options.db_type]
+    if options.db_type not in BULK_METHODS[options.bulk_method]:
+        p.error("--bulk-method %s is not supported by %s"
+                % (options.bulk_method, options.db_type))
+
+    return vars(options)
+
+
+def get_connect_uri(kwargs):
+    return DB_CONNECT_URI.get(kwargs["db_type"]).format(**kwargs)
+
+
+def is_memory_uri(uri):
+    url = make_url(uri)
+    return (url.get_backend_name() == "sqlite" and
+            url.database in (None, "", ":memory:"))
+
+
+def get_sqlite_options(kwargs):
+    return {"journal_mode": kwargs.get("sqlite_journal", "wal"),
+            "synchronous": kwargs.get("sqlite_sync", "normal")}
+
+
+def get_engine_args(uri, pool_options):
+    """Return the create_engine arguments of a database URI"""
+
+    args = dict(pool_options, poolclass=TimedQueuePool)
+    if make_url(uri).get_backend_name() == "sqlite":
+        args["connect_args"] = dict(SQLITE_CONNECT_ARGS)
+        if is_memory_uri(uri):
+            # Every connection of an in-memory database is a new empty
+            # database, so all the threads share a single one in turn.
+            args.update(pool_size=1, max_overflow=0, pool_recycle=-1)
+    return args
+
+
+def set_sqlite_pragmas(engine, sqlite_options):
+    """Apply the journal and synchronous tuning to each new connection"""
+
+    def on_connect(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=%s"
+                       % sqlite_options["journal_mode"])
+        cursor.execute("PRAGMA synchronous=%s"
+                       % sqlite_options["synchronous"])
+        cursor.close()
+
+    event.listen(engine, "connect", on_connect)
+
+
+def get_pool_options(kwargs, **overrides):
+    """Return the create_engine pool arguments of the parsed options"""
+
+    options = dict(DEFAULT_POOL_OPTIONS)
+    for name in options:
+        if kwargs.get(name) is not None:
+            options[name] = kwargs[name]
+    options.update(overrides)
+    return options
+
+
+class TimedPool(object):
+    """Pool mixin which reports how long a checkout waited"""
+
+    wait_listener = None
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedPool, self)._do_get()
+        finally:
+            if self.wait_listener is not None:
+                self.wait_listener(time.time() - start)
+
+    def recreate(self):
+        pool = super(TimedPool, self).recreate()
+        pool.wait_listener = self.wait_listener
+        return pool
+
+
+class TimedQueuePool(TimedPool, QueuePool):
+    """QueuePool which reports how long a checkout waited"""
+
+
+class PoolStats(object):
+    """Instrument an engine pool through the SQLAlchemy pool events"""
+
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidated = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.peak_overflow = 0
+        self.wait = LatencyHistogram()
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        event.listen(engine, "connect", self.on_connect)
+        event.listen(engine, "checkout", self.on_checkout)
+        event.listen(engine, "checkin", self.on_checkin)
+        event.listen(engine, "invalidate", self.on_invalidate)
+        if isinstance(engine.pool, TimedPool):
+            engine.pool.wait_listener = self.record_wait
+        self._engine = engine
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.wait.record(seconds)
+
+    def on_connect(self, dbapi_conn, conn_record):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_conn, conn_record, conn_proxy):
+        overflow = getattr(self._engine.pool, "overflow", None)
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out,
+                                        self.checked_out)
+            if overflow is not None:
+                self.peak_overflow = max(self.peak_overflow, overflow())
+
+    def on_checkin(self, dbapi_conn, conn_record):
+        with self._lock:
+            self.checked_out -= 1
+
+    def on_invalidate(self, dbapi_conn, conn_record, exception):
+        with self._lock:
+            self.invalidated += 1
+
+    def merge(self, other):
+        self.connects += other.connects
+        self.checkouts += other.checkouts
+        self.invalidated += other.invalidated
+        self.peak_checked_out += other.peak_checked_out
+        self.peak_overflow += other.peak_overflow
+        self.wait.merge(other.wait)
+
+    def to_dict(self):
+        with self._lock:
+            return {"connects": self.connects,
+                    "checkouts": self.checkouts,
+                    "invalidated": self.invalidated,
+                    "peak_checked_out": self.peak_checked_out,
+                    "peak_overflow": self.peak_overflow,
+                    "wait": self.wait.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for name in ("connects", "checkouts", "invalidated",
+                     "peak_checked_out", "peak_overflow"):
+            setattr(stats, name, data[name])
+        stats.wait = LatencyHistogram.from_dict(data["wait"])
+        return stats
+
+    def report(self):
+        return ("pool: connects=%d checkouts=%d invalidated=%d "
+                "peak_in_use=%d peak_overflow=%d wait_avg=%.3fms "
+                "wait_p99=%.3fms"
+                % (self.connects, self.checkouts, self.invalidated,
+                   self.peak_checked_out, self.peak_overflow,
+                   self.wait.mean() * 1000,
+                   self.wait.percentile(99) * 1000))
+
+
+class StressTestTable(Base):
+    """Define a database Persons table for use test"""
+
+    __tablename__ = "Streetest_table"
+
+    id = Column(Integer, primary_key=True)
+    # The callable, not its result: the time of the insert, not of the
+    # import of this module.
+    date_time = Column(String(30), default=datetime.utcnow)
+    k = Column(Integer, nullable=False, default=0)
+    payload = Column(String(MAX_ROW_WIDTH))
+
+
+def make_payload(value, row_width):
+    return ("%d-" % value).ljust(row_width, "x")[:row_width]
+
+
+def create_indexes(bind, columns):
+    """Create the secondary indexes of the test table if missing"""
+
+    table = StressTestTable.__table__
+    exist = set(index["name"] for index in
+                inspect(bind).get_indexes(table.name))
+    for column in columns:
+        name = "ix_streetest_%s" % column
+        if name not in exist:
+            index = Index(name, table.c[column])
+            # Indexes are chosen per run, keep them out of create_all
+            table.indexes.discard(index)
+            index.create(bind)
+
+
+def make_row(k, row_width, date_time=None):
+    return {"date_time": str(date_time or datetime.utcnow()),
+            "k": k,
+            "payload": make_payload(k, row_width)}
+
+
+def new_row(rows, k, row_width, date_time=None):
+    """Take the next generated row, or make one of k if none were"""
+
+    if rows is not None:
+        return rows.next_row()
+    return make_row(k, row_width, date_time)
+
+
+def copy_rows(connection, rows):
+    """Load rows with PostgreSQL COPY FROM STDIN"""
+
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow((row["date_time"], row["k"], row["payload"]))
+    buf.seek(0)
+    table = connection.dialect.identifier_preparer.format_table(
+        StressTestTable.__table__)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert("COPY %s (date_time, k, payload) FROM STDIN "
+                           "WITH CSV" % table, buf)
+    finally:
+        cursor.close()
+
+
+def insert_statement(k, payload, date_time=None):
+    return insert(StressTestTable.__table__).values(
+        date_time=date_time or str(datetime.utcnow()), k=k, payload=payload)
+
+
+class RawInsert(object):
+    """Insert test rows with a DBAPI cursor, the SQL is compiled once
+
+    PostgreSQL connections PREPARE the insert once and EXECUTE it after,
+    the other databases reuse the same SQL string (the sqlite3 module
+    keeps its statements prepared per connection).
+    """
+
+    PREPARED_NAME = "stress_insert"
+
+    def __init__(self, engine):
+        table = StressTestTable.__table__
+        self.dialect = engine.dialect.name
+        self.prepared = self.dialect == "postgresql"
+        if self.prepared:
+            self.prepare_sql = (
+                "PREPARE %s AS INSERT INTO %s (date_time, k, payload) "
+                "VALUES ($1, $2, $3) RETURNING id"
+                % (self.PREPARED_NAME,
+                   engine.dialect.identifier_preparer.format_table(table)))
+            self.sql = "EXECUTE %s (%%s, %%s, %%s)" % self.PREPARED_NAME
+            self.names = ("date_time", "k", "payload")
+            return
+        compiled = table.insert().values(
+            date_time=bindparam("date_time"), k=bindparam("k"),
+            payload=bindparam("payload")).compile(dialect=engine.dialect)
+        self.sql = compiled.string
+        self.names = compiled.positiontup if compiled.positional else None
+
+    def params(self, row):
+        if self.names is None:
+            return row
+        return tuple(row[name] for name in self.names)
+
+    def execute(self, connection, row):
+        """Insert row on a pooled DBAPI connection, return its id"""
+
+        cursor = connection.cursor()
+        try:
+            if self.prepared and not connection.info.get(self.PREPARED_NAME):
+                cursor.execute(self.prepare_sql)
+                # Prepared statements live as long as the connection
+                connection.info[self.PREPARED_NAME] = True
+            cursor.execute(self.sql, self.params(row))
+            if self.prepared:
+                key = cursor.fetchone()[0]
+            else:
+                # None where the driver has no lastrowid (oracle, mssql)
+                key = getattr(cursor, "lastrowid", None)
+        finally:
+            cursor.close()
+        connection.commit()
+        return key
+
+
+def read_statement(key):
+    return StressTestTable.__table__.select().where(
+        StressTestTable.id == key)
+
+
+def scan_statement(key, length):
+    return StressTestTable.__table__.select().where(
+        StressTestTable.id.between(key, key + length - 1))
+
+
+def update_statement(key, k, payload):
+    return update(StressTestTable.__table__).where(
+        StressTestTable.id == key).values(k=k, payload=payload)
+
+
+class StressTestDB(object):
+    """Define stress test operation database the same class"""
+
+    def __init__(self, uri, debug=False, row_width=DEFAULT_ROW_WIDTH,
+                 indexes=(), pool_options=None, sqlite_options=None,
+                 bulk_method="executemany", batch_size=1000,
+                 insert_path="orm", rows=None, partitions=0):
+        self.uri = uri
+        self.row_width = row_width
+        self.indexes = indexes
+        self.pool_options = pool_options or DEFAULT_POOL_OPTIONS
+        self.sqlite_options = sqlite_options or get_sqlite_options({})
+        self.bulk_method = bulk_method
+        self.batch_size = batch_size
+        self.insert_path = insert_path
+        self.rows = rows
+        self.partitions = partitions
+        self.pool_stats = PoolStats()
+        self._engine = self._get_engine(uri, debug)
+        if self._engine.dialect.name == "sqlite":
+            set_sqlite_pragmas(self._engine, self.sqlite_options)
+        self.pool_stats.attach(self._engine)
+        self._session = self.get_session()
+        # The insert is compiled on first use only, and kept
+        self._insert = StressTestTable.__table__.insert()
+        self._core_engine = self._engine.execution_options(
+            compiled_cache={})
+        self._raw_insert = None
+
+    def create_database(self):
+        if self.partitions:
+            reset.create_partitioned_table(self._engine,
+                                           StressTestTable.__table__,
+                                           self.partitions)
+        Base.metadata.create_all(self._engine)
+        self.create_indexes()
+
+    def create_indexes(self):
+        create_indexes(self._engine, self.indexes)
+
+    def drop_database(self):
+        Base.metadata.drop_all(self._engine)
+
+    def reset_table(self, method="auto", threads=4, chunk=10000):
+        """Empty the test table, return the reset method used"""
+
+        return reset.reset_table(self._engine, StressTestTable.__table__,
+                                 method, threads, chunk)
+
+    def make_payload(self, value):
+        return make_payload(value, self.row_width)
+
+    def new_row(self, k, date_time=None):
+        return new_row(self.rows, k, self.row_width, date_time)
+
+    def add_test_data(self, k=0):
+        """Insert one row with the insert path of the run, return its id"""
+
+        if self.insert_path == "core":
+            return self.add_test_data_core(k)
+        if self.insert_path == "raw":
+            return self.add_test_data_raw(k)
+        return self.add_test_data_orm(k)
+
+    def add_test_data_orm(self, k=0):
+        new_test = StressTestTable(**self.new_row(k))
+        self._session.add(new_test)
+        self._session.flush()
+        key = new_test.id
+        self._session.commit()
+        return key
+
+    def add_test_data_core(self, k=0):
+        with self._core_engine.begin() as connection:
+            result = connection.execute(self._insert, self.new_row(k))
+            return result.inserted_primary_key[0]
+
+    def add_test_data_raw(self, k=0):
+        if self._raw_insert is None:
+            self._raw_insert = RawInsert(self._engine)
+        connection = self._engine.raw_connection()
+        try:
+            return self._raw_insert.execute(connection, self.new_row(k))
+        finally:
+            connection.close()
+
+    def bulk_insert(self, values):
+        """Load one row per value with the bulk method of the run"""
+
+        now = datetime.utcnow()
+        rows = [self.new_row(k, now) for k in values]
+        if self.bulk_method == "orm":
+            self._session.add_all([StressTestTable(**row) for row in rows])
+        elif self.bulk_method == "executemany":
+            self._session.execute(StressTestTable.__table__.insert(), rows)
+        elif self.bulk_method == "values":
+            self._session.execute(
+                StressTestTable.__table__.insert().values(rows))
+        elif self.bulk_method == "copy":
+            copy_rows(self._session.connection(), rows)
+        else:
+            raise ValueError("Unknown bulk method %s" % self.bulk_method)
+        self._session.commit()
+        return len(rows)
+
+    def read_data(self, key):
+        row = self._session.execute(read_statement(key)).first()
+        self._session.commit()
+        return row
+
+    def scan_data(self, key, length):
+        rows = self._session.execute(scan_statement(key, length)).fetchall()
+        self._session.commit()
+        return len(rows)
+
+    def update_data(self, key, k=0):
+        row = self.new_row(k)
+        result = self._session.execute(
+            update_statement(key, row["k"], row["payload"]))
+        self._session.commit()
+        return result.rowcount
+
+    def query_data(self):
+        data_total = self._session.query(
+            func.count("*")).select_from(StressTestTable).scalar()
+
+        return data_total
+
+    def query_max_key(self):
+        return self._session.query(
+            func.max(StressTestTable.id)).scalar() or 0
+
+    def _get_engine(self, uri, debug=False):
+        try:
+            engine = create_engine(uri, echo=debug,
+                                   **get_engine_args(uri, self.pool_options))
+        except Exception as err:
+            logging.info(">>> %s" % err)
+            raise
+        return engine
+
+    def get_session(self):
+        session = scoped_session(sessionmaker(bind=self._engine,
+                                              autoflush=True))
+        return session
+
+    def rollback(self):
+        """Roll back the failed operation, the session is usable again"""
+
+        self._session.rollback()
+
+    def close(self):
+        self._session.remove()
+
+    def dispose(self):
+        self._session.remove()
+        self._engine.dispose()
+
+
+def get_test_obj(connect_uri, kwargs, pool_options=None, data_rows=True):
+    """Build a StressTestDB from the parsed options
+
+    The --data-rows rows are only generated with data_rows, the test
+    objects which run no workload make their few rows on the fly.
+    """
+
+    return StressTestDB(connect_uri, debug=kwargs["debug"],
+                        row_width=kwargs["row_width"],
+                        indexes=kwargs["indexes"],
+                        pool_options=pool_options or get_pool_options(kwargs),
+                        sqlite_options=get_sqlite_options(kwargs),
+                        bulk_method=kwargs["bulk_method"],
+                        batch_size=kwargs["batch_size"],
+                        insert_path=kwargs["insert_path"],
+                        rows=generate_rows(kwargs) if data_rows else None,
+                        partitions=kwargs["partitions"])
+
+
+def new_test_obj(connect_uri, kwargs, data_rows=True, **pool_overrides):
+    """Build a StressTestDB from the parsed options and create its table"""
+
+    test_obj = get_test_obj(connect_uri, kwargs,
+                            get_pool_options(kwargs, **pool_overrides),
+                            data_rows)
+    test_obj.create_database()
+    return test_obj
+
+
+def generate_rows(kwargs):
+    """Generate the rows of the run, None to make them on the fly"""
+
+    if not kwargs.get("data_rows"):
+        return None
+    start_time = time.time()
+    rows = data.generate(data.DataSpec(kwargs["row_width"],
+                                       kwargs["row_width_max"],
+                                       kwargs["payload"],
+                                       kwargs["k_cardinality"],
+                                       kwargs["date_span"]),
+                         kwargs["data_rows"], kwargs["seed"])
+    logging.info(">>> Generated %d rows (%d bytes) in %.2fs"
+                 % (len(rows), rows.size(), time.time() - start_time))
+    return rows
+
+
+def get_profile(kwargs):
+    return workloads.get_profile(kwargs["workload"], kwargs["key_dist"],
+                                 kwargs["scan_length"])
+
+
+def new_phases(kwargs):
+    """Return the PhaseController of the run, None for a single phase"""
+
+    if not (kwargs.get("warmup") or kwargs.get("steady_state") or
+            kwargs.get("duration")):
+        return None
+    return workloads.PhaseController(kwargs["warmup"], kwargs["duration"],
+                                     kwargs["cooldown"],
+                                     kwargs["steady_state"],
+                                     kwargs["steady_window"],
+                                     kwargs["steady_cv"])
+
+
+def describe_workload(profile, kwargs):
+    if "bulk" in profile.mix:
+        return "Workload %r, bulk method %s of %d rows" % (
+            profile, kwargs["bulk_method"], kwargs["batch_size"])
+    return "Workload %r" % profile
+
+
+def new_workload(test_obj, profile, seed=None):
+    """Start a workload on the key space currently in the test table
+
+    seed makes the operations and keys of the workload reproducible.
+    """
+
+    workload = workloads.Workload(profile, test_obj.query_max_key(), seed)
+    test_obj.close()
+    return workload
+
+
+def worker_kwargs(kwargs, worker_num):
+    """Return the options of a worker, with a seed of its own
+
+    Workers with the same seed would all generate the same rows and run
+    the same operations.
+    """
+
+    if kwargs.get("seed") is None:
+        return kwargs
+    return dict(kwargs, seed=kwargs["seed"] + worker_num)
+
+
+def do_clean_table(connect_uri, kwargs=None):
+    """Empty the test table with the reset method of kwargs
+
+    Without kwargs the table is dropped.
+    """
+
+    kwargs = kwargs or {"reset_method": "drop"}
+    begin_test = StressTestDB(connect_uri,
+                              sqlite_options=get_sqlite_options(kwargs))
+    start_time = time.time()
+    try:
+        method = begin_test.reset_table(kwargs["reset_method"],
+                                        kwargs.get("reset_threads", 4),
+                                        kwargs.get("reset_chunk", 10000))
+    finally:
+        begin_test.dispose()
+    logging.info(">>> Reset %s by %s in %.2fs"
+                 % (StressTestTable.__tablename__, method,
+                    time.time() - start_time))
+    return method
@@ -0,0 +1,146 @@
+# Test data generator of the database stress testing scripts.
+#
+# By default every row is made on the fly: k is a random number, the
+# payload is k padded with 'x' to --row-width and date_time is the current
+# time. With --data-rows the rows are generated before the test starts,
+# from --seed, so the same seed always loads the same dataset and the
+# generation cost stays out of the measured operations:
+#
+#    k          --k-cardinality distinct values
+#    date_time  spread over --date-span seconds after 2017-01-01
+#    payload    --row-width up to --row-width-max characters of
+#
+#       pad     k padded with 'x', compresses to nothing
+#       text    words of a small vocabulary, compresses like prose
+#       random  hexadecimal digits, does not compress
+#       blob    base64 of random bytes, binary content stored as text
+#
+# The rows are kept in compact column buffers (arrays and one string per
+# text column) instead of one dict per row. The operations take the rows
+# in turn and start over once all of them are used.
+#
+# Code is kept compatible with python2 and python3.
+
+from array import array
+import base64
+import binascii
+from datetime import datetime, timedelta
+import itertools
+import random
+
+PAYLOAD_KINDS = ("pad", "text", "random", "blob")
+
+EPOCH = datetime(2017, 1, 1)
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+DATE_WIDTH = 19
+
+MAX_K = 2 ** 31 - 1
+
+WORDS = ("the", "of", "and", "to", "in", "is", "that", "for", "it", "as",
+         "was", "with", "be", "by", "on", "not", "he", "this", "are", "or",
+         "his", "from", "at", "which", "but", "have", "an", "had", "they",
+         "you", "were", "their", "one", "all", "we", "can", "her", "has",
+         "there", "been", "if", "more", "when", "will", "would", "who",
+         "so", "no", "database", "server", "table", "index", "query",
+         "commit", "latency", "stress", "test", "row", "column", "page",
+         "cache", "lock", "disk", "write")
+
+
+class DataSpec(object):
+    """Describe the columns of the generated rows"""
+
+    def __init__(self, row_width=30, row_width_max=None, payload="pad",
+                 k_cardinality=None, date_span=0):
+        if payload not in PAYLOAD_KINDS:
+            raise ValueError("Unknown payload %s, Such as [%s]"
+                             % (payload, "|".join(PAYLOAD_KINDS)))
+        self.row_width = row_width
+        self.row_width_max = max(row_width_max or row_width, row_width)
+        self.payload = payload
+        self.k_cardinality = min(k_cardinality or MAX_K, MAX_K)
+        self.date_span = date_span
+
+
+def pad_payload(rand, k, width):
+    return ("%d-" % k).ljust(width, "x")[:width]
+
+
+def text_payload(rand, k, width):
+    words = []
+    size = 0
+    while size < width:
+        word = rand.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:width]
+
+
+def random_payload(rand, k, width):
+    return "%0*x" % (width, rand.getrandbits(4 * width))
+
+
+def blob_payload(rand, k, width):
+    size = width * 3 // 4 + 3
+    data = binascii.unhexlify("%0*x" % (2 * size, rand.getrandbits(8 * size)))
+    return base64.b64encode(data).decode("ascii")[:width]
+
+
+PAYLOADS = {"pad": pad_payload,
+            "text": text_payload,
+            "random": random_payload,
+            "blob": blob_payload}
+
+
+class ColumnBuffers(object):
+    """Generated rows stored column by column"""
+
+    def __init__(self, keys, dates, offsets, payloads):
+        self.keys = keys
+        self.dates = dates
+        self.offsets = offsets
+        self.payloads = payloads
+        # itertools.count is atomic under the GIL, threads share the rows
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def row(self, num):
+        return {"date_time": self.dates[num * DATE_WIDTH:
+                                        (num + 1) * DATE_WIDTH],
+                "k": self.keys[num],
+                "payload": self.payloads[self.offsets[num]:
+                                         self.offsets[num + 1]]}
+
+    def next_row(self):
+        return self.row(next(self._counter) % len(self.keys))
+
+    def size(self):
+        """Return the memory size of the buffers in bytes"""
+
+        return (self.keys.itemsize * len(self.keys) + len(self.dates) +
+                self.offsets.itemsize * len(self.offsets) +
+                len(self.payloads))
+
+
+def generate(spec, count, seed=None):
+    """Generate count rows of spec, the same seed makes the same rows"""
+
+    rand = random.Random(seed)
+    make_payload = PAYLOADS[spec.payload]
+    keys = array("l")
+    offsets = array("L", [0])
+    dates = []
+    payloads = []
+    size = 0
+    for _ in range(count):
+        k = rand.randint(0, spec.k_cardinality - 1)
+        keys.append(k)
+        date_time = EPOCH + timedelta(seconds=rand.randint(0, spec.date_span))
+        dates.append(date_time.strftime(DATE_FORMAT))
+        payload = make_payload(rand, k, rand.randint(spec.row_width,
+                                                     spec.row_width_max))
+        payloads.append(payload)
+        size += len(payload)
+        offsets.append(size)
+    return ColumnBuffers(keys, "".join(dates), offsets, "".join(payloads))
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+# Scripts are mainly used for stress testing of different databases,
+# The way to test is to use Python modules to connect database then
+# Repeatedly run the workload operations.
+#
+# One load node can not saturate a big database cluster, so this script
+# drives one database from many load nodes. Start an agent on every node:
+#
+#    python db_stresstesting_distributed.py --agent <node_ipaddr>:7700 \
+#           --token <secret>
+#
+# An agent runs whatever database URI and options a coordinator sends it,
+# and the URI carries the database password in clear text. An agent only
+# listens on 127.0.0.1 unless a host is given (--agent 7700 is
+# 127.0.0.1:7700), expose it on a trusted network only and give it a
+# --token, the coordinator must send the same --token.
+#
+# then run the coordinator with the usual options, it sends the workload
+# to the agents, starts them at the same time, prints their merged
+# progress while they run and one merged report at the end:
+#
+#    python db_stresstesting_distributed.py -i <mysql_server_ipaddr> -u root \
+#           -p <root_password> -P 3306 -d <database_name> \
+#           -t [mysql|orace|sqlserver] -n <operation_count> \
+#           --agents node1:7700,node2:7700 [-T <threads_per_agent>] \
+#           [--token <secret>] [-w mixed -k zipfian]
+#
+# Use --local-agents <count> instead of --agents to run the agents as local
+# subprocesses.
+#
+# An agent logs to stderr, or to db_stresstesting_agent_<port>.log in
+# --log-dir. The coordinator gives up on an agent not ready, or silent
+# while it runs, for --agent-timeout seconds and reports it as failed.
+#
+# Coordinator and agents talk newline delimited JSON over TCP:
+#
+#    coordinator -> agent  {"cmd": "prepare", "uri": ..., "kwargs": ...,
+#                           "total": <share of the operations>,
+#                           "token": ...}
+#    agent -> coordinator  {"event": "ready"}
+#    coordinator -> agent  {"cmd": "start"}
+#    agent -> coordinator  {"event": "progress", "elapsed": ..., "stats": ...}
+#    agent -> coordinator  {"event": "done", "elapsed": ..., "stats": ...,
+#                           "pool": ...}
+#
+# An agent can answer {"event": "error", "message": ...} at any time.
+
+from __future__ import print_function
+
+import hmac
+import json
+import logging
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import db_stresstesting_common as common
+from db_stresstesting_common import StressTestDB, do_clean_table
+import db_stresstesting_metrics as metrics
+import db_stresstesting_workload as workloads
+
+DEFAULT_AGENT_PORT = 7700
+AGENT_TIMEOUT = 60
+
+
+def parse_args():
+    """The function define how to use this scipt andProvide help manual"""
+
+    p = common.get_option_parser()
+    p.add_option("-n", "--num", type="int", dest="total",
+                 help="Enter the total number of test database operations.")
+    p.add_option("-T", "--threads", type="int", dest="thread_count",
+                 default=10,
+                 help="Enter the number of test threads of every agent,"
+                 " default is 10")
+    p.add_option("--agent", dest="agent",
+                 help="Run as agent listening on host:port")
+    p.add_option("--agents", dest="agents",
+                 help="Comma separated host:port list of the agents")
+    p.add_option("--local-agents", type="int", dest="local_agents",
+                 help="Start the agents as local subprocesses")
+    p.add_option("--token", dest="token", default="",
+                 help="Secret the agents require from the coordinator")
+    p.add_option("--agent-timeout", type="float", dest="agent_timeout",
+                 default=AGENT_TIMEOUT,
+                 help="Seconds to wait for an agent to get ready, or for"
+                 " the progress of a running agent, default is %d"
+                 % AGENT_TIMEOUT)
+    p.add_option("--log-dir", dest="log_dir",
+                 help="Directory of the logs, an agent logs to stderr"
+                 " without it")
+
+    options, args = p.parse_args()
+    if options.agent:
+        return vars(options)
+    if not options.agents and not options.local_agents:
+        p.error("--agents or --local-agents is required")
+    kwargs = common.parse_args(p, required=("total",))
+    if kwargs["agent_timeout"] <= kwargs["progress_interval"]:
+        p.error("--agent-timeout must be longer than --progress-interval")
+    return kwargs
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port or DEFAULT_AGENT_PORT)
+
+
+def send_message(sock, message):
+    sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+
+def to_bytes(text):
+    if not isinstance(text, bytes):
+        text = text.encode("utf-8")
+    return text
+
+
+def read_messages(sock):
+    for line in sock.makefile("r"):
+        if line.strip():
+            yield json.loads(line)
+
+
+class Agent(object):
+    """Run the workload shares sent by a coordinator with the token"""
+
+    def __init__(self, host, port, token=""):
+        self.token = token
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.address = self.server.getsockname()
+
+    def serve_forever(self):
+        while True:
+            sock, peer = self.server.accept()
+            logging.info(">>> Coordinator %s:%s connected" % peer)
+            try:
+                self.handle(sock)
+            except Exception as err:
+                logging.exception(">>> Agent session failed: %s" % err)
+            finally:
+                sock.close()
+
+    def handle(self, sock):
+        messages = read_messages(sock)
+        for message in messages:
+            if message["cmd"] != "prepare":
+                continue
+            if not hmac.compare_digest(to_bytes(message.get("token", "")),
+                                       to_bytes(self.token)):
+                logging.warning(">>> Coordinator sent a wrong token")
+                send_message(sock, {"event": "error",
+                                    "message": "wrong token"})
+                return
+            try:
+                test_obj, workload = self.prepare(message)
+            except Exception as err:
+                send_message(sock, {"event": "error", "message": str(err)})
+                continue
+            send_message(sock, {"event": "ready"})
+            for message in messages:
+                if message["cmd"] == "start":
+                    self.run(sock, test_obj, workload, message)
+                    break
+            return
+
+    def prepare(self, message):
+        kwargs = message["kwargs"]
+        test_obj = common.get_test_obj(message["uri"], kwargs,
+                                       get_pool_options(kwargs))
+        self.total = message["total"]
+        self.kwargs = kwargs
+        workload = common.new_workload(test_obj, common.get_profile(kwargs),
+                                       kwargs["seed"])
+        return test_obj, workload
+
+    def run(self, sock, test_obj, workload, message):
+        stats = workloads.WorkloadStats()
+        runner = threading.Thread(target=workloads.run_threads,
+                                  name="Runner",
+                                  args=(test_obj, workload, stats,
+                                        self.kwargs["thread_count"],
+                                        self.total,
+                                        self.kwargs["log_sample"]))
+        interval = self.kwargs["progress_interval"]
+        start_time = time.time()
+        runner.start()
+        while runner.is_alive():
+            runner.join(interval or None)
+            if interval:
+                send_message(sock, {"event": "progress",
+                                    "elapsed": time.time() - start_time,
+                                    "stats": stats.to_dict()})
+        elapsed = time.time() - start_time
+        test_obj.dispose()
+        send_message(sock, {"event": "done",
+                            "elapsed": elapsed,
+                            "stats": stats.to_dict(),
+                            "pool": test_obj.pool_stats.to_dict()})
+
+
+def get_pool_options(kwargs):
+    # One connection per agent thread unless a pool size is given
+    if kwargs["pool_size"] is None:
+        return common.get_pool_options(kwargs,
+                                       pool_size=kwargs["thread_count"])
+    return common.get_pool_options(kwargs)
+
+
+def stop_local_agents(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+
+def start_local_agents(count, token="", log_dir=None):
+    """Start agents as subprocesses, return (processes, addresses)"""
+
+    processes = []
+    addresses = []
+    options = ["--log-dir", log_dir] if log_dir else []
+    try:
+        for num in range(count):
+            process = subprocess.Popen([sys.executable, __file__,
+                                        "--agent", "127.0.0.1:0",
+                                        "--token", token] + options,
+                                       stdout=subprocess.PIPE,
+                                       universal_newlines=True)
+            processes.append(process)
+            # The agent prints the address it listens on as first line
+            line = process.stdout.readline()
+            if not line.startswith("Agent listening on "):
+                raise RuntimeError("Local agent %d exited with %s before "
+                                   "listening" % (num, process.wait()))
+            addresses.append(parse_address(line.split()[-1]))
+    except Exception:
+        stop_local_agents(processes)
+        raise
+    return processes, addresses
+
+
+class Coordinator(object):
+    """Distribute a workload to agents and merge their results"""
+
+    def __init__(self, addresses):
+        self.sockets = [socket.create_connection(address)
+                        for address in addresses]
+        self.events = queue.Queue()
+
+    def _reader(self, num, sock):
+        try:
+            for message in read_messages(sock):
+                self.events.put((num, message))
+        except Exception as err:
+            self.events.put((num, {"event": "error", "message": str(err)}))
+            return
+        self.events.put((num, {"event": "error",
+                               "message": "connection closed"}))
+
+    def wait(self, kinds, agents, timeout):
+        """Wait for one of the event kinds from every agent
+
+        An agent which did not answer within timeout seconds gets an error.
+        """
+
+        answers = {}
+        deadline = time.time() + timeout
+        while len(answers) < len(agents):
+            try:
+                num, message = self.events.get(
+                    timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                for num in agents - set(answers):
+                    answers[num] = {"event": "error",
+                                    "message": "no answer within %gs"
+                                    % timeout}
+                break
+            if num in agents and message["event"] in kinds + ("error",):
+                answers[num] = message
+        return answers
+
+    def run(self, connect_uri, kwargs, progress=None, token=""):
+        timeout = kwargs["agent_timeout"]
+        for num, sock in enumerate(self.sockets):
+            reader = threading.Thread(target=self._reader,
+                                      name="Agent: %d" % num,
+                                      args=(num, sock))
+            reader.daemon = True
+            reader.start()
+
+        shares = split_total(kwargs["total"], len(self.sockets))
+        for num, sock in enumerate(self.sockets):
+            send_message(sock, {"cmd": "prepare", "uri": connect_uri,
+                                "kwargs": common.worker_kwargs(kwargs, num),
+                                "total": shares[num], "token": token})
+        agents = set(range(len(self.sockets)))
+        answers = self.wait(("ready",), agents, timeout)
+        errors = dict((num, message["message"]) for num, message
+                      in answers.items() if message["event"] == "error")
+        running = agents - set(errors)
+
+        start_time = time.time()
+        for num in running:
+            send_message(self.sockets[num], {"cmd": "start"})
+
+        latest = {}
+        done = {}
+        last_progress = start_time
+        # Without progress events an agent is silent until it is done
+        heard = dict((num, start_time) for num in running)
+        while len(done) < len(running):
+            try:
+                if not kwargs["progress_interval"]:
+                    num, message = self.events.get()
+                else:
+                    silent = min(heard[num] for num in running
+                                 if num not in done)
+                    num, message = self.events.get(
+                        timeout=max(silent + timeout - time.time(), 0))
+            except queue.Empty:
+                now = time.time()
+                for num in running:
+                    if num not in done and now - heard[num] >= timeout:
+                        done[num] = {"event": "error",
+                                     "message": "no progress within %gs"
+                                     % timeout}
+                continue
+            if num not in running or num in done:
+                continue
+            heard[num] = time.time()
+            if message["event"] == "progress":
+                latest[num] = message
+                now = time.time()
+                if (progress is not None and
+                        now - last_progress >= kwargs["progress_interval"]):
+                    last_progress = now
+                    progress(now - start_time, merge_stats(latest.values()))
+            elif message["event"] in ("done", "error"):
+                done[num] = message
+        elapsed = time.time() - start_time
+
+        for num, message in done.items():
+            if message["event"] == "error":
+                errors[num] = message["message"]
+        results = [message for message in done.values()
+                   if message["event"] == "done"]
+        pool_stats = common.PoolStats()
+        for message in results:
+            pool_stats.merge(common.PoolStats.from_dict(message["pool"]))
+        return merge_stats(results), pool_stats, errors, elapsed
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+
+def split_total(total, parts):
+    share, rest = divmod(total, parts)
+    return [share + (1 if num < rest else 0) for num in range(parts)]
+
+
+def merge_stats(messages):
+    stats = workloads.WorkloadStats()
+    for message in messages:
+        stats.merge(workloads.WorkloadStats.from_dict(message["stats"]))
+    return stats
+
+
+@common.timer
+def do_stress_test(connect_uri, **kwargs):
+    """Start stress test database opeartion"""
+
+    test_obj = common.new_test_obj(connect_uri, kwargs, data_rows=False,
+                                   pool_size=1)
+    test_obj.dispose()
+
+    processes = []
+    if kwargs["local_agents"]:
+        processes, addresses = start_local_agents(kwargs["local_agents"],
+                                                  kwargs["token"],
+                                                  kwargs["log_dir"])
+    else:
+        addresses = [parse_address(address)
+                     for address in kwargs["agents"].split(",")]
+    coordinator = None
+    reporter = None
+    stats = None
+    try:
+        coordinator = Coordinator(addresses)
+        # The agents send their progress, the reporter only prints and
+        # exports what the coordinator merged.
+        reporter = metrics.new_reporter(None, kwargs).start()
+        stats, pool_stats, errors, elapsed = coordinator.run(
+            connect_uri, kwargs,
+            lambda elapsed, stats: reporter.tick(stats), kwargs["token"])
+    except KeyboardInterrupt:
+        print("Quitting.....")
+        sys.exit(0)
+    finally:
+        if reporter is not None:
+            reporter.stop(stats)
+        if coordinator is not None:
+            coordinator.close()
+        stop_local_agents(processes)
+
+    for num, message in sorted(errors.items()):
+        print("Agent %s:%s failed: %s" % (addresses[num] + (message,)))
+    print("%s, %d agents" % (
+        common.describe_workload(common.get_profile(kwargs), kwargs),
+        len(addresses)))
+    for line in stats.report(elapsed):
+        print(line)
+    print(pool_stats.report())
+    begin_test = StressTestDB(connect_uri, kwargs["debug"])
+    db_total = begin_test.query_data()
+    begin_test.close()
+    print("A total of %d data in Streetest_table table" % db_total)
+
+
+def run_agent(address, token="", log_dir=None):
+    agent = Agent(*parse_address(address), token=token)
+    log_name = None
+    if log_dir:
+        log_name = "db_stresstesting_agent_%s.log" % agent.address[1]
+    common.setup_logging(log_name, log_dir)
+    if not token and not agent.address[0].startswith("127."):
+        logging.warning(">>> Agent on %s:%s without --token, any host may "
+                        "run a workload on it" % agent.address)
+    print("Agent listening on %s:%s" % agent.address)
+    sys.stdout.flush()
+    agent.serve_forever()
+
+
+def main():
+    kwargs = parse_args()
+    if kwargs["agent"]:
+        run_agent(kwargs["agent"], kwargs["token"], kwargs["log_dir"])
+        return
+
+    common.setup_logging(log_dir=kwargs["log_dir"])
+
+    connect_uri = common.get_connect_uri(kwargs)
+    if common.is_memory_uri(connect_uri):
+        print("In-memory sqlite can not be shared by agents")
+        sys.exit(1)
+    if kwargs["clean_table"] is False:
+        do_clean_table(connect_uri, kwargs)
+        sys.exit(0)
+
+    do_stress_test(connect_uri, **kwargs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+# Fault injection of the database stress testing scripts.
+#
+# The steady workload only tests the happy path, production pain comes
+# from reconnect storms and failovers. The faults are injected into the
+# engine of a StressTestDB while the workload runs:
+#
+#    --churn N          every Nth connection checkout reconnects, as with
+#                       a short pool_recycle or a connection per request
+#    --kill-every S     every S seconds kill the pooled connections, on
+#                       the server (PostgreSQL, MySQL) or by closing the
+#                       idle DBAPI connections of the pool
+#    --proxy-latency MS connect through a local TCP proxy adding MS
+#    [--proxy-jitter MS] (+/- jitter) milliseconds to every packet
+#    --outage-at S      the proxy cuts every connection and refuses new
+#    [--outage-for S]   ones S seconds into the run, for --outage-for
+#                       seconds, like a failover
+#
+# After every kill or outage the operations are watched until they
+# succeed without errors for RECOVERY_POLLS polls in a row, the recovery
+# time and the errors of every fault are printed after the report. A kill
+# which found no connection to kill is not a fault, only counted.
+#
+# Code is kept compatible with python2 and python3.
+
+from __future__ import print_function
+
+import itertools
+import logging
+import random
+import socket
+import threading
+import time
+
+from sqlalchemy import event, exc, text
+
+import db_stresstesting_common as common
+
+# Clean polls in a row, with operations and no errors, to recover
+RECOVERY_POLLS = 5
+
+
+class ChurnListener(object):
+    """Make every Nth connection checkout reconnect"""
+
+    def __init__(self, every):
+        self.every = every
+        self.count = 0
+        self._counter = itertools.count(1)
+
+    def attach(self, engine):
+        # First checkout listener, a refused checkout never reaches the
+        # pool statistics.
+        event.listen(engine, "checkout", self.on_checkout, insert=True)
+
+    def on_checkout(self, dbapi_conn, conn_record, conn_proxy):
+        if next(self._counter) % self.every == 0:
+            self.count += 1
+            # The pool closes the connection and checks out a new one
+            raise exc.DisconnectionError("Connection churn")
+
+
+class ConnectionKiller(object):
+    """Kill the connections of an engine while it is used"""
+
+    def __init__(self):
+        self.idle = set()
+        self._lock = threading.Lock()
+        self._engine = None
+
+    def attach(self, engine):
+        self._engine = engine
+        event.listen(engine, "checkin", self.on_checkin)
+        event.listen(engine, "checkout", self.on_checkout)
+        event.listen(engine, "invalidate", self.on_gone)
+        event.listen(engine, "close", self.on_gone)
+
+    def on_checkin(self, dbapi_conn, conn_record):
+        if dbapi_conn is not None:
+            with self._lock:
+                self.idle.add(dbapi_conn)
+
+    def on_checkout(self, dbapi_conn, conn_record, conn_proxy):
+        with self._lock:
+            self.idle.discard(dbapi_conn)
+
+    def on_gone(self, dbapi_conn, conn_record, exception=None):
+        with self._lock:
+            self.idle.discard(dbapi_conn)
+
+    def kill(self):
+        """Kill the connections, return how many were killed"""
+
+        dialect = self._engine.dialect.name
+        if dialect == "postgresql":
+            return self._kill_server(
+                "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                "WHERE datname = current_database() AND "
+                "usename = current_user AND pid <> pg_backend_pid()")
+        if dialect == "mysql":
+            with self._engine.connect() as connection:
+                ids = [row[0] for row in connection.execute(text(
+                    "SELECT id FROM information_schema.processlist "
+                    "WHERE user = SUBSTRING_INDEX(CURRENT_USER(), '@', 1) "
+                    "AND db = DATABASE() AND id <> CONNECTION_ID()"))]
+                for connection_id in ids:
+                    try:
+                        connection.execute(text("KILL %d" % connection_id))
+                    except exc.DBAPIError as err:
+                        # Gone in between
+                        logging.info(">>> KILL %d: %s" % (connection_id, err))
+            return len(ids)
+        # No way to kill a session from another one, close the idle
+        # connections under the feet of the pool instead.
+        with self._lock:
+            idle, self.idle = self.idle, set()
+        for dbapi_conn in idle:
+            try:
+                dbapi_conn.close()
+            except Exception as err:
+                logging.info(">>> Close connection: %s" % err)
+        return len(idle)
+
+    def _kill_server(self, sql):
+        with self._engine.connect() as connection:
+            return len(connection.execute(text(sql)).fetchall())
+
+
+class LatencyProxy(object):
+    """Forward TCP connections to a database server, slowly
+
+    Every chunk of data is delayed latency +/- jitter seconds in both
+    directions. outage() cuts the connections and refuses new ones for a
+    while.
+    """
+
+    BUFFER_SIZE = 65536
+
+    def __init__(self, target, latency=0.0, jitter=0.0):
+        self.target = target
+        self.latency = latency
+        self.jitter = jitter
+        self.down_until = 0.0
+        self._sockets = set()
+        self._lock = threading.Lock()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(128)
+        self.address = self.server.getsockname()
+
+    def start(self):
+        thread = threading.Thread(target=self._accept, name="Proxy")
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.close()
+        self._close_all()
+
+    def outage(self, seconds):
+        self.down_until = time.time() + seconds
+        self._close_all()
+
+    def _close_all(self):
+        # The pipes end on the shutdown and close their sockets
+        with self._lock:
+            sockets = list(self._sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except socket.error:
+                return
+            if time.time() < self.down_until:
+                client.close()
+                continue
+            try:
+                upstream = socket.create_connection(self.target)
+            except socket.error as err:
+                logging.info(">>> Proxy connect failed: %s" % err)
+                client.close()
+                continue
+            with self._lock:
+                self._sockets.update((client, upstream))
+            thread = threading.Thread(target=self._serve, name="Pipe",
+                                      args=(client, upstream))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, client, upstream):
+        """Pipe both directions, close the sockets once both ended"""
+
+        reverse = threading.Thread(target=self._pipe, name="Pipe",
+                                   args=(upstream, client))
+        reverse.daemon = True
+        reverse.start()
+        self._pipe(client, upstream)
+        reverse.join()
+        with self._lock:
+            self._sockets.difference_update((client, upstream))
+        client.close()
+        upstream.close()
+
+    def _pipe(self, source, sink):
+        try:
+            while True:
+                data = source.recv(self.BUFFER_SIZE)
+                if not data:
+                    break
+                delay = self.latency + random.uniform(-self.jitter,
+                                                      self.jitter)
+                if delay > 0:
+                    time.sleep(delay)
+                sink.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            for sock in (source, sink):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+
+class Fault(object):
+    """One injected fault and the recovery from it
+
+    killed is the number of connections a kill killed, None for an
+    outage.
+    """
+
+    def __init__(self, name, at, stats, killed=None):
+        self.name = name
+        self.at = at
+        self.killed = killed
+        self.time = time.time()
+        self.errors_before = sum(stats.errors.values())
+        self.errors = 0
+        self.recovery = None
+        # Start of the clean polls in a row, and how many
+        self.clean_since = None
+        self.clean_polls = 0
+
+
+class FaultInjector(object):
+    """Inject the faults of a run and measure the recovery from them
+
+    Every poll seconds the stats are checked, a fault is recovered once
+    recovery_polls polls in a row see new successful operations and no
+    new errors. Its recovery time runs to the start of those polls.
+    """
+
+    def __init__(self, churn=0, kill_every=0.0, latency=0.0, jitter=0.0,
+                 outage_at=None, outage_for=5.0, poll=0.1,
+                 recovery_polls=RECOVERY_POLLS):
+        self.churn = ChurnListener(churn) if churn else None
+        self.killer = ConnectionKiller() if kill_every else None
+        self.kill_every = kill_every
+        self.latency = latency
+        self.jitter = jitter
+        self.outage_at = outage_at
+        self.outage_for = outage_for
+        self.poll = poll
+        self.recovery_polls = recovery_polls
+        self.proxy = None
+        self.faults = []
+        self.kills = 0
+        # Kills which found no connection to kill
+        self.empty_kills = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def proxy_uri(self, kwargs):
+        """Start the proxy if needed, return the URI to connect to"""
+
+        if not (self.latency or self.jitter or self.outage_at is not None):
+            return common.get_connect_uri(kwargs)
+        self.proxy = LatencyProxy((kwargs["ip"], kwargs["port"]),
+                                  self.latency, self.jitter).start()
+        host, port = self.proxy.address
+        return common.get_connect_uri(dict(kwargs, ip=host, port=port))
+
+    def attach(self, test_obj):
+        if self.churn is not None:
+            self.churn.attach(test_obj._engine)
+        if self.killer is not None:
+            self.killer.attach(test_obj._engine)
+
+    def start(self, stats):
+        self._thread = threading.Thread(target=self._run, name="Faults",
+                                        args=(stats,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.proxy is not None:
+            self.proxy.stop()
+
+    def _run(self, stats):
+        start_time = time.time()
+        next_kill = self.kill_every or None
+        outage_done = self.outage_at is None
+        previous = stats.copy()
+        previous_time = start_time
+        while not self._stop.wait(self.poll):
+            current = stats.copy()
+            now = time.time()
+            elapsed = now - start_time
+            self._track(previous, current, previous_time)
+            previous = current
+            previous_time = now
+
+            if next_kill is not None and elapsed >= next_kill:
+                next_kill += self.kill_every
+                killed = self.killer.kill()
+                if killed:
+                    self.kills += 1
+                    self.faults.append(Fault("kill #%d" % self.kills,
+                                             elapsed, current, killed))
+                else:
+                    self.empty_kills += 1
+            if not outage_done and elapsed >= self.outage_at:
+                outage_done = True
+                self.proxy.outage(self.outage_for)
+                self.faults.append(Fault("outage %gs" % self.outage_for,
+                                         elapsed, current))
+            logging.debug(">>> Faults at %.1fs" % elapsed)
+
+    def _track(self, previous, current, previous_time):
+        """Track the recovery over the poll since previous_time"""
+
+        errors = sum(current.errors.values())
+        new_errors = errors - sum(previous.errors.values())
+        new_ops = current.total() - previous.total()
+        for fault in self.faults:
+            if fault.recovery is not None:
+                continue
+            fault.errors = errors - fault.errors_before
+            if not new_ops or new_errors:
+                fault.clean_polls = 0
+                continue
+            if not fault.clean_polls:
+                # The fault began within this poll at the earliest
+                fault.clean_since = max(previous_time, fault.time)
+            fault.clean_polls += 1
+            if fault.clean_polls >= self.recovery_polls:
+                fault.recovery = fault.clean_since - fault.time
+
+    def report(self, stats):
+        """Return the report lines of the faults"""
+
+        errors = sum(stats.errors.values())
+        total = stats.total() + errors
+        lines = ["faults: error rate %.3f%% (%d of %d operations)"
+                 % (errors * 100.0 / total if total else 0.0, errors, total)]
+        if self.churn is not None:
+            lines.append("  churn: %d reconnects, one every %d checkouts"
+                         % (self.churn.count, self.churn.every))
+        if self.empty_kills:
+            lines.append("  kill: %d kills found no connection to kill"
+                         % self.empty_kills)
+        for fault in self.faults:
+            lines.append("  %-12s at %6.1fs: %6s killed, %d errors, %s"
+                         % (fault.name, fault.at,
+                            "-" if fault.killed is None else fault.killed,
+                            fault.errors,
+                            "recovered in %.2fs" % fault.recovery
+                            if fault.recovery is not None
+                            else "not recovered"))
+        return lines
+
+
+def new_injector(kwargs):
+    """Return the FaultInjector of the options, None without faults"""
+
+    if not (kwargs.get("churn") or kwargs.get("kill_every") or
+            kwargs.get("proxy_latency") or kwargs.get("proxy_jitter") or
+            kwargs.get("outage_at") is not None):
+        return None
+    return FaultInjector(kwargs["churn"], kwargs["kill_every"],
+                         kwargs["proxy_latency"] / 1000.0,
+                         kwargs["proxy_jitter"] / 1000.0,
+                         kwargs["outage_at"], kwargs["outage_for"])
@@ -10,193 +10,95 @@
 #           -t [mysql|orace|sqlserver] -n <record_count> \
 #           [-C "clean test db table"|-D "open debug" ]
 #
+# The operation mix is chosen with a workload profile, such as 70% point
+# reads, 20% inserts and 10% updates on zipfian distributed keys:
+#
+#           -w mixed | -w read=70,insert=20,update=10 -k zipfian \
+#           [--row-width 200 --index k --index date_time]
+#
 # Code is reconstructed for test database
 # Defines the general class of the operating database, call Opeartion_DB class
 # can More flexible access to create, delete, add users and other operations
 
-from datetime import datetime
-import functools
 import logging
-import optparse
-import os
 import sys
 import time
 from gevent import monkey
 import gevent
 
-from sqlalchemy import create_engine
-from sqlalchemy import func, Column, Integer, String
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.ext import declarative
+import db_stresstesting_common as common
+from db_stresstesting_common import do_clean_table
+import db_stresstesting_metrics as metrics
+import db_stresstesting_workload as workloads
 
-Base = declarative.declarative_base()
 monkey.patch_all()
 
-DB_CONNECT_URI = {"mysql": "mysql://{user}:{password}@{ip}:{port}/{db}",
-                  "oracle": "oracle://{user}:{password}@{ip}:{port}/{db}",
-                  "sqlserver": "mssql+pymssql://{user}:{password}@{ip}"}
-
-
-def timer(func):
-
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        func(*args, **kwargs)
-        end_time = time.time()
-        print "Timer: %s" % (end_time - start_time)
-
-    return wrapper
-
-
-def setup_logging():
-    """Edit log configure file && output format"""
-
-    log_path = os.getcwd()
-    logging.basicConfig(level=logging.DEBUG,
-                        format="%(asctime)s %(filename)"
-                               "s[line:%(lineno)d] {%(threadName)s} "
-                               "%(levelname)s %(message)s",
-                        datefmt="%a, %d %b %Y %H:%M:%S",
-                        filename="%s/db_stresstesting.log" % log_path,
-                        filemode="w")
-
 
 def parse_args():
     """The function define how to use this scipt andProvide help manual"""
 
-    usage = "usage: %prog [options] arg1 ... arg2"
-    p = optparse.OptionParser(usage=usage)
-
-    p.add_option("-i", "--ip", dest="ip",
-
-                 help="Input an ip connect address.")
-    p.add_option("-u", "--user", type="string", dest="user",
-                 help="Input connect database test user.")
-    p.add_option("-p", "--password", dest="password",
-                 help="Input connect database user password")
-    p.add_option("-P", "--port", type="int", dest="port",
-                 help="Input connect database port number.")
-    p.add_option("-d", "--db", dest="db",
-                 help="Input connect database name.")
-    p.add_option("-t", "--type", dest="db_type",
-                 help="Input connect database type."
-                 "Such as [mysql|oracle|sqlserver].")
+    p = common.get_option_parser()
     p.add_option("-n", "--num", type="int", dest="total",
-                 help="Enter the total number of test database inserts.")
-    p.add_option("-C", "--clean", action="store_false", dest="clean_table",
-                 help="Clean test database table")
-    p.add_option("-D", "--debug", action="store_true", dest="open_debug",
-                 help="Open sqlalchemy debug mode, The default is False")
-
-    options, args = p.parse_args()
-
-    if options.total is None:
-        p.error("Pls test-database.py -h|--help")
-        sys.exit(1)
-
-    args = {"user": options.user,
-            "password": options.password,
-            "ip": options.ip,
-            "port": options.port,
-            "db": options.db,
-            "db_type": options.db_type,
-            "total": options.total,
-            "clean_table": options.clean_table,
-            "open_debug": options.open_debug}
-
-    return args
-
-
-class StressTestTable(Base):
-    """Define a database Persons table for use test"""
-
-    __tablename__ = "Streetest_table"
+                 help="Enter the total number of test database operations.")
 
-    id = Column(Integer, primary_key=True)
-    date_time = Column(String(30), default=datetime.utcnow())
+    return common.parse_args(p, required=("total",))
 
 
-class StressTestDB(object):
-    """Define stress test operation database the same class"""
-
-    def __init__(self, uri, debug=False):
-        self.uri = uri
-        self._engine = self._get_engine(uri, debug)
-        self._session = self.get_session()
-
-    def create_database(self):
-        Base.metadata.create_all(self._engine)
-
-    def drop_database(self):
-        Base.metadata.drop_all(self._engine)
-
-    def add_test_data(self):
-        start_date = datetime.utcnow()
-        new_test = StressTestTable(date_time=start_date)
-        self._session.add(new_test)
-        self._session.commit()
-
-    def query_data(self):
-        data_total = self._session.query(
-            func.count("*")).select_from(StressTestTable).scalar()
-
-        return data_total
-
-    def _get_engine(self, uri, debug=False):
-        try:
-            engine = create_engine(uri, pool_size=100, pool_recycle=7200,
-                                   echo=debug)
-        except Exception as err:
-            logging.info(">>> %s" % err)
-        return engine
-
-    def get_session(self):
-        session = scoped_session(sessionmaker(bind=self._engine,
-                                              autoflush=True))
-        return session
-
+def insert_record(test_obj, workload, stats, num, log_sample):
+    try:
+        op, key = workloads.run_operation(test_obj, workload, stats)
+    except Exception as err:
+        logging.exception(">>> The %d operation failed: %s" % (num, err))
+        return
+    finally:
+        test_obj.close()
+    workloads.log_operation(num, op, key, log_sample)
 
-def do_clean_table(connect_uri):
-    begin_test = StressTestDB(connect_uri)
-    begin_test.drop_database()
 
+@common.timer
+def do_stress_test(connect_uri, **kwargs):
+    """Start stress test database opeartion"""
 
-def insert_record(test_obj, num):
-    test_obj.add_test_data()
-    logging.info(">>> Insert the %d commit data..." % num)
+    total = kwargs["total"]
 
+    test_obj = common.new_test_obj(connect_uri, kwargs)
+    profile = common.get_profile(kwargs)
+    workload = common.new_workload(test_obj, profile, kwargs["seed"])
+    stats = workloads.WorkloadStats()
+    # Threads are greenlets once monkey patched, the reporter runs when
+    # the operations wait on the database.
+    reporter = metrics.new_reporter(stats.copy, kwargs).start()
+    start_time = time.time()
 
-@timer
-def do_stress_test(connect_uri, **kwargs):
-    """Start stress test database opeartion"""
-    debug = kwargs['open_debug']
-    test_obj = StressTestDB(connect_uri, debug=debug)
-    test_obj.create_database()
     try:
-
         gevents = []
-        for num in xrange(kwargs["total"]):
-            gevents.append(gevent.spawn(insert_record, test_obj, num))
+        for num in xrange(total):
+            gevents.append(gevent.spawn(insert_record, test_obj, workload,
+                                        stats, num, kwargs["log_sample"]))
         gevent.joinall(gevents)
-
     except KeyboardInterrupt:
         print "Quitting....."
         sys.exit(0)
     finally:
-        begin_test = StressTestDB(connect_uri, debug)
-        db_total = begin_test.query_data()
+        elapsed = time.time() - start_time
+        reporter.stop()
+        print common.describe_workload(profile, kwargs)
+        for line in stats.report(elapsed):
+            print line
+        print test_obj.pool_stats.report()
+        db_total = test_obj.query_data()
+        test_obj.close()
         print "A total of %d data in Persons table" % db_total
 
 
 def main():
     kwargs = parse_args()
-    setup_logging()
+    common.setup_logging()
+    connect_uri = common.get_connect_uri(kwargs)
     if kwargs["clean_table"] is False:
-        do_clean_table()
+        do_clean_table(connect_uri, kwargs)
         sys.exit(0)
 
-    connect_uri = DB_CONNECT_URI.get(kwargs["db_type"]).format(**kwargs)
     do_stress_test(connect_uri, **kwargs)
 
 
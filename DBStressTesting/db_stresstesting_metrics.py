@@ -0,0 +1,190 @@
+# Live progress and metrics export of the database stress testing scripts.
+#
+# While a test runs, the per worker counters are summed up every
+# --progress-interval seconds and the throughput and latency of the last
+# interval are printed as one progress line, rewritten in place on a
+# terminal:
+#
+#    [   12.0s] 120342 ops   10211.3 ops/s  p50 0.912ms  p99 4.331ms  0 errors
+#
+# The same aggregation can be exported for plotting or scraping:
+#
+#    --metrics-json FILE  one JSON object per interval (newline delimited)
+#    --metrics-prom FILE  Prometheus text format, rewritten every interval
+#                         (point the node_exporter textfile collector at it)
+#
+# Code is kept compatible with python2 and python3.
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import threading
+import time
+
+import db_stresstesting_workload as workloads
+
+PERCENTILES = (50, 95, 99)
+
+
+class ProgressReporter(object):
+    """Print and export the metrics of a running stress test
+
+    source is a callable returning a copy of the current WorkloadStats, it
+    is called every interval by a reporter thread. When source is None,
+    nothing runs in the background and the caller feeds the stats to
+    tick() itself.
+    """
+
+    def __init__(self, source=None, interval=1.0, json_path=None,
+                 prom_path=None, stream=None):
+        self.source = source
+        self.interval = interval
+        self.json_path = json_path
+        self.prom_path = prom_path
+        self.stream = stream or sys.stdout
+        self._previous = workloads.WorkloadStats()
+        self._json = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._start_time = self._last_time = time.time()
+        self._live = hasattr(self.stream, "isatty") and self.stream.isatty()
+
+    def start(self):
+        self._start_time = self._last_time = time.time()
+        if self.json_path:
+            self._json = open(self.json_path, "w")
+        if self.source is not None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run,
+                                            name="Progress")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.tick()
+
+    def stop(self, stats=None):
+        """Stop the reporter thread and report the final stats"""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if stats is not None or self.source is not None:
+            self.tick(stats)
+        if self._live and self.interval > 0:
+            self.stream.write("\n")
+            self.stream.flush()
+        if self._json is not None:
+            self._json.close()
+            self._json = None
+
+    def tick(self, stats=None):
+        """Report the stats recorded since the previous tick"""
+
+        if stats is None:
+            stats = self.source()
+        now = time.time()
+        elapsed = now - self._start_time
+        period = max(now - self._last_time, 1e-6)
+        current = stats.snapshot()
+        interval = stats.diff(self._previous).snapshot()
+        self._previous, self._last_time = stats, now
+
+        if self.interval > 0:
+            self.print_line(elapsed, period, current, interval)
+        if self._json is not None:
+            self.write_json(now, elapsed, period, current, interval)
+        if self.prom_path:
+            self.write_prom(current)
+
+    def print_line(self, elapsed, period, current, interval):
+        latency = merge_histograms(interval.histograms.values())
+        line = ("[%7.1fs] %d ops  %10.1f ops/s  p50 %.3fms  p99 %.3fms  "
+                "%d errors"
+                % (elapsed,
+                   sum(h.count for h in current.histograms.values()),
+                   latency.count / period,
+                   latency.percentile(50) * 1000,
+                   latency.percentile(99) * 1000,
+                   sum(current.errors.values())))
+        if self._live:
+            self.stream.write("\r%-79s" % line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def write_json(self, now, elapsed, period, current, interval):
+        ops = {}
+        for op in workloads.OPERATIONS:
+            histogram = interval.histograms.get(op)
+            if histogram is None and op not in interval.errors:
+                continue
+            histogram = histogram or workloads.LatencyHistogram()
+            ops[op] = {"count": histogram.count,
+                       "errors": interval.errors.get(op, 0),
+                       "rows": interval.rows.get(op, 0),
+                       "ops_per_sec": histogram.count / period,
+                       "mean": histogram.mean()}
+            for percent in PERCENTILES:
+                ops[op]["p%d" % percent] = histogram.percentile(percent)
+        record = {"time": now,
+                  "elapsed": elapsed,
+                  "interval": period,
+                  "total": sum(h.count for h in current.histograms.values()),
+                  "errors": sum(current.errors.values()),
+                  "ops": ops}
+        self._json.write(json.dumps(record, sort_keys=True) + "\n")
+        self._json.flush()
+
+    def write_prom(self, current):
+        lines = []
+        for name, kind, doc, values in (
+                ("operations_total", "counter", "Operations completed.",
+                 dict((op, h.count) for op, h
+                      in current.histograms.items())),
+                ("errors_total", "counter", "Operations failed.",
+                 current.errors),
+                ("rows_total", "counter", "Rows handled by the operations.",
+                 current.rows)):
+            lines.append("# HELP db_stress_%s %s" % (name, doc))
+            lines.append("# TYPE db_stress_%s %s" % (name, kind))
+            for op in sorted(values):
+                lines.append('db_stress_%s{op="%s"} %d'
+                             % (name, op, values[op]))
+
+        lines.append("# HELP db_stress_latency_seconds Operation latency.")
+        lines.append("# TYPE db_stress_latency_seconds summary")
+        for op in sorted(current.histograms):
+            histogram = current.histograms[op]
+            for percent in PERCENTILES:
+                lines.append('db_stress_latency_seconds{op="%s",'
+                             'quantile="%s"} %.6f'
+                             % (op, percent / 100.0,
+                                histogram.percentile(percent)))
+            lines.append('db_stress_latency_seconds_sum{op="%s"} %.6f'
+                         % (op, histogram.mean() * histogram.count))
+            lines.append('db_stress_latency_seconds_count{op="%s"} %d'
+                         % (op, histogram.count))
+
+        # Write aside then rename, a scraper never reads a partial file
+        tmp_path = "%s.tmp" % self.prom_path
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(tmp_path, self.prom_path)
+
+
+def merge_histograms(histograms):
+    latency = workloads.LatencyHistogram()
+    for histogram in histograms:
+        latency.merge(histogram)
+    return latency
+
+
+def new_reporter(source, kwargs):
+    """Build the reporter configured by the command line options"""
+
+    return ProgressReporter(source, kwargs["progress_interval"],
+                            kwargs["metrics_json"], kwargs["metrics_prom"])
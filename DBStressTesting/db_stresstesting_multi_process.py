@@ -5,183 +5,224 @@
 # You can use this script in the following ways:
 # such as:
 #
-#    python db_stresstesting_multi_thread.py -i <mysql_server_ipaddr> -u root \
+#    python db_stresstesting_multi_process.py -i <mysql_server_ipaddr> -u root \
 #           -p <root_password> -P 3306 -d <database_name> \
 #           -t [mysql|orace|sqlserver] -n <record_count> \
+#           [-c <process_count> -T <threads_per_process>] \
 #           [-C "clean test db table"|-D "open debug" ]
 #
+# Every worker process builds its own engine after the fork, runs its share
+# of the operations and sends its compact latency histograms back to the
+# parent over a queue, the parent merges them into one report. While the
+# workers run they also send their histograms every --progress-interval,
+# the parent prints and exports the merged progress.
+#
+# The operation mix is chosen with a workload profile, such as 70% point
+# reads, 20% inserts and 10% updates on zipfian distributed keys:
+#
+#           -w mixed | -w read=70,insert=20,update=10 -k zipfian \
+#           [--row-width 200 --index k --index date_time]
+#
 # Code is reconstructed for test database
 # Defines the general class of the operating database, call Opeartion_DB class
 # can More flexible access to create, delete, add users and other operations
 
-from datetime import datetime
-import functools
 import logging
 import multiprocessing
-import optparse
-import os
+import Queue
 import sys
+import threading
 import time
 
-from sqlalchemy import create_engine
-from sqlalchemy import func, Column, Integer, String
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.ext import declarative
-
-Base = declarative.declarative_base()
-
-DB_CONNECT_URI = {"mysql": "mysql://{user}:{password}@{ip}:{port}/{db}",
-                  "oracle": "oracle://{user}:{password}@{ip}:{port}/{db}",
-                  "sqlserver": "mssql+pymssql://{user}:{password}@{ip}"}
-
-
-def timer(func):
-
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        func(*args, **kwargs)
-        end_time = time.time()
-        print "Timer: %s" % (end_time - start_time)
-
-    return wrapper
-
-
-def setup_logging():
-    """Edit log configure file && output format"""
-
-    log_path = os.getcwd()
-    logging.basicConfig(level=logging.DEBUG,
-                        format="%(asctime)s %(filename)"
-                               "s[line:%(lineno)d] {%(threadName)s} "
-                               "%(levelname)s %(message)s",
-                        datefmt="%a, %d %b %Y %H:%M:%S",
-                        filename="%s/db_stresstesting.log" % log_path,
-                        filemode="w")
+import db_stresstesting_common as common
+from db_stresstesting_common import StressTestDB, do_clean_table
+import db_stresstesting_metrics as metrics
+import db_stresstesting_workload as workloads
 
 
 def parse_args():
     """The function define how to use this scipt andProvide help manual"""
 
-    usage = "usage: %prog [options] arg1 ... arg2"
-    p = optparse.OptionParser(usage=usage)
-
-    p.add_option("-i", "--ip", dest="ip",
-
-                 help="Input an ip connect address.")
-    p.add_option("-u", "--user", type="string", dest="user",
-                 help="Input connect database test user.")
-    p.add_option("-p", "--password", dest="password",
-                 help="Input connect database user password")
-    p.add_option("-P", "--port", type="int", dest="port",
-                 help="Input connect database port number.")
-    p.add_option("-d", "--db", dest="db",
-                 help="Input connect database name.")
-    p.add_option("-t", "--type", dest="db_type",
-                 help="Input connect database type."
-                 "Such as [mysql|oracle|sqlserver].")
+    p = common.get_option_parser()
     p.add_option("-n", "--num", type="int", dest="total",
-                 help="Enter the total number of test database inserts.")
-    p.add_option("-C", "--clean", action="store_false", dest="clean_table",
-                 help="Clean test database table")
-    p.add_option("-D", "--debug", action="store_true", dest="open_debug",
-                 help="Open sqlalchemy debug mode, The default is False")
-
-    options, args = p.parse_args()
+                 help="Enter the total number of test database operations.")
+    p.add_option("-c", "--process_count", type="int", dest="process_count",
+                 default=multiprocessing.cpu_count(),
+                 help="Enter the number of worker processes,"
+                 " default is the cpu count")
+    p.add_option("-T", "--threads", type="int", dest="thread_count",
+                 default=1,
+                 help="Enter the number of test threads of every worker"
+                 " process, default is 1")
 
-    if options.total is None:
-        p.error("Pls test-database.py -h|--help")
-        sys.exit(1)
-
-    args = {"user": options.user,
-            "password": options.password,
-            "ip": options.ip,
-            "port": options.port,
-            "db": options.db,
-            "db_type": options.db_type,
-            "total": options.total,
-            "clean_table": options.clean_table,
-            "open_debug": options.open_debug}
+    return common.parse_args(p, required=("total",))
 
-    return args
 
+def split_total(total, parts):
+    share, rest = divmod(total, parts)
+    return [share + (1 if num < rest else 0) for num in xrange(parts)]
 
-class StressTestTable(Base):
-    """Define a database Persons table for use test"""
 
-    __tablename__ = "Streetest_table"
+def get_pool_options(kwargs):
+    # Every worker thread holds one connection, the default pool of 100
+    # connections per process would be far too big.
+    if kwargs["pool_size"] is None:
+        return common.get_pool_options(kwargs,
+                                       pool_size=kwargs["thread_count"])
+    return common.get_pool_options(kwargs)
 
-    id = Column(Integer, primary_key=True)
-    date_time = Column(String(30), default=datetime.utcnow())
 
+def run_worker(connect_uri, kwargs, worker_num, total, start, results):
+    """Run the share of the operations of a worker process
 
-class StressTestDB(object):
-    """Define stress test operation database the same class"""
+    Messages sent to the parent are (kind, worker_num, payload) tuples,
+    'ready' once connected, 'progress' with the metrics so far while the
+    operations run, then 'done' with the metrics, or 'error'.
+    """
 
-    def __init__(self, uri, debug=False):
-        self.uri = uri
-        self._engine = self._get_engine(uri, debug)
-        self._session = self.get_session()
+    kwargs = common.worker_kwargs(kwargs, worker_num)
+    try:
+        # The engine is built after the fork, no connection is shared
+        # with the parent or the other workers.
+        test_obj = common.get_test_obj(connect_uri, kwargs,
+                                       get_pool_options(kwargs))
+        workload = common.new_workload(test_obj, common.get_profile(kwargs),
+                                       kwargs["seed"])
+        stats = workloads.WorkloadStats()
+    except Exception as err:
+        logging.exception(">>> Worker %d failed to start: %s"
+                          % (worker_num, err))
+        results.put(("error", worker_num, str(err)))
+        return
+
+    results.put(("ready", worker_num, None))
+    start.wait()
+    done = threading.Event()
+    if kwargs["progress_interval"] > 0:
+        sender = threading.Thread(target=send_progress, name="Progress",
+                                  args=(stats, worker_num, results,
+                                        kwargs["progress_interval"], done))
+        sender.daemon = True
+        sender.start()
+    try:
+        elapsed = workloads.run_threads(test_obj, workload, stats,
+                                        kwargs["thread_count"], total,
+                                        kwargs["log_sample"])
+        test_obj.dispose()
+    except Exception as err:
+        logging.exception(">>> Worker %d failed: %s" % (worker_num, err))
+        results.put(("error", worker_num, str(err)))
+        return
+    finally:
+        done.set()
+    results.put(("done", worker_num,
+                 {"elapsed": elapsed,
+                  "stats": stats.to_dict(),
+                  "pool": test_obj.pool_stats.to_dict()}))
 
-    def create_database(self):
-        Base.metadata.create_all(self._engine)
 
-    def drop_database(self):
-        Base.metadata.drop_all(self._engine)
+def send_progress(stats, worker_num, results, interval, done):
+    while not done.wait(interval):
+        results.put(("progress", worker_num, stats.to_dict()))
 
-    def add_test_data(self):
-        start_date = datetime.utcnow()
-        new_test = StressTestTable(date_time=start_date)
-        self._session.add(new_test)
-        self._session.commit()
 
-    def query_data(self):
-        data_total = self._session.query(
-            func.count("*")).select_from(StressTestTable).scalar()
+def collect(results, workers, count, progress=None):
+    """Get count messages from the workers, fail if they all died
 
-        return data_total
+    Progress messages are not counted, they are handed to progress.
+    """
 
-    def _get_engine(self, uri, debug=False):
+    messages = []
+    while len(messages) < count:
         try:
-            engine = create_engine(uri, pool_size=100, pool_recycle=7200,
-                                   echo=debug)
-        except Exception as err:
-            logging.info(">>> %s" % err)
-        return engine
+            message = results.get(timeout=1)
+        except Queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                raise RuntimeError("Worker processes exited without result")
+            continue
+        if message[0] == "progress":
+            if progress is not None:
+                progress(message[1], message[2])
+            continue
+        messages.append(message)
+    return messages
 
-    def get_session(self):
-        session = scoped_session(sessionmaker(bind=self._engine,
-                                              autoflush=True))
-        return session
 
+class WorkerProgress(object):
+    """Keep the latest metrics of every worker"""
 
-def do_clean_table(connect_uri):
-    begin_test = StressTestDB(connect_uri)
-    begin_test.drop_database()
+    def __init__(self):
+        self.latest = {}
 
+    def __call__(self, worker_num, payload):
+        self.latest[worker_num] = payload
 
-def insert_record(test_obj, num):
-    test_obj.add_test_data()
-    logging.info(">>> Insert the %d commit data..." % num)
+    def stats(self):
+        stats = workloads.WorkloadStats()
+        for payload in self.latest.values():
+            stats.merge(workloads.WorkloadStats.from_dict(payload))
+        return stats
 
 
-@timer
+@common.timer
 def do_stress_test(connect_uri, **kwargs):
     """Start stress test database opeartion"""
 
-    debug = kwargs['open_debug']
+    debug = kwargs["debug"]
     total = kwargs["total"]
 
-    test_obj = StressTestDB(connect_uri, debug=debug)
-    test_obj.create_database()
-
+    test_obj = common.new_test_obj(connect_uri, kwargs, data_rows=False,
+                                   pool_size=1)
+    # Close the parent connections, they must not be inherited by the
+    # forked workers.
+    test_obj.dispose()
+
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    workers = []
+    for worker_num, share in enumerate(
+            split_total(total, kwargs["process_count"])):
+        worker = multiprocessing.Process(
+            target=run_worker, name="Worker: %d" % worker_num,
+            args=(connect_uri, kwargs, worker_num, share, start, results))
+        worker.start()
+        workers.append(worker)
+
+    stats = workloads.WorkloadStats()
+    pool_stats = common.PoolStats()
+    progress = WorkerProgress()
+    reporter = metrics.new_reporter(progress.stats, kwargs)
+    start_time = time.time()
     try:
-        mpool = multiprocessing.Pool(total)
-        mpool.map(insert_record, ((test_obj, i) for i in xrange(total)))
+        messages = collect(results, workers, len(workers))
+        failed = [message for message in messages if message[0] == "error"]
+        start_time = time.time()
+        reporter.start()
+        start.set()
+        messages = failed + collect(results, workers,
+                                    len(workers) - len(failed), progress)
+        for kind, worker_num, payload in messages:
+            if kind == "error":
+                print "Worker %d failed: %s" % (worker_num, payload)
+                continue
+            stats.merge(workloads.WorkloadStats.from_dict(payload["stats"]))
+            pool_stats.merge(common.PoolStats.from_dict(payload["pool"]))
+        for worker in workers:
+            worker.join()
     except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
         print "Quitting....."
         sys.exit(0)
     finally:
+        elapsed = time.time() - start_time
+        reporter.stop(stats)
+        print "%s, %d processes" % (
+            common.describe_workload(common.get_profile(kwargs), kwargs),
+            len(workers))
+        for line in stats.report(elapsed):
+            print line
+        print pool_stats.report()
         begin_test = StressTestDB(connect_uri, debug)
         db_total = begin_test.query_data()
         print "A total of %d data in Persons table" % db_total
@@ -189,12 +230,15 @@ def do_stress_test(connect_uri, **kwargs):
 
 def main():
     kwargs = parse_args()
-    setup_logging()
+    common.setup_logging()
+    connect_uri = common.get_connect_uri(kwargs)
+    if common.is_memory_uri(connect_uri):
+        print "In-memory sqlite can not be shared by worker processes"
+        sys.exit(1)
     if kwargs["clean_table"] is False:
-        do_clean_table()
+        do_clean_table(connect_uri, kwargs)
         sys.exit(0)
 
-    connect_uri = DB_CONNECT_URI.get(kwargs["db_type"]).format(**kwargs)
     do_stress_test(connect_uri, **kwargs)
 
 
@@ -10,176 +10,132 @@
 #           -p password -P 3306 -d test -t mysql -n 100 \
 #           [-C "clean test db table"|-D "open debug" ]
 #
+# The operation mix is chosen with a workload profile, such as 70% point
+# reads, 20% inserts and 10% updates on zipfian distributed keys:
+#
+#           -w mixed | -w read=70,insert=20,update=10 -k zipfian \
+#           [--row-width 200 --index k --index date_time]
+#
+# To size a connection pool from data, rerun the workload across pool
+# sizes and compare the throughput and latency of every size, the table
+# is emptied by --reset-method before every size:
+#
+#           -c 200 -n 20000 --pool-sweep 5,10,20,50,100 [--max-overflow 0]
+#
+# Inserts go through the ORM unit of work by default. To separate the
+# client overhead from the server capacity, compare the ORM, the cached
+# compiled Core insert and the raw DBAPI cursor paths, on a table emptied
+# by --reset-method before every path:
+#
+#           -w insert -n 20000 --compare-paths | --insert-path raw
+#
+# The harness itself can run offline on SQLite (a file or :memory:), and
+# bulk loads are measured per load method of the database type:
+#
+#           -t sqlite -d /tmp/stress.db [--sqlite-journal wal] \
+#           [--sqlite-sync normal] -w bulk-load \
+#           [--bulk-method orm|executemany|values|copy --batch-size 1000]
+#
+# A progress line is printed every second while the test runs, the metrics
+# of every interval can be exported for plotting or scraping:
+#
+#           [--progress-interval 1] [--metrics-json metrics.ndjson] \
+#           [--metrics-prom metrics.prom] [--log-sample 1000]
+#
+# Only the measurement phase is reported when the run is phased, after a
+# fixed warmup or once the throughput is steady, for a fixed duration or
+# until the operations run out:
+#
+#           [--warmup 10] [--steady-state --steady-cv 0.05] \
+#           [--duration 60 --cooldown 5]
+#
+# Reconnect storms and failovers are injected while the workload runs,
+# the errors and the recovery time of every fault are reported:
+#
+#           [--churn 100] [--kill-every 10] \
+#           [--proxy-latency 5 --proxy-jitter 2] \
+#           [--outage-at 30 --outage-for 5]
+#
 # Code is reconstructed for test database
 # Defines the general class of the operating database, call Opeartion_DB class
 # can More flexible access to create, delete, add users and other operations
 
-from datetime import datetime
-import functools
-import logging
-import optparse
 import os
 import sys
 import time
-import threading
-
-from sqlalchemy import create_engine
-from sqlalchemy import func, Column, Integer, String
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.ext import declarative
 
-Base = declarative.declarative_base()
-
-DB_CONNECT_URI = {"mysql": "mysql://{user}:{password}@{ip}:{port}/{db}",
-                  "oracle": "oracle://{user}:{password}@{ip}:{port}/{db}",
-                  "sqlserver": "mssql+pymssql://{user}:{password}@{ip}"}
-
-
-def timer(func):
-
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        func(*args, **kwargs)
-        end_time = time.time()
-        print "Timer: %s" % (end_time - start_time)
-
-    return wrapper
-
-
-def setup_logging():
-    """Edit log configure file && output format"""
-
-    log_path = os.getcwd()
-    logging.basicConfig(level=logging.DEBUG,
-                        format="%(asctime)s %(filename)"
-                               "s[line:%(lineno)d] {%(threadName)s} "
-                               "%(levelname)s %(message)s",
-                        datefmt="%a, %d %b %Y %H:%M:%S",
-                        filename="%s/db_stresstesting.log" % log_path,
-                        filemode="w")
+import db_stresstesting_common as common
+from db_stresstesting_common import do_clean_table
+import db_stresstesting_faults as faults
+import db_stresstesting_metrics as metrics
+import db_stresstesting_workload as workloads
 
 
 def parse_args():
     """The function define how to use this scipt andProvide help manual"""
 
-    usage = "usage: %prog [options] arg1 ... arg2"
-    p = optparse.OptionParser(usage=usage)
-
-    p.add_option("-i", "--ip", dest="ip",
-                 help="Input an ip connect address.")
-    p.add_option("-u", "--user", type="string", dest="user",
-                 help="Input connect database test user.")
-    p.add_option("-p", "--password", dest="password",
-                 help="Input connect database user password")
-    p.add_option("-P", "--port", type="int",
-                 dest="port", default=3306,
-                 help="Input connect database port number, default is 3306")
-    p.add_option("-d", "--db", dest="db",
-                 help="Input connect database name.")
-    p.add_option("-t", "--type", dest="db_type", default="mysql",
-                 help="Input connect database type."
-                 "Such as [mysql|oracle|sqlserver], default is mysql")
+    p = common.get_option_parser()
+    common.add_phase_options(p)
+    common.add_fault_options(p)
     p.add_option("-c", "--thread_count", type="int",
                  dest="thread_count", default=100,
-                 help="Enter the total number of test database inserts."
+                 help="Enter the number of concurrent test threads."
                  " default is 100 thread count")
-    p.add_option("-C", "--clean", action="store_false", dest="clean_table",
-                 help="Clean test database table")
-    p.add_option("-D", "--debug", action="store_true", dest="debug",
-                 help="Open sqlalchemy debug mode, The default is False")
-
-    options, args = p.parse_args()
-
-    if options.db is None:
-        p.error("Pls test-database.py -h|--help")
-        sys.exit(1)
-
-    args = {"user": options.user,
-            "password": options.password,
-            "ip": options.ip,
-            "port": options.port,
-            "db": options.db,
-            "db_type": options.db_type,
-            "thread_count": options.thread_count,
-            "clean_table": options.clean_table,
-            "debug": options.debug}
-
-    return args
-
-
-class StressTestTable(Base):
-    """Define a database Persons table for use test"""
-
-    __tablename__ = "Streetest_table"
-
-    id = Column(Integer, primary_key=True)
-    date_time = Column(String(30), default=datetime.utcnow())
-
-
-class StressTestDB(object):
-    """Define stress test operation database the same class"""
-
-    def __init__(self, uri, debug=False):
-        self.uri = uri
-        self.debug = debug
-        self._engine = self.get_engine()
-        self.session = self.get_session()
-
-    def create_database(self):
-        Base.metadata.create_all(self._engine)
-
-    def drop_database(self):
-        Base.metadata.drop_all(self._engine)
-
-    def add_test_data(self):
-        start_date = datetime.utcnow()
-        new_test = StressTestTable(date_time=start_date)
-        self.session.add(new_test)
-        self.session.commit()
-
-    def query_data(self):
-        data_total = self.session.query(
-            func.count("*")).select_from(StressTestTable).scalar()
-
-        return data_total
-
-    def get_engine(self):
+    p.add_option("-n", "--num", type="int", dest="total",
+                 help="Enter the total number of test database operations."
+                 " default is one operation per thread")
+    p.add_option("--pool-sweep", dest="pool_sweep",
+                 help="Rerun the workload for every pool size of a comma "
+                 "separated list, such as 5,10,20,50, on an emptied table")
+    p.add_option("--compare-paths", action="store_true",
+                 dest="compare_paths", default=False,
+                 help="Rerun the workload with every insert path (orm, core,"
+                 " raw) and compare their client CPU time")
+
+    kwargs = common.parse_args(p, required=("db",))
+    if kwargs["db_type"] == "sqlite" and (
+            kwargs["proxy_latency"] or kwargs["proxy_jitter"] or
+            kwargs["outage_at"] is not None):
+        p.error("The proxy options need a network database, not sqlite")
+    if kwargs["churn"] < 0 or kwargs["kill_every"] < 0:
+        p.error("--churn and --kill-every must not be negative")
+    if kwargs["churn"] == 1:
+        # A checkout is only retried a few times, every one would fail
+        p.error("--churn must be 0 or at least 2")
+    if kwargs["total"] is None:
+        # A timed measurement runs until it is over
+        kwargs["total"] = (sys.maxsize if kwargs["duration"]
+                           else kwargs["thread_count"])
+    if kwargs["pool_sweep"]:
         try:
-            engine = create_engine(self.uri, pool_size=100,
-                                   pool_recycle=7200, echo=self.debug)
-        except Exception as err:
-            logging.info(">>> %s" % err)
-        return engine
-
-    def get_session(self):
-        session = scoped_session(sessionmaker(bind=self._engine,
-                                              autoflush=True))
-        return session
-
-
-def do_clean_table(connect_uri):
-    begin_test = StressTestDB(connect_uri)
-    begin_test.drop_database()
-
+            kwargs["pool_sweep"] = [int(size) for size
+                                    in kwargs["pool_sweep"].split(",")]
+        except ValueError:
+            p.error("--pool-sweep must be a list of pool sizes")
+    return kwargs
 
-def insert_record(test_obj, num):
-    test_obj.add_test_data()
-    logging.info(">>> Insert the %d commit data..." % num)
 
-
-@timer
+@common.timer
 def do_stress_test(connect_uri, **kwargs):
-    """Start stress test database opeartion"""
-    debug = kwargs.get("debug")
-    test_obj = StressTestDB(connect_uri, debug=debug)
-    test_obj.create_database()
+    """Start stress test database opeartion, return (stats, elapsed)"""
+    injector = faults.new_injector(kwargs)
+    if injector is not None:
+        connect_uri = injector.proxy_uri(kwargs)
+    test_obj = common.new_test_obj(connect_uri, kwargs)
+    if injector is not None:
+        injector.attach(test_obj)
+    workload = common.new_workload(test_obj, common.get_profile(kwargs),
+                                   kwargs["seed"])
+    stats = workloads.WorkloadStats()
+    phases = common.new_phases(kwargs)
+    reporter = metrics.new_reporter(stats.copy, kwargs).start()
+    start_time = time.time()
+    if injector is not None:
+        injector.start(stats)
     try:
-        for thread_num in xrange(kwargs.get("thread_count")):
-            threading.Thread(target=insert_record,
-                             name=('Thread: %s' % thread_num),
-                             args=(test_obj, thread_num)).start()
-        test_obj.session.close()
+        workloads.run_threads(test_obj, workload, stats,
+                              kwargs["thread_count"], kwargs["total"],
+                              kwargs["log_sample"], phases)
 
     # Test process, if you want to interrupt the program,
     # you can output friendly
@@ -187,21 +143,143 @@ def do_stress_test(connect_uri, **kwargs):
         print "Quitting....."
         sys.exit(0)
     finally:
-        begin_test = StressTestDB(connect_uri, debug)
-        db_total = begin_test.query_data()
-        begin_test._session.close()
+        elapsed = time.time() - start_time
+        reporter.stop()
+        if injector is not None:
+            injector.stop()
+        if phases is not None:
+            stats, elapsed = phases.get_stats(stats, elapsed)
+        print common.describe_workload(workload.profile, kwargs)
+        if phases is not None:
+            print phases.describe()
+        for line in stats.report(elapsed):
+            print line
+        print test_obj.pool_stats.report()
+        if injector is not None:
+            for line in injector.report(stats):
+                print line
+        db_total = test_obj.query_data()
+        test_obj.close()
         print "A total of %d data in Streetest_table table" % db_total
+    return stats, elapsed
+
+
+@common.timer
+def do_pool_sweep(connect_uri, **kwargs):
+    """Rerun the workload for every pool size and compare them"""
+
+    profile = common.get_profile(kwargs)
+    results = []
+    try:
+        for pool_size in kwargs["pool_sweep"]:
+            # Every size starts from the same empty table
+            do_clean_table(connect_uri, kwargs)
+            test_obj = common.new_test_obj(connect_uri, kwargs,
+                                           pool_size=pool_size)
+            workload = common.new_workload(test_obj, profile,
+                                           kwargs["seed"])
+            stats = workloads.WorkloadStats()
+            phases = common.new_phases(kwargs)
+            elapsed = workloads.run_threads(test_obj, workload, stats,
+                                            kwargs["thread_count"],
+                                            kwargs["total"],
+                                            kwargs["log_sample"], phases)
+            test_obj.dispose()
+            if phases is not None:
+                stats, elapsed = phases.get_stats(stats, elapsed)
+            results.append((pool_size, stats, test_obj.pool_stats, elapsed))
+            print "Pool size %d done in %.2fs" % (pool_size, elapsed)
+    except KeyboardInterrupt:
+        print "Quitting....."
+        sys.exit(0)
+    finally:
+        print "%s, %d threads, %d operations" % (
+            common.describe_workload(profile, kwargs),
+            kwargs["thread_count"], kwargs["total"])
+        print "%9s %10s %8s %10s %10s %10s %8s %8s" % (
+            "pool_size", "ops/s", "errors", "p50(ms)", "p99(ms)",
+            "wait(ms)", "connects", "overflow")
+        for pool_size, stats, pool_stats, elapsed in results:
+            latency = workloads.LatencyHistogram()
+            for histogram in stats.histograms.values():
+                latency.merge(histogram)
+            print "%9d %10.1f %8d %10.3f %10.3f %10.3f %8d %8d" % (
+                pool_size, stats.total() / elapsed,
+                sum(stats.errors.values()),
+                latency.percentile(50) * 1000,
+                latency.percentile(99) * 1000,
+                pool_stats.wait.mean() * 1000,
+                pool_stats.connects, pool_stats.peak_overflow)
+
+
+def get_cpu_time():
+    # User + system CPU time of this process, the client side of the test
+    times = os.times()
+    return times[0] + times[1]
+
+
+@common.timer
+def do_path_compare(connect_uri, **kwargs):
+    """Rerun the workload with every insert path and compare them"""
+
+    profile = common.get_profile(kwargs)
+    results = []
+    try:
+        for path in common.INSERT_PATHS:
+            path_kwargs = dict(kwargs, insert_path=path)
+            # Every path starts from the same empty table
+            do_clean_table(connect_uri, kwargs)
+            test_obj = common.new_test_obj(connect_uri, path_kwargs)
+            workload = common.new_workload(test_obj, profile,
+                                           kwargs["seed"])
+            stats = workloads.WorkloadStats()
+            cpu_time = get_cpu_time()
+            elapsed = workloads.run_threads(test_obj, workload, stats,
+                                            kwargs["thread_count"],
+                                            kwargs["total"],
+                                            kwargs["log_sample"])
+            cpu_time = get_cpu_time() - cpu_time
+            test_obj.dispose()
+            results.append((path, stats, elapsed, cpu_time))
+            print "Insert path %s done in %.2fs" % (path, elapsed)
+    except KeyboardInterrupt:
+        print "Quitting....."
+        sys.exit(0)
+    finally:
+        print "%s, %d threads, %d operations" % (
+            common.describe_workload(profile, kwargs),
+            kwargs["thread_count"], kwargs["total"])
+        # The client CPU time per operation is the overhead of the path,
+        # the rest of the latency is spent waiting for the server.
+        print "%-6s %10s %8s %10s %10s %12s %8s" % (
+            "path", "ops/s", "errors", "p50(ms)", "p99(ms)", "cpu/op(us)",
+            "cpu%")
+        for path, stats, elapsed, cpu_time in results:
+            latency = workloads.LatencyHistogram()
+            for histogram in stats.histograms.values():
+                latency.merge(histogram)
+            print "%-6s %10.1f %8d %10.3f %10.3f %12.1f %8.1f" % (
+                path, stats.total() / elapsed, sum(stats.errors.values()),
+                latency.percentile(50) * 1000,
+                latency.percentile(99) * 1000,
+                cpu_time * 1000000 / max(stats.total(), 1),
+                cpu_time * 100 / elapsed)
 
 
 def main():
     kwargs = parse_args()
-    connect_uri = DB_CONNECT_URI.get(kwargs.get("db_type")).format(**kwargs)
-    setup_logging()
+    connect_uri = common.get_connect_uri(kwargs)
+    common.setup_logging()
     if kwargs.get("clean_table") is False:
-        do_clean_table(connect_uri)
+        do_clean_table(connect_uri, kwargs)
         sys.exit(0)
 
-    do_stress_test(connect_uri, **kwargs)
+    if kwargs["pool_sweep"]:
+        do_pool_sweep(connect_uri, **kwargs)
+    elif kwargs["compare_paths"]:
+        do_path_compare(connect_uri, **kwargs)
+    else:
+        do_stress_test(connect_uri, **kwargs)
 
 
 if __name__ == "__main__":
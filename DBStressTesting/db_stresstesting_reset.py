@@ -0,0 +1,208 @@
+# Fast reset of the database stress testing table.
+#
+# Dropping and recreating the table after a big run is slow and loses the
+# indexes created for the run. The reset methods empty the table in place:
+#
+#    truncate  TRUNCATE TABLE (DELETE without WHERE on SQLite, which it
+#              runs as a truncate), the ids start over from 1
+#    delete    DELETE by id ranges of --reset-chunk rows, --reset-threads
+#              ranges at a time, for databases or permissions without
+#              TRUNCATE
+#    drop      DROP TABLE, the table is recreated by the next run
+#    auto      truncate, delete when the truncate fails (no privilege,
+#              referenced table ...)
+#
+# With --partitions the table is created hash partitioned on id
+# (PostgreSQL and MySQL) and reused by the next runs. A table left
+# unpartitioned by a run without --partitions has to be dropped first.
+# PostgreSQL partitions are truncated in parallel.
+#
+# Code is kept compatible with python2 and python3.
+
+import logging
+import threading
+
+from sqlalchemy import func, inspect, text
+from sqlalchemy.schema import CreateTable
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+RESET_METHODS = ("auto", "truncate", "delete", "drop")
+PARTITION_DIALECTS = ("mysql", "postgresql")
+
+
+def table_exists(bind, table):
+    return table.name in inspect(bind).get_table_names()
+
+
+def quote_table(bind, table):
+    return bind.dialect.identifier_preparer.format_table(table)
+
+
+def is_partitioned(engine, table):
+    """Tell whether the existing table is partitioned"""
+
+    if engine.dialect.name == "mysql":
+        query = ("SELECT COUNT(*) FROM information_schema.partitions "
+                 "WHERE table_schema = DATABASE() AND table_name = :name "
+                 "AND partition_name IS NOT NULL")
+    else:
+        query = ("SELECT COUNT(*) FROM pg_partitioned_table t "
+                 "JOIN pg_class c ON c.oid = t.partrelid "
+                 "WHERE c.relname = :name")
+    with engine.connect() as connection:
+        return connection.execute(text(query),
+                                  {"name": table.name}).scalar() > 0
+
+
+def create_partitioned_table(engine, table, partitions):
+    """Create table hash partitioned on id, unless it exists already
+
+    An existing table which is not partitioned raises ValueError, it has
+    to be dropped to be created partitioned.
+    """
+
+    dialect = engine.dialect.name
+    if dialect not in PARTITION_DIALECTS:
+        raise ValueError("Partitioned tables are not supported by %s, Such "
+                         "as [%s]" % (dialect, "|".join(PARTITION_DIALECTS)))
+    if table_exists(engine, table):
+        if not is_partitioned(engine, table):
+            raise ValueError("Table %s exists and is not partitioned, drop "
+                             "it with -C --reset-method drop to create it "
+                             "with --partitions" % table.name)
+        return False
+    create = str(CreateTable(table).compile(dialect=engine.dialect)).strip()
+    prepare = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        if dialect == "mysql":
+            connection.execute(text("%s PARTITION BY HASH (id) PARTITIONS %d"
+                                    % (create, partitions)))
+            return True
+        connection.execute(text("%s PARTITION BY HASH (id)" % create))
+        for num in range(partitions):
+            connection.execute(text(
+                "CREATE TABLE %s PARTITION OF %s FOR VALUES WITH "
+                "(MODULUS %d, REMAINDER %d)"
+                % (prepare.quote("%s_p%d" % (table.name, num)),
+                   quote_table(engine, table), partitions, num)))
+    return True
+
+
+def get_partitions(engine, table):
+    """Return the partition tables of a PostgreSQL partitioned table"""
+
+    if engine.dialect.name != "postgresql":
+        return []
+    with engine.connect() as connection:
+        rows = connection.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :name ORDER BY c.relname"),
+            {"name": table.name})
+        return [row[0] for row in rows]
+
+
+def run_parallel(engine, statements, threads):
+    """Execute statements over threads connections, one commit each"""
+
+    tasks = queue.Queue()
+    for statement in statements:
+        tasks.put(statement)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                statement = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                with engine.begin() as connection:
+                    connection.execute(statement)
+            except Exception as err:
+                logging.exception(">>> Reset statement failed: %s" % err)
+                errors.append(err)
+
+    workers = [threading.Thread(target=worker, name="Reset: %d" % num)
+               for num in range(min(threads, len(statements)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def truncate_statements(dialect, table):
+    """Return the SQL emptying a table which is not partitioned"""
+
+    name = dialect.identifier_preparer.format_table(table)
+    if dialect.name == "sqlite":
+        # No TRUNCATE, SQLite optimizes a DELETE without WHERE into one
+        return ["DELETE FROM %s" % name]
+    if dialect.name == "postgresql":
+        return ["TRUNCATE TABLE %s RESTART IDENTITY" % name]
+    return ["TRUNCATE TABLE %s" % name]
+
+
+def truncate_table(engine, table, threads=4):
+    partitions = get_partitions(engine, table)
+    if partitions:
+        prepare = engine.dialect.identifier_preparer
+        run_parallel(engine, [text("TRUNCATE TABLE %s"
+                                   % prepare.quote(partition))
+                              for partition in partitions], threads)
+        # The id sequence belongs to the parent table
+        statements = ["SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                      "1, false)" % quote_table(engine, table)
+                      .replace("'", "''")]
+    else:
+        statements = truncate_statements(engine.dialect, table)
+    with engine.begin() as connection:
+        for statement in statements:
+            connection.execute(text(statement))
+
+
+def delete_chunks(engine, table, threads=4, chunk=10000):
+    """Delete the rows by id ranges of chunk rows, over threads"""
+
+    with engine.connect() as connection:
+        low = connection.execute(func.min(table.c.id).select()).scalar()
+        high = connection.execute(func.max(table.c.id).select()).scalar()
+    if low is None:
+        return
+    statements = [table.delete().where(
+        table.c.id.between(start, min(start + chunk - 1, high)))
+        for start in range(low, high + 1, chunk)]
+    run_parallel(engine, statements, threads)
+
+
+def reset_table(engine, table, method="auto", threads=4, chunk=10000):
+    """Empty table with the reset method, return the method used"""
+
+    if method == "drop":
+        table.drop(engine, checkfirst=True)
+        return method
+    if not table_exists(engine, table):
+        return method
+    if method == "auto":
+        try:
+            truncate_table(engine, table, threads)
+            return "truncate"
+        except Exception as err:
+            logging.warning(">>> Truncate failed, deleting by chunks: %s"
+                            % err)
+            method = "delete"
+    if method == "truncate":
+        truncate_table(engine, table, threads)
+        return method
+    if method == "delete":
+        delete_chunks(engine, table, threads, chunk)
+        return method
+    raise ValueError("Unknown reset method %s, Such as [%s]"
+                     % (method, "|".join(RESET_METHODS)))
@@ -0,0 +1,646 @@
+# Workload profiles of the database stress testing scripts.
+#
+# A workload profile declares the operation mix of a run (point reads by
+# primary key, inserts, updates and range scans) and the distribution of
+# the keys the operations touch:
+#
+#    uniform  every existing row has the same chance to be picked
+#    zipfian  a few rows are hot, the others are rarely touched
+#    latest   like zipfian, but the hot rows are the newest inserted ones
+#
+# The bulk operation loads a batch of rows with the bulk method of the run
+# (ORM, executemany, multi-row VALUES or COPY).
+#
+# Every operation latency is recorded into a log-bucketed histogram which
+# can be merged between workers and printed as a report at the end.
+#
+# Code is kept compatible with python2 and python3.
+
+import bisect
+import itertools
+import logging
+import math
+import random
+import threading
+import time
+
+OPERATIONS = ("read", "insert", "update", "scan", "bulk")
+
+
+class UniformKeys(object):
+    """Pick every key in [1, max_key] with the same probability"""
+
+    def __init__(self, rand):
+        self.rand = rand
+
+    def next_key(self, max_key):
+        return self.rand.randint(1, max(max_key, 1))
+
+
+class ZipfianKeys(object):
+    """Pick keys in [1, max_key] following a zipfian distribution
+
+    The algorithm is the one of YCSB (Gray et al, "Quickly generating
+    billion-record synthetic databases"), the zeta constant is updated
+    incrementally when the key space grows with the inserts.
+    """
+
+    def __init__(self, rand, theta=0.99):
+        self.rand = rand
+        self.theta = theta
+        self.alpha = 1.0 / (1.0 - theta)
+        self.zeta2 = self._zeta(0, 2, 0.0)
+        self.count = 0
+        self.zetan = 0.0
+        self._lock = threading.Lock()
+
+    def _zeta(self, start, end, total):
+        for i in range(start, end):
+            total += 1.0 / math.pow(i + 1, self.theta)
+        return total
+
+    def next_rank(self, count):
+        count = max(count, 1)
+        with self._lock:
+            if count > self.count:
+                self.zetan = self._zeta(self.count, count, self.zetan)
+            elif count < self.count:
+                self.zetan = self._zeta(0, count, 0.0)
+            self.count = count
+            zetan = self.zetan
+
+        if count == 1:
+            return 0
+
+        u = self.rand.random()
+        uz = u * zetan
+        if uz < 1.0:
+            return 0
+        if count == 2 or uz < 1.0 + math.pow(0.5, self.theta):
+            return 1
+        eta = ((1 - math.pow(2.0 / count, 1 - self.theta)) /
+               (1 - self.zeta2 / zetan))
+        rank = int(count * math.pow(eta * u - eta + 1, self.alpha))
+        return min(rank, count - 1)
+
+    def next_key(self, max_key):
+        return self.next_rank(max_key) + 1
+
+
+class LatestKeys(ZipfianKeys):
+    """Pick keys in [1, max_key], the newest keys are the hottest"""
+
+    def next_key(self, max_key):
+        return max(max_key, 1) - self.next_rank(max_key)
+
+
+KEY_DISTRIBUTIONS = {"uniform": UniformKeys,
+                     "zipfian": ZipfianKeys,
+                     "latest": LatestKeys}
+
+
+class WorkloadProfile(object):
+    """Declare the operation mix and the key distribution of a run"""
+
+    def __init__(self, name, mix, distribution="uniform", scan_length=100):
+        unknown = set(mix) - set(OPERATIONS)
+        if unknown:
+            raise ValueError("Unknown workload operation %s"
+                             % ", ".join(sorted(unknown)))
+        if distribution not in KEY_DISTRIBUTIONS:
+            raise ValueError("Unknown key distribution %s" % distribution)
+        if sum(mix.values()) <= 0:
+            raise ValueError("Workload %s has no operation" % name)
+
+        self.name = name
+        self.mix = dict((op, weight) for op, weight in mix.items()
+                        if weight > 0)
+        self.distribution = distribution
+        self.scan_length = scan_length
+
+    @classmethod
+    def from_string(cls, spec, distribution="uniform", scan_length=100):
+        """Build a profile from a 'read=70,insert=20,update=10' string"""
+
+        mix = {}
+        for item in spec.split(","):
+            try:
+                op, weight = item.split("=")
+                mix[op.strip()] = float(weight)
+            except ValueError:
+                raise ValueError("Invalid workload operation %r" % item)
+        return cls(spec, mix, distribution, scan_length)
+
+    def __repr__(self):
+        mix = ",".join("%s=%g" % (op, self.mix[op])
+                       for op in OPERATIONS if op in self.mix)
+        return "<WorkloadProfile %s %s %s>" % (self.name, mix,
+                                               self.distribution)
+
+
+PROFILES = {
+    "insert": WorkloadProfile("insert", {"insert": 100}),
+    "mixed": WorkloadProfile("mixed", {"read": 70, "insert": 20,
+                                       "update": 10}, "zipfian"),
+    "read-heavy": WorkloadProfile("read-heavy", {"read": 95, "update": 5},
+                                  "zipfian"),
+    "update-heavy": WorkloadProfile("update-heavy", {"read": 50,
+                                                     "update": 50},
+                                    "zipfian"),
+    "read-latest": WorkloadProfile("read-latest", {"read": 95, "insert": 5},
+                                   "latest"),
+    "scan": WorkloadProfile("scan", {"scan": 95, "insert": 5}, "uniform"),
+    "bulk-load": WorkloadProfile("bulk-load", {"bulk": 100}),
+}
+
+
+def get_profile(name, distribution=None, scan_length=100):
+    """Get a profile by name or from an operation mix string"""
+
+    if name in PROFILES:
+        base = PROFILES[name]
+        return WorkloadProfile(base.name, base.mix,
+                               distribution or base.distribution,
+                               scan_length)
+    return WorkloadProfile.from_string(name, distribution or "uniform",
+                                       scan_length)
+
+
+class Workload(object):
+    """Generate the operations of a profile over a growing key space"""
+
+    def __init__(self, profile, max_key=0, seed=None):
+        self.profile = profile
+        self.max_key = max_key
+        self.rand = random.Random(seed)
+        self.keys = KEY_DISTRIBUTIONS[profile.distribution](self.rand)
+
+        self._ops = []
+        self._weights = []
+        total = 0
+        for op in OPERATIONS:
+            if op in profile.mix:
+                total += profile.mix[op]
+                self._ops.append(op)
+                self._weights.append(total)
+        self._total = total
+
+    def next_operation(self):
+        """Return the next (operation, key) tuple to execute"""
+
+        point = self.rand.random() * self._total
+        op = self._ops[bisect.bisect_right(self._weights, point)]
+        if op in ("insert", "bulk"):
+            return op, None
+        return op, self.keys.next_key(self.max_key)
+
+    def next_value(self):
+        return self.rand.randint(0, 2 ** 31 - 1)
+
+    def inserted(self, key):
+        if key is not None and key > self.max_key:
+            self.max_key = key
+
+    def inserted_rows(self, count):
+        # Bulk loads do not return their keys, ids are assumed contiguous
+        self.max_key += count
+
+
+def execute_operation(test_obj, workload, op, key):
+    """Execute one workload operation on a StressTestDB object
+
+    Return the number of rows the operation handled.
+    """
+
+    if op == "read":
+        test_obj.read_data(key)
+    elif op == "insert":
+        workload.inserted(test_obj.add_test_data(workload.next_value()))
+    elif op == "update":
+        test_obj.update_data(key, workload.next_value())
+    elif op == "scan":
+        return test_obj.scan_data(key, workload.profile.scan_length)
+    elif op == "bulk":
+        rows = test_obj.bulk_insert([workload.next_value() for _
+                                     in range(test_obj.batch_size)])
+        workload.inserted_rows(rows)
+        return rows
+    return 1
+
+
+class LatencyHistogram(object):
+    """Record latencies in log scaled buckets of 5% precision
+
+    Histograms are plain dicts of bucket -> count, so they can be merged
+    between threads, processes or hosts.
+    """
+
+    BASE = 1.05
+
+    def __init__(self, buckets=None):
+        self.buckets = dict(buckets or {})
+        self.count = sum(self.buckets.values())
+
+    def record(self, seconds):
+        micros = max(seconds * 1000000.0, 1.0)
+        bucket = int(math.log(micros) / math.log(self.BASE))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+
+    def _value(self, bucket):
+        # Upper bound of the bucket, in seconds
+        return math.pow(self.BASE, bucket + 1) / 1000000.0
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = max(int(math.ceil(self.count * percent / 100.0)), 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return self._value(bucket)
+        return self._value(max(self.buckets))
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return sum(self._value(bucket) * count for bucket, count
+                   in self.buckets.items()) / self.count
+
+    def diff(self, previous):
+        """Return the histogram of the latencies recorded since previous"""
+
+        buckets = dict(self.buckets)
+        if previous is not None:
+            for bucket, count in previous.buckets.items():
+                buckets[bucket] = buckets.get(bucket, 0) - count
+        return LatencyHistogram(dict((bucket, count) for bucket, count
+                                     in buckets.items() if count > 0))
+
+    def to_dict(self):
+        return dict((str(bucket), count)
+                    for bucket, count in self.buckets.items())
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(dict((int(bucket), count)
+                        for bucket, count in data.items()))
+
+
+class OperationCounters(object):
+    """Per operation histograms, error and row counts of one worker
+
+    A worker is the only writer of its counters, so recording takes no
+    lock.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.errors = {}
+        self.rows = {}
+
+    def record(self, op, seconds, error=False, rows=1):
+        if error:
+            self.errors[op] = self.errors.get(op, 0) + 1
+            return
+        histogram = self.histograms.get(op)
+        if histogram is None:
+            histogram = self.histograms[op] = LatencyHistogram()
+        histogram.record(seconds)
+        self.rows[op] = self.rows.get(op, 0) + rows
+
+    def merge(self, other):
+        # other may be the live counters of a running worker, dict() copies
+        # are atomic under the GIL.
+        for op, histogram in list(other.histograms.items()):
+            self.histograms.setdefault(op, LatencyHistogram()).merge(
+                LatencyHistogram(dict(histogram.buckets)))
+        for op, count in dict(other.errors).items():
+            self.errors[op] = self.errors.get(op, 0) + count
+        for op, count in dict(other.rows).items():
+            self.rows[op] = self.rows.get(op, 0) + count
+
+
+class WorkloadStats(object):
+    """Collect per operation latency histograms and error counts
+
+    Threads record into their own counters returned by worker(), they are
+    only summed up when the stats are read, so the workers never wait on
+    each other. record() on the stats itself is for single threaded event
+    loops (gevent, asyncio) and merged results.
+    """
+
+    def __init__(self):
+        self._base = OperationCounters()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def worker(self):
+        """Return new counters owned by the calling worker"""
+
+        counters = OperationCounters()
+        with self._lock:
+            self._workers.append(counters)
+        return counters
+
+    def record(self, op, seconds, error=False, rows=1):
+        self._base.record(op, seconds, error, rows)
+
+    def snapshot(self):
+        """Return the counters of all the workers summed up"""
+
+        counters = OperationCounters()
+        counters.merge(self._base)
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            counters.merge(worker)
+        return counters
+
+    @property
+    def histograms(self):
+        return self.snapshot().histograms
+
+    @property
+    def errors(self):
+        return self.snapshot().errors
+
+    @property
+    def rows(self):
+        return self.snapshot().rows
+
+    def merge(self, other):
+        self._base.merge(other.snapshot())
+
+    def copy(self):
+        """Return the stats recorded so far, frozen"""
+
+        stats = WorkloadStats()
+        stats.merge(self)
+        return stats
+
+    def total(self):
+        return sum(h.count for h in self.histograms.values())
+
+    def to_dict(self):
+        counters = self.snapshot()
+        return {"histograms": dict((op, h.to_dict()) for op, h
+                                   in counters.histograms.items()),
+                "errors": counters.errors,
+                "rows": counters.rows}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for op, buckets in data["histograms"].items():
+            stats._base.histograms[op] = LatencyHistogram.from_dict(buckets)
+        stats._base.errors.update(data["errors"])
+        stats._base.rows.update(data.get("rows", {}))
+        return stats
+
+    def diff(self, previous):
+        """Return the stats recorded since the previous stats were taken"""
+
+        current = self.snapshot()
+        before = previous.snapshot()
+        stats = WorkloadStats()
+        for op, histogram in current.histograms.items():
+            stats._base.histograms[op] = histogram.diff(
+                before.histograms.get(op))
+        for name in ("errors", "rows"):
+            counts = getattr(before, name)
+            getattr(stats._base, name).update(
+                (op, count - counts.get(op, 0))
+                for op, count in getattr(current, name).items())
+        return stats
+
+    def report(self, elapsed):
+        """Return the report lines of the run"""
+
+        counters = self.snapshot()
+        lines = ["%-8s %10s %8s %10s %10s %10s %10s %10s %10s"
+                 % ("op", "count", "errors", "ops/s", "rows/s", "avg(ms)",
+                    "p50(ms)", "p95(ms)", "p99(ms)")]
+        ops = [op for op in OPERATIONS
+               if op in counters.histograms or op in counters.errors]
+        for op in ops:
+            h = counters.histograms.get(op, LatencyHistogram())
+            rows = counters.rows.get(op, h.count)
+            lines.append("%-8s %10d %8d %10.1f %10.1f %10.3f %10.3f %10.3f "
+                         "%10.3f"
+                         % (op, h.count, counters.errors.get(op, 0),
+                            h.count / elapsed if elapsed else 0.0,
+                            rows / elapsed if elapsed else 0.0,
+                            h.mean() * 1000, h.percentile(50) * 1000,
+                            h.percentile(95) * 1000,
+                            h.percentile(99) * 1000))
+        return lines
+
+
+class PhaseController(object):
+    """Split a run into warmup, measurement and cooldown phases
+
+    The warmup lasts warmup seconds, or with steady_state until the
+    throughput of the last steady_windows windows of window seconds varies
+    less than max_cv (coefficient of variation), warmup seconds at most.
+    The measurement lasts duration seconds, or until the first worker runs
+    out of operations. The cooldown keeps the workers running cooldown
+    more seconds after a timed measurement, or is the tail of the run
+    while the other workers finish their last operations.
+
+    Only the operations of the measurement phase are kept in measured.
+    """
+
+    MAX_WARMUP = 60.0
+
+    def __init__(self, warmup=0.0, duration=None, cooldown=0.0,
+                 steady_state=False, window=1.0, max_cv=0.05,
+                 steady_windows=5):
+        self.warmup = warmup or (self.MAX_WARMUP if steady_state else 0.0)
+        self.duration = duration
+        self.cooldown = cooldown
+        self.steady_state = steady_state
+        self.window = window
+        self.max_cv = max_cv
+        self.steady_windows = steady_windows
+
+        self.phase = None
+        self.steady = False
+        self.warmup_elapsed = 0.0
+        self.measured = None
+        self.elapsed = 0.0
+        self._ending = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, stats):
+        self._thread = threading.Thread(target=self._run, name="Phases",
+                                        args=(stats,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stopped(self):
+        """True once the workers must stop, after a timed cooldown"""
+
+        return self._stop.is_set()
+
+    def worker_done(self):
+        self._ending.set()
+
+    def join(self):
+        self._ending.set()
+        self._thread.join()
+
+    def _set_phase(self, phase):
+        self.phase = phase
+        logging.info(">>> Phase %s" % phase)
+
+    def _run(self, stats):
+        start_time = time.time()
+        self._set_phase("warmup")
+        self._wait_warmup(stats, start_time)
+
+        self._set_phase("measure")
+        measure_time = time.time()
+        self.warmup_elapsed = measure_time - start_time
+        before = stats.copy()
+        self._ending.wait(self.duration)
+        self.elapsed = time.time() - measure_time
+        self.measured = stats.copy().diff(before)
+
+        self._set_phase("cooldown")
+        if self.duration is not None:
+            self._ending.wait(self.cooldown)
+            self._stop.set()
+
+    def _wait_warmup(self, stats, start_time):
+        deadline = start_time + self.warmup
+        if not self.steady_state:
+            self._ending.wait(max(deadline - time.time(), 0))
+            return
+        rates = []
+        previous = stats.copy()
+        previous_time = start_time
+        while time.time() < deadline and not self._ending.wait(self.window):
+            current, now = stats.copy(), time.time()
+            rates.append((current.total() - previous.total()) /
+                         max(now - previous_time, 1e-6))
+            previous, previous_time = current, now
+            if is_steady(rates[-self.steady_windows:], self.steady_windows,
+                         self.max_cv):
+                self.steady = True
+                return
+
+    def get_stats(self, stats, elapsed):
+        """Return the (stats, elapsed) to report
+
+        The measurement phase when it ran, the whole run when the run
+        ended during the warmup.
+        """
+
+        if self.measured is None or not self.measured.total():
+            return stats, elapsed
+        return self.measured, self.elapsed
+
+    def describe(self):
+        if self.measured is None or not self.measured.total():
+            return "Run ended during the warmup, reporting the whole run"
+        return ("Warmup %.1fs%s, measured %.1fs"
+                % (self.warmup_elapsed,
+                   " (steady state)" if self.steady else
+                   " (no steady state)" if self.steady_state else "",
+                   self.elapsed))
+
+
+def is_steady(rates, count, max_cv):
+    """True when the count last rates vary less than max_cv"""
+
+    if len(rates) < count:
+        return False
+    mean = sum(rates) / float(len(rates))
+    if not mean:
+        return False
+    deviation = math.sqrt(sum((rate - mean) ** 2 for rate in rates) /
+                          len(rates))
+    return deviation / mean <= max_cv
+
+
+def run_operation(test_obj, workload, stats):
+    """Pick, execute and time the next operation of the workload
+
+    stats is a WorkloadStats or the counters of the calling worker.
+    """
+
+    op, key = workload.next_operation()
+    start = time.time()
+    try:
+        rows = execute_operation(test_obj, workload, op, key)
+    except Exception:
+        stats.record(op, time.time() - start, error=True)
+        # A failed flush or a lost connection leaves the session in a
+        # failed transaction, every next operation would fail too.
+        test_obj.rollback()
+        raise
+    stats.record(op, time.time() - start, rows=rows)
+    return op, key
+
+
+def log_operation(num, op, key, log_sample):
+    """Log one operation out of log_sample, none when log_sample is 0"""
+
+    if log_sample and num % log_sample == 0:
+        logging.info(">>> Execute the %d %s operation on key %s..."
+                     % (num, op, key))
+
+
+def run_operations(test_obj, workload, stats, counter, total, log_sample=0,
+                   phases=None):
+    """Run operations until the shared counter reaches total"""
+
+    counters = stats.worker()
+    try:
+        for num in counter:
+            if num >= total or (phases and phases.stopped()):
+                break
+            try:
+                op, key = run_operation(test_obj, workload, counters)
+            except Exception as err:
+                logging.exception(">>> The %d operation failed: %s"
+                                  % (num, err))
+                continue
+            log_operation(num, op, key, log_sample)
+    finally:
+        if phases is not None:
+            phases.worker_done()
+        test_obj.close()
+
+
+def run_threads(test_obj, workload, stats, thread_count, total,
+                log_sample=0, phases=None):
+    """Run total operations over thread_count threads, return the elapsed"""
+
+    # itertools.count is atomic under the GIL, threads share it as
+    # operation number dispenser.
+    counter = itertools.count()
+    threads = []
+    start_time = time.time()
+    if phases is not None:
+        phases.start(stats)
+    for thread_num in range(thread_count):
+        thread = threading.Thread(target=run_operations,
+                                  name=("Thread: %s" % thread_num),
+                                  args=(test_obj, workload, stats,
+                                        counter, total, log_sample, phases))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if phases is not None:
+        phases.join()
+    return time.time() - start_time
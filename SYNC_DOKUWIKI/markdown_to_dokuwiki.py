@@ -0,0 +1,477 @@
+"""
+Convert the Markdown of SmartWiki documents into DokuWiki syntax.
+
+The conversion is one pass over the lines of a document, every line is
+looked at once and the inline markup of a line is tokenized once, so the
+time grows linearly with the size of the document:
+
+    # Heading             ====== Heading ======
+    * item / 1. item      "  * item" / "  - item", nested by indentation
+    | a | b | tables      ^ a ^ b ^ header and | c | d | rows, aligned
+    ```lang code          <code lang> ... </code>
+    **bold** *italic*     **bold** //italic//
+    `code` ~~deleted~~    ''%%code%%'' <del>deleted</del>
+    [text](url)           [[url|text]]
+    ![alt](src)           {{src|alt}}
+
+The DokuWiki markup which is text in Markdown, such as //not italic// or
+an unclosed **, is kept literal in %%...%%.
+
+Run it as a script to measure the throughput on large documents:
+
+    python markdown_to_dokuwiki.py [--size 1048576] [--count 5] [file ...]
+"""
+
+from __future__ import print_function
+
+import io
+import optparse
+import re
+import time
+
+# Part of the render cache key, bump it when the output changes
+CONVERTER_VERSION = 4
+
+FENCE_RE = re.compile(r'^\s*(`{3,}|~{3,})\s*([\w+#.-]*)')
+HEADING_RE = re.compile(r'^ {0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$')
+SETEXT_RE = re.compile(r'^ {0,3}(=+|-+)\s*$')
+RULE_RE = re.compile(r'^ {0,3}([-*_])(?:\s*\1){2,}\s*$')
+LIST_RE = re.compile(r'^(\s*)([-*+]|\d+[.)])\s+(.*)$')
+QUOTE_RE = re.compile(r'^\s*((?:>\s?)+)(.*)$')
+TABLE_SEPARATOR_RE = re.compile(
+    r'^\s*\|?\s*:?-+:?\s*(?:\|\s*:?-+:?\s*)*\|?\s*$')
+CELL_SPLIT_RE = re.compile(r'(?<!\\)\|')
+
+# The code spans and links are only opened here, their closing is looked
+# up by _CodeSpans and _Links
+INLINE_RE = re.compile(r'''
+    (?P<code>`+)
+  | (?P<image>!\[)
+  | (?P<link>\[)
+  | <(?P<autolink>(?:https?|ftp)://[^<>\s]+)>
+  | (?P<strong>\*\*|__)
+  | (?P<em>\*|_)
+  | (?P<strike>~~)
+''', re.VERBOSE)
+BACKTICKS_RE = re.compile(r'`+')
+CLOSE_BRACKET_RE = re.compile(r'\]')
+URL_END_RE = re.compile(r'[\s)]')
+TITLE_RE = re.compile(r'\s+"[^"]*"\)')
+
+# DokuWiki markup, the // of an URL such as http:// is not italic
+DOKU_MARKUP_RE = re.compile(
+    r"(?<!:)//|\*\*|__|''|~~|\[\[|\]\]|\{\{|\}\}|\(\(|\)\)|\\\\|%%")
+
+# A line starting with them is a table row in DokuWiki
+TABLE_MARKS = ('^', '|')
+
+MARKERS = {'strong': ('**', '**'),
+           'em': ('//', '//'),
+           'strike': ('<del>', '</del>')}
+
+
+def _escape_markup(match):
+    markup = match.group()
+    if markup == '%%':
+        return '<nowiki>%%</nowiki>'
+    return '%%' + markup + '%%'
+
+
+def escape(text):
+    """Keep the DokuWiki markup of a text literal."""
+
+    return DOKU_MARKUP_RE.sub(_escape_markup, text)
+
+
+def nowiki(text):
+    """Keep a whole text literal, the %% inside it included."""
+
+    return '<nowiki>%%</nowiki>'.join('%%' + part + '%%' if part else ''
+                                      for part in text.split('%%'))
+
+
+class _CodeSpans(object):
+    """The code spans of a line.
+
+    A run of backticks opens a code span closed by the next run of the same
+    length, the runs are listed once for the whole line.
+    """
+
+    def __init__(self, text):
+        self.closing = {}
+        following = {}
+        for match in reversed(list(BACKTICKS_RE.finditer(text))):
+            length = len(match.group())
+            if length in following:
+                self.closing[match.start()] = following[length]
+            following[length] = match.span()
+
+    def match(self, start):
+        """Return the (start, end) of the run closing the run at start."""
+
+        return self.closing.get(start)
+
+
+class _Lookahead(object):
+    """The next match of a pattern from increasing positions of a text.
+
+    The text is only searched again when the previous match is behind the
+    position, so it is scanned once whatever the number of lookups.
+    """
+
+    def __init__(self, pattern, text):
+        self.pattern = pattern
+        self.text = text
+        self.found = -1
+
+    def find(self, pos):
+        if self.found < pos:
+            match = self.pattern.search(self.text, pos)
+            self.found = match.start() if match else len(self.text)
+        return self.found
+
+
+class _Links(object):
+    """The [text](url "title") links of a line.
+
+    The closing ] and the end of the url are looked up from the previous
+    lookup and the tails are parsed once, so the unclosed [ or ]( of a
+    line do not rescan it to its end.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.brackets = _Lookahead(CLOSE_BRACKET_RE, text)
+        self.url_ends = _Lookahead(URL_END_RE, text)
+        self.tails = {}
+        self.titles = {}
+
+    def match(self, start):
+        """Return (text, url, end) of the link opened by the [ at start."""
+
+        close = self.brackets.find(start + 1)
+        if close not in self.tails:
+            self.tails[close] = self._tail(close)
+        tail = self.tails[close]
+        if tail is None:
+            return None
+        return (self.text[start + 1:close],) + tail
+
+    def _tail(self, close):
+        if self.text[close + 1:close + 2] != '(':
+            return None
+        url_end = self.url_ends.find(close + 2)
+        if url_end == len(self.text):
+            return None
+        url = self.text[close + 2:url_end]
+        if self.text[url_end] == ')':
+            return url, url_end + 1
+        if url_end not in self.titles:
+            match = TITLE_RE.match(self.text, url_end)
+            self.titles[url_end] = match.end() if match else None
+        if self.titles[url_end] is None:
+            return None
+        return url, self.titles[url_end]
+
+
+def convert_inline(text):
+    """Convert the inline markup of one line.
+
+    The emphasis delimiters are matched with a stack: an opening delimiter
+    is kept as a placeholder in the output and turned into markup when its
+    closing delimiter comes, the unmatched ones stay literal. The text
+    between the markup is escaped.
+    """
+
+    out = []
+    # (delimiter, kind, index of the placeholder in out)
+    stack = []
+    # delimiter: the positions in stack of its open delimiters
+    opened = {}
+    code_spans = None
+    links = None
+    pos = scan = 0
+    while True:
+        match = INLINE_RE.search(text, scan)
+        if not match:
+            break
+        start, scan = match.span()
+        kind = match.lastgroup
+        if kind == 'code':
+            if code_spans is None:
+                code_spans = _CodeSpans(text)
+            closing = code_spans.match(start)
+            if closing is None:
+                # The backticks stay literal
+                continue
+            out.append(escape(text[pos:start]))
+            pos = scan = closing[1]
+            out.append("''" + nowiki(text[match.end():closing[0]].strip()) +
+                       "''")
+            continue
+        if kind in ('image', 'link'):
+            if links is None:
+                links = _Links(text)
+            bracket = start + 1 if kind == 'image' else start
+            link = links.match(bracket)
+            if link is None:
+                # The brackets stay literal
+                continue
+            label, url, end = link
+            out.append(escape(text[pos:start]))
+            pos = scan = end
+            if kind == 'image':
+                out.append('{{%s%s}}' % (url, '|' + label if label else ''))
+            else:
+                label = convert_inline(label)
+                out.append('[[%s%s]]' % (url, '|' + label if label else ''))
+            continue
+        out.append(escape(text[pos:start]))
+        pos = scan
+        if kind == 'autolink':
+            out.append('[[%s]]' % match.group('autolink'))
+        else:
+            delimiter = match.group(kind)
+            before = text[match.start() - 1] if match.start() else ' '
+            after = text[pos] if pos < len(text) else ' '
+            # snake_case_names are not emphasis
+            if delimiter[0] == '_' and before.isalnum() and after.isalnum():
+                out.append(escape(delimiter))
+                continue
+            if opened.get(delimiter) and not before.isspace():
+                # The delimiters opened inside stay literal
+                while True:
+                    item = stack.pop()
+                    opened[item[0]].pop()
+                    if item[0] == delimiter:
+                        break
+                    out[item[2]] = escape(item[0])
+                _, kind, index = item
+                out[index] = MARKERS[kind][0]
+                out.append(MARKERS[kind][1])
+            elif not after.isspace():
+                opened.setdefault(delimiter, []).append(len(stack))
+                stack.append((delimiter, kind, len(out)))
+                out.append(delimiter)
+            else:
+                out.append(escape(delimiter))
+    out.append(escape(text[pos:]))
+    for delimiter, _, index in stack:
+        out[index] = escape(delimiter)
+    return ''.join(out)
+
+
+def _split_cells(line):
+    line = line.strip()
+    if line.startswith('|'):
+        line = line[1:]
+    if line.endswith('|') and not line.endswith('\\|'):
+        line = line[:-1]
+    return [cell.strip().replace('\\|', '|')
+            for cell in CELL_SPLIT_RE.split(line)]
+
+
+def _alignments(separator):
+    aligns = []
+    for cell in _split_cells(separator):
+        left, right = cell.startswith(':'), cell.endswith(':')
+        aligns.append('center' if left and right else
+                      'right' if right else 'left' if left else None)
+    return aligns
+
+
+def _table_row(cells, aligns, mark):
+    out = []
+    for num, cell in enumerate(cells):
+        align = aligns[num] if num < len(aligns) else None
+        cell = convert_inline(cell)
+        # DokuWiki aligns a cell by the spaces around its text
+        if align == 'right':
+            cell = '  %s ' % cell
+        elif align == 'center':
+            cell = '  %s  ' % cell
+        elif align == 'left':
+            cell = ' %s  ' % cell
+        else:
+            cell = ' %s ' % cell
+        out.append(mark + cell)
+    return ''.join(out) + mark
+
+
+def convert(markdown):
+    """Convert a Markdown document into DokuWiki syntax."""
+
+    lines = markdown.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    out = []
+    fence = None
+    aligns = None
+    indents = []
+    num = 0
+    while num < len(lines):
+        line = lines[num]
+        next_line = lines[num + 1] if num + 1 < len(lines) else ''
+        num += 1
+
+        if fence is not None:
+            if line.strip().startswith(fence):
+                out.append('</code>')
+                fence = None
+            else:
+                out.append(line)
+            continue
+        match = FENCE_RE.match(line)
+        if match:
+            fence = match.group(1)
+            lang = match.group(2)
+            out.append('<code %s>' % lang if lang else '<code>')
+            continue
+
+        if not line.strip():
+            aligns = None
+            indents = []
+            out.append('')
+            continue
+
+        if aligns is not None:
+            if '|' in line:
+                out.append(_table_row(_split_cells(line), aligns, '|'))
+                continue
+            aligns = None
+        if '|' in line and TABLE_SEPARATOR_RE.match(next_line) and \
+                '-' in next_line:
+            aligns = _alignments(next_line)
+            out.append(_table_row(_split_cells(line), aligns, '^'))
+            num += 1
+            continue
+
+        match = LIST_RE.match(line)
+        if match and not RULE_RE.match(line):
+            indent = len(match.group(1).expandtabs(4))
+            while indents and indent < indents[-1]:
+                indents.pop()
+            if not indents or indent > indents[-1]:
+                indents.append(indent)
+            bullet = '-' if match.group(2)[0].isdigit() else '*'
+            out.append('  ' * len(indents) + bullet + ' ' +
+                       convert_inline(match.group(3).strip()))
+            continue
+        if indents:
+            if line[0].isspace():
+                # DokuWiki list items are one line, join the continuation
+                out[-1] += ' ' + convert_inline(line.strip())
+                continue
+            indents = []
+
+        if line.startswith('    ') or line.startswith('\t'):
+            # Two leading spaces are preformatted text in DokuWiki
+            out.append(line)
+            continue
+
+        match = HEADING_RE.match(line)
+        if match:
+            marks = '=' * max(7 - len(match.group(1)), 2)
+            out.append('%s %s %s' % (marks, match.group(2), marks))
+            continue
+        if RULE_RE.match(line):
+            out.append('----')
+            continue
+        match = SETEXT_RE.match(next_line)
+        if match and next_line.strip():
+            marks = '======' if match.group(1)[0] == '=' else '====='
+            out.append('%s %s %s' % (marks, line.strip(), marks))
+            num += 1
+            continue
+
+        match = QUOTE_RE.match(line)
+        if match:
+            out.append(match.group(1).replace(' ', '') + ' ' +
+                       convert_inline(match.group(2).strip()))
+            continue
+
+        text = convert_inline(line.strip())
+        if text.startswith(TABLE_MARKS):
+            text = '%%' + text[0] + '%%' + text[1:]
+        if line.endswith('  '):
+            text += ' \\\\'
+        out.append(text)
+
+    if fence is not None:
+        out.append('</code>')
+    return '\n'.join(out)
+
+
+SAMPLE = u"""# Install guide
+
+Setup of the **server** on *Linux*, see [the docs](http://example.com/docs)
+and `config_file.yml` for the options of snake_case_names.
+
+## Steps
+
+1. Download the package
+2. Install it
+   * with `pip`
+   * or from the sources
+3. Run ~~the old~~ the new service
+
+| Option | Default | Description |
+|:-------|:-------:|------------:|
+| port   | 8080    | The **port** to listen on |
+| debug  | false   | Verbose logs |
+
+```python
+def main():
+    print("hello")
+```
+
+> A note about the ![logo](logo.png) and <http://example.com>.
+
+---
+
+"""
+
+
+def benchmark(markdowns):
+    """Convert the documents, return (seconds, characters)."""
+
+    start = time.time()
+    size = 0
+    for markdown in markdowns:
+        size += len(markdown)
+        convert(markdown)
+    return time.time() - start, size
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [--size BYTES] [--count N] [file ...]')
+    parser.add_option('-s', '--size', type='int', dest='size',
+                      default=1024 * 1024,
+                      help='Size of the generated documents, default is '
+                           '1 MB.')
+    parser.add_option('-c', '--count', type='int', dest='count', default=5,
+                      help='Number of generated documents, default is 5.')
+    options, files = parser.parse_args()
+
+    if files:
+        corpora = [('%d files' % len(files),
+                    [io.open(path, encoding='utf8').read()
+                     for path in files])]
+    else:
+        # Doubling sizes, the time per MB stays flat when it is linear
+        corpora = []
+        for factor in (1, 2, 4):
+            size = options.size * factor
+            doc = SAMPLE * (size // len(SAMPLE) + 1)
+            corpora.append(('%d x %d KB' % (options.count, size // 1024),
+                            [doc[:size]] * options.count))
+    print('%-20s %10s %10s %10s' % ('corpus', 'seconds', 'MB/s', 'docs/s'))
+    for name, markdowns in corpora:
+        seconds, size = benchmark(markdowns)
+        seconds = max(seconds, 1e-6)
+        print('%-20s %10.3f %10.2f %10.1f'
+              % (name, seconds, size / 1048576.0 / seconds,
+                 len(markdowns) / seconds))
+
+
+if __name__ == '__main__':
+    main()
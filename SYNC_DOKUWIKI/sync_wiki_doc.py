@@ -1,24 +1,161 @@
 """
 Script for sync SmartWiki Documents into DokuWiki.
+
+The pages follow the tree of the documents: every project is a
+namespace, every document with children is a namespace of its parent
+namespace too, such as project_1/install/linux.txt. The tree is built in
+memory from one pass over the doc_id and parent_id columns. Every
+namespace gets a start page listing its pages by doc_sort, every project
+a sidebar of its whole tree.
+
+The sync is incremental: a SQLite manifest maps every document to its
+page file, the md5 of the page and its version, and keeps the highest
+version synced. The next run only queries the documents changed since
+then, skips the pages whose md5 did not change, moves the pages whose
+path changed with the tree and removes the pages of the deleted
+documents. Only the start pages and sidebars of the namespaces changed
+are rendered again. Use --full to check every document and page again.
+
+Sibling documents whose names clean to the same page name get it by
+doc_id: the lowest doc_id gets name, the others name_<doc_id>, or
+name_<doc_id>_2 and so on when a sibling is named so.
+
+The documents are streamed: the ids and names come from a server side
+cursor and the contents are fetched --batch-size documents at a time, the
+pages are written as the rows arrive, so the memory used does not grow
+with the size of the wiki.
+
+A page is written to a temporary file which is renamed over the old page,
+DokuWiki never serves a half written page. Its owner and mode are set in
+process, only when the script may not chown, the pages are given to
+the wiki user by one sudo chown per batch at the end.
+
+The pages are rendered and written by a pool of --workers threads, which
+hides the latency of every file operation on network filesystems.
+
+The Markdown of the documents is converted to DokuWiki syntax by
+markdown_to_dokuwiki. The conversions are cached in the manifest by the
+md5 of their Markdown, a document moved or synced again with the same
+content is not converted again. A new CONVERTER_VERSION syncs every
+document again.
+
+With --daemon the script keeps running: every --interval seconds it
+polls the count and the newest version of the documents, one aggregate
+query, and syncs only when they changed. A burst of
+edits is synced once, after --debounce seconds without new changes but
+at the latest --max-delay seconds after the first one. The polls and
+syncs share the pooled engine. The sync lag, from the newest edit to its
+page written, and the throughput are logged after every sync and written
+to --metrics-prom in the Prometheus text format.
+
+The DokuWiki search index of the pages written or removed is updated
+right after the sync, so the first searches do not wait for DokuWiki to
+index the pages lazily on their views. DokuWiki indexes them itself: one
+php process per --index-batch pages runs idx_addPage on them, as the
+wiki user. --no-search-index leaves the indexing to DokuWiki.
+
+The images and attachments a document links from the SmartWiki uploads
+are synced into the DokuWiki media and the links point to them, such as
+/uploads/2017/01/logo.png to smartwiki:2017:01:logo.png. The media are
+stored by content: every distinct content is copied once into a store,
+in chunks, as data/media_store/<md5[:2]>/<md5>, and the media files are
+hardlinks of the store, copies when the filesystem cannot link. The
+manifest keeps the size, mtime and md5 of every upload synced, an upload
+which did not change is skipped without reading it. The media no
+document links any more are removed. --no-media leaves the links as
+they are.
 """
 
+from datetime import datetime, timedelta
+import errno
+import grp
+import hashlib
 import logging
 import os
 import optparse
+import posixpath
+import pwd
+import Queue
+import re
+import signal
+import sqlite3
+import subprocess
 import sys
-from urllib import quote
+import tempfile
+import threading
+import time
+import unicodedata
+from urllib import quote, unquote
+import zlib
 
 from sqlalchemy import BIGINT, create_engine, Column, DateTime, Integer, String
-from sqlalchemy import Text, TIMESTAMP
+from sqlalchemy import func, select, Text, TIMESTAMP
 from sqlalchemy.ext import declarative
 from sqlalchemy.orm import sessionmaker
 
+import markdown_to_dokuwiki
+
 reload(sys)
 sys.setdefaultencoding("utf-8")
 
 SQLALCHEMY_DATABASE_URI = ('mysql+pymysql://smartwiki:'
                            'smartwiki@<mysql_server_ipaddr>:3306/smartwiki?charset=utf8')
 SMARTWIKI_SERVER_IPADDR = '<smartwiki_server_ipaddr>'
+DOKU_PATH = '/var/www/dokuwiki'
+DOKU_PAGES_PATH = DOKU_PATH + '/data/pages'
+DOKU_MEDIA_PATH = DOKU_PATH + '/data/media'
+MEDIA_STORE_PATH = DOKU_PATH + '/data/media_store'
+MEDIA_NAMESPACE = 'smartwiki'
+SMARTWIKI_UPLOADS_PATH = '/var/www/smartwiki/public/uploads'
+UPLOADS_URL = '/uploads/'
+COPY_CHUNK = 1024 * 1024
+MANIFEST_FILE = 'sync_sw_2_dw.manifest'
+# Documents committed late may carry a version a bit older than the
+# watermark, look back that far again, the unchanged pages are skipped.
+WATERMARK_OVERLAP = 60
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S'
+BATCH_SIZE = 500
+PAGE_OWNER = 'www-data:www-data'
+PAGE_MODE = 0o644
+DIR_MODE = 0o755
+CHOWN_BATCH = 500
+WORKERS = 4
+POLL_INTERVAL = 5
+DEBOUNCE = 2
+MAX_DELAY = 30
+# Connections idle longer are replaced, before the server drops them
+POOL_RECYCLE = 3600
+# The specials of the ASCII and latin-1 characters in the ids of
+# DokuWiki, beyond them its specials are the punctuation, symbols and
+# spaces. A : or ; is no namespace in a name.
+ID_SPECIAL_RE = re.compile(u'[\\x00-\\x20!"#$%&\'()*+,/:;<=>?@\\[\\\\\\]^`{|}~'
+                           u'\\x7f-\\xbf\\xd7\\xf7]')
+# The letters DokuWiki deaccents to other than their letter without accents
+LOWER_ACCENTS = {u'\xe4': u'ae', u'\xf6': u'oe', u'\xfc': u'ue',
+                 u'\xdf': u'ss', u'\xe6': u'ae', u'\u0153': u'oe',
+                 u'\xfe': u'th', u'\xf0': u'dh', u'\xf8': u'o',
+                 u'\u0111': u'd', u'\u0127': u'h', u'\u0142': u'l',
+                 u'\u0167': u't', u'\u0192': u'f', u'\xb5': u'u'}
+# Part of the converter version of the manifest, bump it when clean_id
+# names the pages otherwise
+CLEAN_ID_VERSION = 2
+INDEX_PAGE = 'start'
+SIDEBAR_PAGE = 'sidebar'
+PROJECT_NAMESPACE = 'project_%d'
+INDEX_BATCH = 1000
+# Run by php -r with the DokuWiki directory as argument and the page ids
+# on stdin, a removed page is dropped from the index
+INDEXER_PHP = r"""
+define('DOKU_INC', $argv[1] . '/');
+define('NOSESSION', 1);
+require_once DOKU_INC . 'inc/init.php';
+while (($id = fgets(STDIN)) !== false) {
+    $id = trim($id);
+    if ($id !== '' && idx_addPage($id, false, true) !== true) {
+        fwrite(STDERR, "Failed to index $id\n");
+    }
+}
+"""
 _ENGINE = None
 _SESSION_MAKER = None
 
@@ -50,7 +187,9 @@ def _get_engine():
         logging.debug("SQLAlchemy engine %s exist.", _ENGINE)
         return _ENGINE
     logging.debug("Create new SQLAlchemy engine.")
-    _ENGINE = create_engine(SQLALCHEMY_DATABASE_URI)
+    # The daemon keeps the engine for days, check the pooled connections
+    _ENGINE = create_engine(SQLALCHEMY_DATABASE_URI, pool_pre_ping=True,
+                            pool_recycle=POOL_RECYCLE)
     return _ENGINE
 
 
@@ -76,41 +215,1299 @@ def get_session():
     return session
 
 
-def sw_to_dw(session=None):
-    """Sync the smartwiki document to dokuwiki."""
+class Manifest(object):
+    """Map the synced documents to their pages, kept in a SQLite file.
+
+    A row per document: its page file name, the page name the file name
+    derives from, the md5 of the page (None until the page is written, ''
+    for an empty document without page), the version synced and the key
+    of its conversion in the renders table. The start pages and sidebars
+    have a row of their md5 in the indexes table.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                doc_id INTEGER PRIMARY KEY,
+                file_name TEXT,
+                base_name TEXT,
+                digest TEXT,
+                version TEXT,
+                source_digest TEXT);
+            CREATE INDEX IF NOT EXISTS pages_file_name ON pages (file_name);
+            CREATE TABLE IF NOT EXISTS indexes (
+                file_name TEXT PRIMARY KEY,
+                digest TEXT);
+            CREATE TABLE IF NOT EXISTS renders (
+                source_digest TEXT PRIMARY KEY,
+                body BLOB);
+            CREATE TABLE IF NOT EXISTS media (
+                upload TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                digest TEXT,
+                file_name TEXT);
+            CREATE INDEX IF NOT EXISTS media_digest ON media (digest);
+            CREATE TABLE IF NOT EXISTS media_refs (
+                doc_id INTEGER,
+                upload TEXT,
+                PRIMARY KEY (doc_id, upload));
+            CREATE INDEX IF NOT EXISTS media_refs_upload
+                ON media_refs (upload);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT);
+        """)
+        columns = [row[1] for row
+                   in self._conn.execute("PRAGMA table_info(pages)")]
+        if 'source_digest' not in columns:
+            # Manifest of a version without the render cache
+            self._conn.execute("ALTER TABLE pages "
+                               "ADD COLUMN source_digest TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pages_source_digest "
+                           "ON pages (source_digest)")
+
+    def get_watermark(self):
+        """Get the version of the last synced document, None if none."""
+
+        row = self._conn.execute("SELECT value FROM meta "
+                                 "WHERE key = 'watermark'").fetchone()
+        if row is None:
+            return None
+        return datetime.strptime(row[0], WATERMARK_FORMAT)
+
+    def set_watermark(self, watermark):
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES "
+                           "('watermark', ?)",
+                           (watermark.strftime(WATERMARK_FORMAT),))
+
+    def get_meta(self, key):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?",
+                                 (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                           (key, value))
+
+    def count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def get(self, doc_id):
+        """Get the (file_name, base_name, digest) of a document."""
+
+        return self._conn.execute("SELECT file_name, base_name, digest "
+                                  "FROM pages WHERE doc_id = ?",
+                                  (doc_id,)).fetchone()
+
+    def holder(self, file_name):
+        """Get the lowest doc_id with a page written to file_name."""
+
+        row = self._conn.execute("SELECT MIN(doc_id) FROM pages "
+                                 "WHERE file_name = ? AND "
+                                 "(digest IS NULL OR digest <> '')",
+                                 (file_name,)).fetchone()
+        return row[0]
+
+    def update(self, doc_id, file_name, base_name, version, digest=None,
+               source_digest=None):
+        self._conn.execute("INSERT OR REPLACE INTO pages (doc_id, file_name, "
+                           "base_name, digest, version, source_digest) "
+                           "VALUES (?, ?, ?, ?, ?, ?)",
+                           (doc_id, file_name, base_name, digest,
+                            version.strftime(WATERMARK_FORMAT),
+                            source_digest))
+
+    def set_digest(self, doc_id, file_name, digest):
+        # A document moved again meanwhile keeps its pending digest
+        self._conn.execute("UPDATE pages SET digest = ? "
+                           "WHERE doc_id = ? AND file_name = ?",
+                           (digest, doc_id, file_name))
+
+    def page_ids(self):
+        """Get the documents with a page, written or pending."""
+
+        return set(row[0] for row in self._conn.execute(
+            "SELECT doc_id FROM pages "
+            "WHERE digest IS NULL OR digest <> ''"))
+
+    def pending_ids(self):
+        """Get the documents whose page was never written."""
+
+        return [row[0] for row in self._conn.execute(
+            "SELECT doc_id FROM pages "
+            "WHERE file_name IS NOT NULL AND digest IS NULL")]
+
+    def files(self):
+        """Iterate over the (doc_id, file_name, digest) of the documents."""
+
+        return self._conn.execute("SELECT doc_id, file_name, digest "
+                                  "FROM pages")
+
+    def index_digest(self, file_name):
+        row = self._conn.execute("SELECT digest FROM indexes "
+                                 "WHERE file_name = ?",
+                                 (file_name,)).fetchone()
+        return row[0] if row else None
+
+    def set_index(self, file_name, digest):
+        self._conn.execute("INSERT OR REPLACE INTO indexes VALUES (?, ?)",
+                           (file_name, digest))
+
+    def remove_index(self, file_name):
+        """Forget an index page, return whether it was written."""
+
+        cursor = self._conn.execute("DELETE FROM indexes "
+                                    "WHERE file_name = ?", (file_name,))
+        return cursor.rowcount > 0
+
+    def get_render(self, source_digest):
+        """Get the cached conversion of a Markdown as utf8, None if none."""
+
+        row = self._conn.execute("SELECT body FROM renders "
+                                 "WHERE source_digest = ?",
+                                 (source_digest,)).fetchone()
+        return zlib.decompress(bytes(row[0])) if row else None
+
+    def set_render(self, source_digest, body):
+        self._conn.execute("INSERT OR REPLACE INTO renders VALUES (?, ?)",
+                           (source_digest,
+                            sqlite3.Binary(zlib.compress(body))))
+
+    def prune_renders(self):
+        """Forget the conversions no document uses, return how many."""
+
+        cursor = self._conn.execute("DELETE FROM renders "
+                                    "WHERE source_digest NOT IN ("
+                                    "SELECT source_digest FROM pages "
+                                    "WHERE source_digest IS NOT NULL)")
+        return cursor.rowcount
+
+    def remove(self, doc_id):
+        """Forget a document, return the file name of its page if any."""
+
+        row = self.get(doc_id)
+        self._conn.execute("DELETE FROM pages WHERE doc_id = ?", (doc_id,))
+        self.set_media_refs(doc_id, [])
+        return row[0] if row and row[2] != '' else None
+
+    def set_media_refs(self, doc_id, uploads):
+        """Set the uploads a document links."""
+
+        self._conn.execute("DELETE FROM media_refs WHERE doc_id = ?",
+                           (doc_id,))
+        self._conn.executemany("INSERT OR IGNORE INTO media_refs "
+                               "VALUES (?, ?)",
+                               [(doc_id, upload) for upload in uploads])
+
+    def get_media(self, upload):
+        """Get the (size, mtime, digest, file_name) of an upload synced."""
+
+        return self._conn.execute("SELECT size, mtime, digest, file_name "
+                                  "FROM media WHERE upload = ?",
+                                  (upload,)).fetchone()
+
+    def set_media(self, upload, size, mtime, digest, file_name):
+        self._conn.execute("INSERT OR REPLACE INTO media VALUES "
+                           "(?, ?, ?, ?, ?)",
+                           (upload, size, mtime, digest, file_name))
+
+    def unused_media(self):
+        """Get the (upload, digest, file_name) no document links."""
+
+        return self._conn.execute(
+            "SELECT upload, digest, file_name FROM media "
+            "WHERE upload NOT IN (SELECT upload FROM media_refs)").fetchall()
+
+    def remove_media(self, upload):
+        self._conn.execute("DELETE FROM media WHERE upload = ?", (upload,))
+
+    def media_used(self, column, value):
+        """Tell whether a media row has value in column."""
+
+        assert column in ('digest', 'file_name')
+        return self._conn.execute("SELECT 1 FROM media WHERE %s = ? LIMIT 1"
+                                  % column, (value,)).fetchone() is not None
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def _id_char(char):
+    if char in LOWER_ACCENTS:
+        return LOWER_ACCENTS[char]
+    letter = unicodedata.normalize('NFD', char)
+    if letter[0] < u'\x80' and letter[0].isalpha():
+        return letter[0]
+    if ID_SPECIAL_RE.match(char) or (
+            char > u'\xff' and unicodedata.category(char)[0] in 'CPSZ'):
+        return u'_'
+    return char
+
+
+def clean_id(name):
+    """Clean a document name into a dokuwiki page name.
+
+    As the cleanID of DokuWiki with its default deaccent: the accents of
+    the latin letters are dropped, the specials become _ and the name is
+    trimmed of its . _ and -.
+    """
+
+    name = u''.join(_id_char(char) for char in name.strip().lower())
+    return re.sub(r'_+', '_', name).strip('._-') or 'untitled'
+
+
+class DocTree(object):
+    """The tree of the documents, from their parent_id.
+
+    A namespace is keyed by the doc_id of its document, or by
+    ('project', project_id) for the root namespace of a project. A
+    document whose parent does not exist, or in a cycle of parents, is in
+    the root namespace of its project.
+    """
+
+    def __init__(self, rows):
+        # doc_id: (parent_id, project_id, doc_name, doc_sort, has_page)
+        self.docs = dict((row[0], tuple(row[1:])) for row in rows)
+        self.parents = {}
+        self.children = {}
+        for doc_id in self.docs:
+            key = self._parent_key(doc_id)
+            self.parents[doc_id] = key
+            self.children.setdefault(key, []).append(doc_id)
+        self._names = {}
+        self._dirs = {}
+        self._page_ids = {}
+
+    @classmethod
+    def load(cls, session, page_ids, batch_size=BATCH_SIZE):
+        """Load the tree, the documents of page_ids have a page.
+
+        The contents are not read, a document synced by this run tells
+        whether it has a page with set_has_page.
+        """
+
+        rows = session.query(WKDocument.doc_id, WKDocument.parent_id,
+                             WKDocument.project_id, WKDocument.doc_name,
+                             WKDocument.doc_sort)\
+            .execution_options(stream_results=True).yield_per(batch_size)
+        return cls(tuple(row) + (row[0] in page_ids,) for row in rows)
+
+    def set_has_page(self, doc_id, has_page):
+        self.docs[doc_id] = self.docs[doc_id][:4] + (has_page,)
+
+    def _parent_key(self, doc_id):
+        parent_id, project_id = self.docs[doc_id][:2]
+        seen = set()
+        node = doc_id
+        while node in self.docs and node not in seen:
+            seen.add(node)
+            node = self.docs[node][0]
+        if parent_id not in self.docs or node == doc_id:
+            return ('project', project_id)
+        return parent_id
+
+    def name(self, doc_id):
+        """Get the page name of a document, unique among its siblings."""
+
+        if doc_id not in self._names:
+            used = set([INDEX_PAGE, SIDEBAR_PAGE])
+            clashes = []
+            # The plain names go first, a suffixed name never takes one
+            for sibling in sorted(self.children[self.parents[doc_id]]):
+                name = clean_id(self.docs[sibling][2])
+                if name in used:
+                    clashes.append((sibling, name))
+                    continue
+                used.add(name)
+                self._names[sibling] = name
+            for sibling, name in clashes:
+                suffixed = '%s_%d' % (name, sibling)
+                num = 2
+                while suffixed in used:
+                    suffixed = '%s_%d_%d' % (name, sibling, num)
+                    num += 1
+                used.add(suffixed)
+                self._names[sibling] = suffixed
+        return self._names[doc_id]
+
+    def namespace_dir(self, key):
+        """Get the directory of a namespace, relative to the pages."""
+
+        if key not in self._dirs:
+            if isinstance(key, tuple):
+                path = PROJECT_NAMESPACE % key[1]
+            else:
+                path = '/'.join([self.namespace_dir(self.parents[key]),
+                                 quote(self.name(key).encode('utf8'),
+                                       safe='')])
+            self._dirs[key] = path
+        return self._dirs[key]
+
+    def path(self, doc_id):
+        return self.namespace_dir(doc_id) + '.txt'
+
+    def page_id(self, key):
+        """Get the dokuwiki id of a page or namespace."""
+
+        if key not in self._page_ids:
+            if isinstance(key, tuple):
+                page_id = PROJECT_NAMESPACE % key[1]
+            else:
+                page_id = ':'.join([self.page_id(self.parents[key]),
+                                    self.name(key)])
+            self._page_ids[key] = page_id
+        return self._page_ids[key]
+
+    def title(self, key):
+        if isinstance(key, tuple):
+            return 'Project %d' % key[1]
+        return self.docs[key][2]
+
+    def sorted_children(self, key):
+        return sorted(self.children.get(key, ()),
+                      key=lambda doc_id: (self.docs[doc_id][3], doc_id))
+
+    def link(self, doc_id):
+        """Link a document page, or its namespace when it has children."""
+
+        title = self.title(doc_id).replace('|', '/').replace(']]', '] ]')
+        if doc_id in self.children:
+            return '[[:%s:|%s]]' % (self.page_id(doc_id), title)
+        return '[[:%s|%s]]' % (self.page_id(doc_id), title)
+
+
+def render_index(tree, key):
+    """Render the start page of a namespace as utf8."""
+
+    lines = ['====== %s ======' % tree.title(key), '']
+    if not isinstance(key, tuple) and tree.docs[key][4]:
+        lines.extend(['[[:%s|%s]]' % (tree.page_id(key), tree.title(key)),
+                      ''])
+    for doc_id in tree.sorted_children(key):
+        lines.append('  * ' + tree.link(doc_id))
+    return ('\n'.join(lines) + '\n').encode('utf8')
+
+
+def render_sidebar(tree, key):
+    """Render the sidebar of a project, its tree as nested lists."""
+
+    lines = []
+    stack = [(doc_id, 1) for doc_id in reversed(tree.sorted_children(key))]
+    while stack:
+        doc_id, depth = stack.pop()
+        lines.append('  ' * depth + '* ' + tree.link(doc_id))
+        stack.extend((child, depth + 1) for child
+                     in reversed(tree.sorted_children(doc_id)))
+    return ('\n'.join(lines) + '\n').encode('utf8')
+
+
+def convert_document(manifest, doc_content, stats):
+    """Convert the Markdown of a document through the render cache.
+
+    Return (source_digest, body), body is the DokuWiki text as utf8.
+    """
+
+    source = doc_content.encode('utf8')
+    source_digest = hashlib.md5(
+        '%d:' % markdown_to_dokuwiki.CONVERTER_VERSION + source).hexdigest()
+    body = manifest.get_render(source_digest)
+    if body is not None:
+        stats.add(cached=1)
+        return source_digest, body
+    body = markdown_to_dokuwiki.convert(source.decode('utf8')).encode('utf8')
+    manifest.set_render(source_digest, body)
+    stats.add(converted=1)
+    return source_digest, body
+
+
+def render_page(doc_id, body):
+    """Render the dokuwiki page of a smartwiki document as utf8.
+
+    body is the document converted to DokuWiki syntax, as utf8.
+    """
+
+    link = '[[%s/docs/show/%d|Smartwiki Link]] \n \n' % (
+        SMARTWIKI_SERVER_IPADDR, doc_id)
+    return link.encode('utf8') + body
+
+
+def _with_contents(session, rows):
+    """Fetch the contents of the documents of rows in one query."""
+
+    contents = dict(session.query(WKDocument.doc_id, WKDocument.doc_content)
+                    .filter(WKDocument.doc_id.in_([row.doc_id
+                                                   for row in rows])))
+    for row in rows:
+        yield row.doc_id, row.doc_name, row.version, contents.get(row.doc_id)
+
+
+def stream_documents(query, content_session, batch_size=BATCH_SIZE):
+    """Yield (doc_id, doc_name, version, doc_content) of the query rows.
+
+    query selects the doc_id, doc_name and version columns, its rows are
+    read from a server side cursor. The contents are fetched batch_size
+    documents at a time through content_session, a cursor being read
+    cannot run another query on the same connection.
+    """
+
+    rows = query.execution_options(stream_results=True).yield_per(batch_size)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            for doc in _with_contents(content_session, batch):
+                yield doc
+            batch = []
+    if batch:
+        for doc in _with_contents(content_session, batch):
+            yield doc
+
+
+def fetch_documents(session, doc_ids, batch_size=BATCH_SIZE):
+    """Yield (doc_id, doc_name, version, doc_content) of doc_ids."""
+
+    for start in range(0, len(doc_ids), batch_size):
+        for row in session.query(WKDocument.doc_id, WKDocument.doc_name,
+                                 WKDocument.version, WKDocument.doc_content)\
+                .filter(WKDocument.doc_id.in_(doc_ids[start:
+                                                      start + batch_size])):
+            yield tuple(row)
+
+
+def file_digest(file_path):
+    """Get the md5 of a file, None if it does not exist."""
+
+    if not os.path.exists(file_path):
+        return None
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as file_obj:
+        for chunk in iter(lambda: file_obj.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_owner(owner):
+    """Get the (uid, gid) of a 'user:group' owner, None if unknown."""
+
+    if not owner:
+        return None
+    user, _, group = owner.partition(':')
+    try:
+        uid = pwd.getpwnam(user).pw_uid
+        gid = grp.getgrnam(group).gr_gid if group else -1
+    except KeyError:
+        logging.warning("Unknown owner %s, keep the owner of the pages.",
+                        owner)
+        return None
+    return uid, gid
+
+
+class PageWriter(object):
+    """Write dokuwiki pages or media atomically, owned by the wiki user."""
+
+    def __init__(self, pages_path=DOKU_PAGES_PATH, owner=PAGE_OWNER,
+                 mode=PAGE_MODE):
+        self.pages_path = pages_path
+        self.owner = owner
+        self.ids = get_owner(owner)
+        self.mode = mode
+        # Pages the script was not allowed to chown
+        self.unowned = []
+        # Directories of the renamed pages, flushed at the end
+        self.dirs = set([pages_path])
+        # Pages written or removed, for the search index
+        self.changed = set()
+
+    def write(self, file_name, content):
+        """Replace the page file_name with content."""
+
+        return self._replace(file_name, lambda file_obj:
+                             file_obj.write(content))
+
+    def copy(self, file_name, source_path):
+        """Replace file_name with a copy of source_path.
+
+        The file is copied COPY_CHUNK bytes at a time. Return the md5 of
+        the bytes copied.
+        """
+
+        digest = hashlib.md5()
+
+        def fill(file_obj):
+            with open(source_path, 'rb') as source:
+                for chunk in iter(lambda: source.read(COPY_CHUNK), b''):
+                    digest.update(chunk)
+                    file_obj.write(chunk)
+
+        self._replace(file_name, fill)
+        return digest.hexdigest()
+
+    def link(self, file_name, source_path):
+        """Replace file_name with a hardlink of source_path.
+
+        A copy when source_path is on another filesystem or may not be
+        linked. Return whether file_name changed.
+        """
+
+        file_full_path = os.path.join(self.pages_path, file_name)
+        if os.path.exists(file_full_path) and \
+                os.path.samefile(file_full_path, source_path):
+            return False
+        dir_path = self._prepare(file_full_path)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.',
+                                        suffix='.tmp')
+        os.close(fd)
+        os.unlink(tmp_path)
+        try:
+            os.link(source_path, tmp_path)
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            self.copy(file_name, source_path)
+            return True
+        try:
+            os.rename(tmp_path, file_full_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self.changed.add(file_name)
+        return True
+
+    def _prepare(self, file_full_path):
+        dir_path = os.path.dirname(file_full_path)
+        if not os.path.isdir(dir_path):
+            self._makedirs(dir_path)
+        self.dirs.add(dir_path)
+        return dir_path
+
+    def _replace(self, file_name, fill):
+        # fill writes the new content to the temporary file object
+        file_full_path = os.path.join(self.pages_path, file_name)
+        dir_path = self._prepare(file_full_path)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.',
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file_obj:
+                fill(file_obj)
+                file_obj.flush()
+                os.fchmod(file_obj.fileno(), self.mode)
+                self._chown(file_obj.fileno(), file_full_path)
+            os.rename(tmp_path, file_full_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self.changed.add(file_name)
+        return file_full_path
+
+    def _makedirs(self, dir_path):
+        parent = os.path.dirname(dir_path)
+        if not os.path.isdir(parent):
+            self._makedirs(parent)
+        try:
+            os.mkdir(dir_path, DIR_MODE)
+        except OSError as err:
+            # Made by another writer meanwhile
+            if err.errno != errno.EEXIST:
+                raise
+            return
+        self.dirs.add(parent)
+        fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fchmod(fd, DIR_MODE)
+            self._chown(fd, dir_path)
+        finally:
+            os.close(fd)
+
+    def remove(self, file_name):
+        """Remove the page file_name if it exists, and its empty dirs."""
+
+        file_full_path = os.path.join(self.pages_path, file_name)
+        try:
+            os.unlink(file_full_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        self.changed.add(file_name)
+        dir_path = os.path.dirname(file_full_path)
+        self.dirs.add(dir_path)
+        while dir_path != self.pages_path:
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                break
+            dir_path = os.path.dirname(dir_path)
+            self.dirs.add(dir_path)
+
+    def _chown(self, fd, file_full_path):
+        if self.ids is None:
+            return
+        try:
+            os.fchown(fd, *self.ids)
+        except OSError as err:
+            if err.errno != errno.EPERM:
+                raise
+            self.unowned.append(file_full_path)
+
+    def finish(self):
+        """Chown the pages left to sudo and flush the directory."""
+
+        for start in range(0, len(self.unowned), CHOWN_BATCH):
+            paths = self.unowned[start:start + CHOWN_BATCH]
+            try:
+                if subprocess.call(['sudo', 'chown', self.owner] + paths):
+                    raise OSError("sudo chown failed")
+            except OSError as err:
+                logging.error("Failed to change owner as %s for %d pages, "
+                              "detailed error as %s", self.owner, len(paths),
+                              err)
+        self.unowned = []
+        # One fsync per directory makes every rename of the run durable
+        for dir_path in sorted(self.dirs):
+            if not os.path.isdir(dir_path):
+                continue
+            fd = os.open(dir_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.dirs = set([self.pages_path])
+
+
+def media_id(upload):
+    """Get the dokuwiki media id of an upload path."""
+
+    return ':'.join([MEDIA_NAMESPACE] + [clean_id(part) for part
+                                         in upload.split('/') if part])
+
+
+def media_file_name(upload):
+    """Get the file of the media of an upload, relative to the media."""
+
+    return '/'.join(quote(part.encode('utf8'), safe='')
+                    for part in media_id(upload).split(':'))
+
+
+def link_uploads(doc_content):
+    """Point the links of a document to smartwiki uploads to the media.
+
+    A link becomes an image link to the media id, which dokuwiki renders
+    as a download link when the media is not an image. Return the
+    document and the paths of the uploads, relative to the uploads.
+    """
+
+    host = SMARTWIKI_SERVER_IPADDR.split('://')[-1].rstrip('/')
+    link_re = re.compile(r'!?\[([^\]]*)\]\(\s*(?:(?:https?:)?//%s)?%s'
+                         r'([^)\s?#]+)[^)\s]*(?:\s+"[^"]*")?\s*\)'
+                         % (re.escape(host), re.escape(UPLOADS_URL)))
+    uploads = []
+
+    def replace(match):
+        upload = posixpath.normpath(
+            unquote(match.group(2).encode('utf8')).decode('utf8'))
+        if upload.startswith('../'):
+            return match.group(0)
+        uploads.append(upload)
+        return '![%s](:%s)' % (match.group(1), media_id(upload))
+
+    return link_re.sub(replace, doc_content), uploads
+
+
+class MediaStore(object):
+    """Sync the smartwiki uploads into the dokuwiki media by content.
+
+    Every distinct content is copied once to the store, named by its md5,
+    the media files are hardlinks of the store objects.
+    """
+
+    def __init__(self, manifest, stats, uploads_path=SMARTWIKI_UPLOADS_PATH,
+                 media_path=DOKU_MEDIA_PATH, store_path=MEDIA_STORE_PATH,
+                 owner=PAGE_OWNER):
+        self.manifest = manifest
+        self.stats = stats
+        self.uploads_path = os.path.normpath(uploads_path)
+        self.media = PageWriter(media_path, owner)
+        self.store = PageWriter(store_path, owner)
+        # upload: whether it was synced by this run
+        self.done = {}
+
+    def sync(self, upload):
+        """Sync an upload to its media, return whether it was changed."""
+
+        source_path = os.path.normpath(os.path.join(self.uploads_path,
+                                                    upload))
+        if not source_path.startswith(self.uploads_path + os.sep):
+            raise ValueError("Upload %s is out of %s"
+                             % (upload, self.uploads_path))
+        stat = os.stat(source_path)
+        file_name = media_file_name(upload)
+        row = self.manifest.get_media(upload)
+        if row is not None and row[0] == stat.st_size and \
+                row[1] == stat.st_mtime and row[3] == file_name and \
+                os.path.exists(os.path.join(self.media.pages_path,
+                                            file_name)):
+            return False
+        digest = file_digest(source_path)
+        object_name = '%s/%s' % (digest[:2], digest)
+        object_path = os.path.join(self.store.pages_path, object_name)
+        if not os.path.exists(object_path):
+            if self.store.copy(object_name, source_path) != digest:
+                self.store.remove(object_name)
+                raise IOError("Upload %s changed while copied" % upload)
+            self.stats.add(size=stat.st_size)
+        self.media.link(file_name, object_path)
+        self.manifest.set_media(upload, stat.st_size, stat.st_mtime, digest,
+                                file_name)
+        return True
+
+    def sync_all(self, uploads):
+        """Sync the uploads not synced by this run yet.
+
+        Return whether they are all synced.
+        """
+
+        synced = True
+        for upload in uploads:
+            if upload in self.done:
+                synced = synced and self.done[upload]
+                continue
+            try:
+                if self.sync(upload):
+                    self.stats.add(media=1)
+                else:
+                    self.stats.add(media_skipped=1)
+                self.done[upload] = True
+            except (IOError, OSError, ValueError) as err:
+                if isinstance(err, ValueError) or \
+                        getattr(err, 'errno', None) == errno.ENOENT:
+                    # Retrying does not help, the link stays broken
+                    logging.warning("Missing smartwiki upload %s, detailed "
+                                    "error as %s", upload, err)
+                    self.done[upload] = True
+                    continue
+                logging.error("Failed to sync the smartwiki upload %s, "
+                              "detailed error as %s", upload, err)
+                self.stats.add(failed=1)
+                self.done[upload] = synced = False
+        return synced
+
+    def collect(self):
+        """Remove the media no document links, and their store objects."""
+
+        for upload, digest, file_name in self.manifest.unused_media():
+            self.manifest.remove_media(upload)
+            if not self.manifest.media_used('file_name', file_name):
+                self.media.remove(file_name)
+            if digest and not self.manifest.media_used('digest', digest):
+                self.store.remove('%s/%s' % (digest[:2], digest))
+
+    def finish(self):
+        self.media.finish()
+        self.store.finish()
+
+
+def file_page_id(file_name):
+    """Get the dokuwiki id of a page file name."""
+
+    return ':'.join(unquote(part) for part
+                    in os.path.splitext(file_name)[0].split('/'))
+
+
+def index_pages(file_names, doku_path=DOKU_PATH, owner=PAGE_OWNER,
+                batch_size=INDEX_BATCH):
+    """Update the dokuwiki search index of the page files.
+
+    The script of INDEXER_PHP runs as the owner of the pages, through
+    sudo when the script runs as another user. Return how many pages were
+    indexed, a page left out is indexed by dokuwiki on its next view.
+    """
+
+    page_ids = [file_page_id(file_name) for file_name in sorted(file_names)]
+    command = ['php', '-r', INDEXER_PHP, '--', doku_path]
+    ids = get_owner(owner)
+    if ids is not None and ids[0] != os.geteuid():
+        command = ['sudo', '-u', owner.partition(':')[0]] + command
+    indexed = 0
+    for start in range(0, len(page_ids), batch_size):
+        batch = page_ids[start:start + batch_size]
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE)
+            process.communicate('\n'.join(batch) + '\n')
+            if process.returncode:
+                raise OSError("php exited with %d" % process.returncode)
+        except OSError as err:
+            logging.error("Failed to index %d pages of dokuwiki by %s, "
+                          "detailed error as %s", len(batch), command[0], err)
+            continue
+        indexed += len(batch)
+    return indexed
+
+
+class SyncStats(object):
+    """Count the pages of a sync."""
+
+    def __init__(self):
+        self.written = 0
+        self.skipped = 0
+        self.failed = 0
+        self.deleted = 0
+        self.bytes = 0
+        self.converted = 0
+        self.cached = 0
+        self.indexed = 0
+        self.media = 0
+        self.media_skipped = 0
+        self.start_time = time.time()
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, written=0, skipped=0, failed=0, deleted=0, size=0,
+            converted=0, cached=0, indexed=0, media=0, media_skipped=0):
+        with self._lock:
+            self.written += written
+            self.skipped += skipped
+            self.failed += failed
+            self.deleted += deleted
+            self.bytes += size
+            self.converted += converted
+            self.cached += cached
+            self.indexed += indexed
+            self.media += media
+            self.media_skipped += media_skipped
+
+    def stop(self):
+        self.elapsed = time.time() - self.start_time
+
+    def summary(self):
+        elapsed = max(self.elapsed, 1e-6)
+        return ('%d pages written, %d unchanged, %d deleted, %d failed, '
+                '%d indexed in %.2fs, %.1f pages/s, %.1f KB/s, %d converted, '
+                '%d from the render cache, %d media synced, %d unchanged'
+                % (self.written, self.skipped, self.deleted, self.failed,
+                   self.indexed, self.elapsed,
+                   (self.written + self.skipped) / elapsed,
+                   self.bytes / 1024.0 / elapsed,
+                   self.converted, self.cached, self.media,
+                   self.media_skipped))
+
+
+class WriterPool(object):
+    """Write pages on a bounded pool of threads.
+
+    The pages are queued in the order of the query, the queue holds a
+    few pages per thread so the query waits for slow writers instead
+    of filling the memory. A page file always goes to the same thread, so
+    the writes of one file keep their order. The errors are reported in
+    document order once the pool is closed.
+    """
+
+    def __init__(self, writer, stats, workers=WORKERS):
+        self.writer = writer
+        self.stats = stats
+        self.errors = []
+        # (doc_id, file_name, digest) of the pages up to date, doc_id is
+        # None for the start pages and sidebars
+        self.done = []
+        self._queues = [Queue.Queue(maxsize=2) for _ in range(workers)]
+        self._threads = [threading.Thread(target=self._run,
+                                          name='Writer-%d' % num,
+                                          args=(tasks,))
+                         for num, tasks in enumerate(self._queues)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, seq, doc_id, file_name, content, digest=None):
+        """Queue a page, digest is the md5 of the page file if known."""
+
+        tasks = self._queues[hash(file_name) % len(self._queues)]
+        tasks.put((seq, doc_id, file_name, content, digest))
+
+    def close(self):
+        """Wait for the queued pages, return the errors in order."""
+
+        for tasks in self._queues:
+            tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self.errors.sort()
+        for seq, doc_id, file_name, err in self.errors:
+            logging.error("Failed to sync the smartwiki document %s to %s, "
+                          "detailed error as %s", doc_id, file_name, err)
+        return self.errors
+
+    def _run(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            seq, doc_id, file_name, content, digest = task
+            try:
+                self._write(doc_id, file_name, content, digest)
+            except Exception as err:
+                logging.debug("Failed to write %s", file_name, exc_info=True)
+                self.errors.append((seq, doc_id, file_name, err))
+                self.stats.add(failed=1)
+
+    def _write(self, doc_id, file_name, content, digest):
+        new_digest = hashlib.md5(content).hexdigest()
+        if digest is None:
+            digest = file_digest(os.path.join(self.writer.pages_path,
+                                              file_name))
+        if digest == new_digest:
+            self.stats.add(skipped=1)
+        else:
+            self.writer.write(file_name, content)
+            self.stats.add(written=1, size=len(content))
+        self.done.append((doc_id, file_name, new_digest))
+
+
+def sync_indexes(tree, manifest, pool, dirs, full=False, seq=0):
+    """Render the start pages and sidebars of the namespaces in dirs.
+
+    dirs are the directories of the namespaces whose pages changed, a
+    namespace left without pages loses its start page, a project without
+    pages its sidebar. Return the index files to remove.
+    """
+
+    keys = dict((tree.namespace_dir(key), key) for key in tree.children)
+    dirs = [dir_path for dir_path in dirs if dir_path]
+    pages = []
+    for dir_path in dirs:
+        pages.append((dir_path + '/' + INDEX_PAGE + '.txt',
+                      keys.get(dir_path), render_index))
+    for dir_path in set(dir_path.split('/')[0] for dir_path in dirs):
+        pages.append((dir_path + '/' + SIDEBAR_PAGE + '.txt',
+                      keys.get(dir_path), render_sidebar))
+    stale = []
+    for file_name, key, render in sorted(pages):
+        if key is None:
+            stale.append(file_name)
+            continue
+        content = render(tree, key)
+        digest = None if full else manifest.index_digest(file_name)
+        if digest == hashlib.md5(content).hexdigest():
+            continue
+        seq += 1
+        pool.submit(seq, None, file_name, content, digest)
+    return stale
+
+
+def sw_to_dw(session=None, full=False, manifest_file=MANIFEST_FILE,
+             batch_size=BATCH_SIZE, owner=PAGE_OWNER, workers=WORKERS,
+             search_index=True, index_batch=INDEX_BATCH, media=True,
+             uploads_path=SMARTWIKI_UPLOADS_PATH):
+    """Sync the smartwiki documents changed since the last sync to dokuwiki.
+
+    With search_index, the pages changed are indexed for the dokuwiki
+    search. With media, the uploads linked by the documents are synced
+    from uploads_path. Return the SyncStats of the run.
+    """
 
     logging.info("Start to sync the smartwiki documents to dokuwiki.")
-    doku_pages_path = '/var/www/dokuwiki/data/pages'
+    manifest = Manifest(manifest_file)
+    # A new manifest has to learn every document, a new converter, new
+    # page names or the media turned on or off have to render every
+    # document again
+    converter_version = '%d.%d%s' % (markdown_to_dokuwiki.CONVERTER_VERSION,
+                                     CLEAN_ID_VERSION,
+                                     ' media' if media else '')
+    full = full or not manifest.count() or \
+        manifest.get_meta('converter_version') != converter_version
+    watermark = None if full else manifest.get_watermark()
     if not session:
         session = get_session()
+    content_session = get_session()
+    tree = DocTree.load(session, manifest.page_ids(), batch_size)
+    query = session.query(WKDocument.doc_id, WKDocument.doc_name,
+                          WKDocument.version)
+    if watermark is not None:
+        logging.info("Sync the documents changed since %s.", watermark)
+        query = query.filter(WKDocument.version >= watermark -
+                             timedelta(seconds=WATERMARK_OVERLAP))
+    new_watermark = watermark
+    stats = SyncStats()
+    writer = PageWriter(DOKU_PAGES_PATH, owner)
+    store = MediaStore(manifest, stats, uploads_path, DOKU_MEDIA_PATH,
+                       MEDIA_STORE_PATH, owner) if media else None
+    # Documents whose uploads failed to sync, retried by the next run
+    media_failed = {}
+    pool = WriterPool(writer, stats, workers)
+
     try:
-        for doc in session.query(WKDocument).all():
-            if doc.doc_content:
-                file_name = ''.join([quote(doc.doc_name.encode('utf8')),
-                                     '.txt'])
-                file_full_path = os.path.join(doku_pages_path, file_name)
-
-                with open(file_full_path, 'w') as file_obj:
-                    try:
-                        content = ''.join(['[[', SMARTWIKI_SERVER_IPADDR,
-                                           '/docs/show/',
-                                           str(doc.doc_id),
-                                           '|Smartwiki Link]] \n \n',
-                                           doc.doc_content])
-                        file_obj.write(content)
-                    except Exception as err:
-                        logging.exception("Failed to sync the smartwiki "
-                                          "documents to dokuwiki, detailed "
-                                          "error as %s", err)
-                try:
-                    os.system(''.join(['sudo chown www-data:www-data ',
-                                       file_full_path]))
-                except Exception as err:
-                    logging.exception("Failed to change owner as www-data for "
-                                      "%s", file_full_path)
+        # Pages failed by the previous runs, new documents and documents
+        # whose path changed with the tree are synced after the changed ones.
+        resync = set(manifest.pending_ids())
+        known = set()
+        deleted = []
+        for doc_id, file_name, digest in manifest.files():
+            known.add(doc_id)
+            if doc_id not in tree.docs:
+                deleted.append(doc_id)
+            elif file_name != tree.path(doc_id):
+                resync.add(doc_id)
+        resync.update(doc_id for doc_id in tree.docs if doc_id not in known)
+        seen = set()
+        # Page files which may be left by their document
+        old_files = {}
+        # Namespaces whose start page has to be rendered again
+        dirs = set()
+        for doc_id in deleted:
+            file_name = manifest.remove(doc_id)
+            if file_name:
+                old_files[doc_id] = file_name
+                dirs.add(os.path.dirname(file_name))
+
+        def changed_documents():
+            for doc in stream_documents(query.order_by(WKDocument.version),
+                                        content_session, batch_size):
+                yield doc
+            for doc in fetch_documents(content_session, sorted(resync - seen),
+                                       batch_size):
+                yield doc
+
+        seq = 0
+        try:
+            for seq, (doc_id, doc_name, version, doc_content) in enumerate(
+                    changed_documents()):
+                if new_watermark is None or version > new_watermark:
+                    new_watermark = version
+                if doc_id not in tree.docs:
+                    # Added after the tree was loaded, the next run syncs it
+                    continue
+                seen.add(doc_id)
+                tree.set_has_page(doc_id, bool(doc_content))
+                row = manifest.get(doc_id)
+                file_name = tree.path(doc_id)
+                # The parent start page links the namespace of a document once
+                # it has children
+                dirs.add(os.path.dirname(file_name))
+                dirs.add(os.path.dirname(os.path.dirname(file_name)))
+                if row is not None and row[0] and row[2] != '':
+                    old_files.setdefault(doc_id, row[0])
+                    dirs.add(os.path.dirname(row[0]))
+                if not doc_content:
+                    manifest.update(doc_id, file_name, tree.name(doc_id),
+                                    version, '')
+                    manifest.set_media_refs(doc_id, [])
+                    continue
+                digest = None
+                if not full and row is not None and row[0] == file_name:
+                    digest = row[2] or None
+                uploads = []
+                if store is not None:
+                    # The media go first, the page never links a missing one
+                    doc_content, uploads = link_uploads(doc_content)
+                    if not store.sync_all(uploads):
+                        media_failed[doc_id] = file_name
+                manifest.set_media_refs(doc_id, uploads)
+                source_digest, body = convert_document(manifest, doc_content,
+                                                       stats)
+                # Pending until the page is written, a failed write is retried
+                manifest.update(doc_id, file_name, tree.name(doc_id), version,
+                                None, source_digest)
+                pool.submit(seq, doc_id, file_name, render_page(doc_id, body),
+                            digest)
+            stale_indexes = sync_indexes(tree, manifest, pool, dirs, full, seq)
+        finally:
+            pool.close()
+            content_session.close()
+
+        for doc_id, file_name, digest in pool.done:
+            if doc_id is None:
+                manifest.set_index(file_name, digest)
+            else:
+                manifest.set_digest(doc_id, file_name, digest)
+        for doc_id, file_name in media_failed.items():
+            manifest.set_digest(doc_id, file_name, None)
+        # A page left by its document and taken by no other one is stale,
+        # unless the document failed to move, then it is kept for now.
+        failed = set(doc_id for _, doc_id, _, _ in pool.errors)
+        for doc_id, file_name in old_files.items():
+            if doc_id not in failed and manifest.holder(file_name) is None:
+                writer.remove(file_name)
+                stats.add(deleted=1)
+        for file_name in stale_indexes:
+            if manifest.remove_index(file_name):
+                writer.remove(file_name)
+        # A failed page is pending in the manifest, the next run retries it
+        if new_watermark is not None:
+            manifest.set_watermark(new_watermark)
+        manifest.set_meta('converter_version', converter_version)
+        manifest.prune_renders()
+        if store is not None:
+            store.collect()
+        manifest.commit()
     finally:
+        writer.finish()
+        if store is not None:
+            store.finish()
+        manifest.close()
         session.close()
-        logging.info("Sync the smartwiki documents to dokuwiki successfully")
+        if search_index and writer.changed:
+            stats.add(indexed=index_pages(writer.changed, DOKU_PATH, owner,
+                                          index_batch))
+        stats.stop()
+
+    logging.info("Sync the smartwiki documents to dokuwiki successfully, "
+                 "%s.", stats.summary())
+    return stats
+
+
+def poll_documents(engine):
+    """Get (count, newest version, database time) of the documents."""
+
+    table = WKDocument.__table__
+    with engine.connect() as connection:
+        query = select([func.count(), func.max(table.c.version),
+                        func.current_timestamp()]).select_from(table)
+        row = connection.execute(query).first()
+    return tuple(row)
+
+
+def oldest_version(engine, since):
+    """Get the oldest version of the documents changed after since."""
+
+    table = WKDocument.__table__
+    with engine.connect() as connection:
+        return connection.execute(select([func.min(table.c.version)])
+                                  .where(table.c.version > since)).scalar()
+
+
+class DaemonMetrics(object):
+    """Count the polls and syncs of the daemon."""
+
+    def __init__(self, prom_path=None):
+        self.prom_path = prom_path
+        self.polls = 0
+        self.syncs = 0
+        self.errors = 0
+        self.pages = dict((result, 0) for result
+                          in ('written', 'unchanged', 'deleted', 'failed'))
+        self.bytes = 0
+        self.lag = 0.0
+        self.duration = 0.0
+        self.throughput = 0.0
+        self.last_sync = 0.0
+
+    def add_sync(self, stats, lag):
+        self.syncs += 1
+        self.pages['written'] += stats.written
+        self.pages['unchanged'] += stats.skipped
+        self.pages['deleted'] += stats.deleted
+        self.pages['failed'] += stats.failed
+        self.bytes += stats.bytes
+        self.lag = lag
+        self.duration = stats.elapsed
+        self.throughput = ((stats.written + stats.skipped) /
+                           max(stats.elapsed, 1e-6))
+        self.last_sync = time.time()
+
+    def write_prom(self):
+        if not self.prom_path:
+            return
+        lines = []
+        for name, kind, doc, value in (
+                ('polls_total', 'counter', 'Polls of the documents.',
+                 self.polls),
+                ('syncs_total', 'counter', 'Syncs run.', self.syncs),
+                ('errors_total', 'counter', 'Polls and syncs failed.',
+                 self.errors),
+                ('bytes_written_total', 'counter', 'Bytes of pages written.',
+                 self.bytes),
+                ('lag_seconds', 'gauge', 'Newest edit to its page written, '
+                 'last sync.', self.lag),
+                ('sync_seconds', 'gauge', 'Duration of the last sync.',
+                 self.duration),
+                ('pages_per_second', 'gauge', 'Pages checked per second, '
+                 'last sync.', self.throughput),
+                ('last_sync_timestamp_seconds', 'gauge',
+                 'Time of the last sync.', self.last_sync)):
+            lines.append('# HELP sync_dokuwiki_%s %s' % (name, doc))
+            lines.append('# TYPE sync_dokuwiki_%s %s' % (name, kind))
+            lines.append('sync_dokuwiki_%s %s' % (name, value))
+        lines.append('# HELP sync_dokuwiki_pages_total Pages synced.')
+        lines.append('# TYPE sync_dokuwiki_pages_total counter')
+        for result in sorted(self.pages):
+            lines.append('sync_dokuwiki_pages_total{result="%s"} %d'
+                         % (result, self.pages[result]))
+
+        # Write aside then rename, a scraper never reads a partial file
+        tmp_path = '%s.tmp' % self.prom_path
+        with open(tmp_path, 'w') as file_obj:
+            file_obj.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self.prom_path)
+
+
+def run_daemon(interval=POLL_INTERVAL, debounce=DEBOUNCE,
+               max_delay=MAX_DELAY, metrics_prom=None, stop=None,
+               **sync_kwargs):
+    """Sync the documents whenever they change, until stop is set.
+
+    sync_kwargs are passed to sw_to_dw, full only applies to the first
+    sync. Return the DaemonMetrics.
+    """
+
+    engine = _get_engine()
+    metrics = DaemonMetrics(metrics_prom)
+    stop = stop or threading.Event()
+    synced = None
+    while not stop.is_set():
+        try:
+            state = poll_documents(engine)
+            metrics.polls += 1
+            if state[:2] != synced:
+                first_seen = time.time()
+                if synced is not None:
+                    # Wait for the burst of edits to settle
+                    while not stop.wait(debounce) and \
+                            time.time() - first_seen < max_delay:
+                        latest = poll_documents(engine)
+                        metrics.polls += 1
+                        if latest[:2] == state[:2]:
+                            break
+                        state = latest
+                    if stop.is_set():
+                        break
+                # The lag runs from the first edit of the burst, on the
+                # clock of the database. A delete has no version, its lag
+                # runs from the poll which saw it.
+                offset = state[2] - datetime.now()
+                first_edit = None
+                if synced is not None and synced[1] is not None and \
+                        state[1] is not None and state[1] > synced[1]:
+                    first_edit = oldest_version(engine, synced[1])
+                stats = sw_to_dw(**sync_kwargs)
+                sync_kwargs['full'] = False
+                synced = state[:2]
+                if first_edit is not None:
+                    lag = _seconds(datetime.now() + offset - first_edit)
+                else:
+                    lag = time.time() - first_seen
+                metrics.add_sync(stats, max(lag, 0.0))
+                logging.info("Synced the documents, lag %.1fs: %s.",
+                             metrics.lag, stats.summary())
+        except Exception:
+            metrics.errors += 1
+            logging.exception("Failed to sync the smartwiki documents, "
+                              "retry in %ds.", interval)
+        try:
+            metrics.write_prom()
+        except (IOError, OSError) as err:
+            logging.error("Failed to write the metrics to %s, detailed "
+                          "error as %s", metrics_prom, err)
+        stop.wait(interval)
+    return metrics
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
 
 
 def parse_args(argv):
@@ -119,6 +1516,60 @@ def parse_args(argv):
     parser.add_option('-d', '--debug', action='store_true',
                       dest='debug', default=False,
                       help='Enable debug message.')
+    parser.add_option('-f', '--full', action='store_true',
+                      dest='full', default=False,
+                      help='Sync every document and check every page, not '
+                           'only the changed ones.')
+    parser.add_option('-m', '--manifest', dest='manifest_file',
+                      default=MANIFEST_FILE,
+                      help='SQLite file mapping the documents to their '
+                           'pages, default is %s.' % MANIFEST_FILE)
+    parser.add_option('-b', '--batch-size', type='int', dest='batch_size',
+                      default=BATCH_SIZE,
+                      help='Documents whose content is fetched at a time, '
+                           'default is %d.' % BATCH_SIZE)
+    parser.add_option('-o', '--owner', dest='owner', default=PAGE_OWNER,
+                      help='user:group owning the pages, empty to keep the '
+                           'owner of the script, default is %s.' % PAGE_OWNER)
+    parser.add_option('-w', '--workers', type='int', dest='workers',
+                      default=WORKERS,
+                      help='Threads writing the pages, default is %d.'
+                           % WORKERS)
+    parser.add_option('--no-search-index', action='store_false',
+                      dest='search_index', default=True,
+                      help='Leave the search index of the pages changed to '
+                           'dokuwiki, which indexes a page on its next view.')
+    parser.add_option('--index-batch', type='int', dest='index_batch',
+                      default=INDEX_BATCH,
+                      help='Pages indexed by one php process, default is %d.'
+                           % INDEX_BATCH)
+    parser.add_option('--no-media', action='store_false', dest='media',
+                      default=True,
+                      help='Leave the links to the smartwiki uploads as '
+                           'they are.')
+    parser.add_option('-u', '--uploads-path', dest='uploads_path',
+                      default=SMARTWIKI_UPLOADS_PATH,
+                      help='Directory of the smartwiki uploads, default is '
+                           '%s.' % SMARTWIKI_UPLOADS_PATH)
+    parser.add_option('--daemon', action='store_true', dest='daemon',
+                      default=False,
+                      help='Keep running and sync the documents whenever '
+                           'they change.')
+    parser.add_option('-i', '--interval', type='float', dest='interval',
+                      default=POLL_INTERVAL,
+                      help='Seconds between the polls of the daemon, '
+                           'default is %d.' % POLL_INTERVAL)
+    parser.add_option('--debounce', type='float', dest='debounce',
+                      default=DEBOUNCE,
+                      help='Seconds without new changes before a sync of '
+                           'the daemon, default is %d.' % DEBOUNCE)
+    parser.add_option('--max-delay', type='float', dest='max_delay',
+                      default=MAX_DELAY,
+                      help='Longest debounce of a burst of changes, default '
+                           'is %d seconds.' % MAX_DELAY)
+    parser.add_option('--metrics-prom', dest='metrics_prom',
+                      help='File the daemon writes its sync lag and '
+                           'throughput to, in the Prometheus text format.')
     return parser.parse_args(argv[1:])[0]
 
 
@@ -136,8 +1587,29 @@ def main(argv):
                         filename='sync_sw_2_dw.log',
                         filemode='w')
 
-    sw_to_dw()
-    print 'Done to sync smartWiki documents to dokuwiki!'
+    if option.workers < 1 or option.index_batch < 1:
+        print 'The number of workers and the index batch must be at least 1.'
+        sys.exit(1)
+    sync_kwargs = dict(full=option.full, manifest_file=option.manifest_file,
+                       batch_size=option.batch_size, owner=option.owner,
+                       workers=option.workers,
+                       search_index=option.search_index,
+                       index_batch=option.index_batch, media=option.media,
+                       uploads_path=option.uploads_path)
+    if option.daemon:
+        if option.interval <= 0 or option.debounce < 0:
+            print 'The interval must be positive, the debounce not negative.'
+            sys.exit(1)
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+        metrics = run_daemon(option.interval, option.debounce,
+                             option.max_delay, option.metrics_prom, stop,
+                             **sync_kwargs)
+        print 'Stopped the sync daemon after %d syncs.' % metrics.syncs
+        return
+    stats = sw_to_dw(**sync_kwargs)
+    print 'Done to sync smartWiki documents to dokuwiki! %s.' % stats.summary()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+"""
+Tests of the conversion of Markdown into DokuWiki syntax, run them with:
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import time
+import unittest
+
+from markdown_to_dokuwiki import convert, convert_inline
+
+
+class ConvertInlineTest(unittest.TestCase):
+
+    def test_markup(self):
+        self.assertEqual(convert_inline(u'*a* and **b** ~~c~~'),
+                         u'//a// and **b** <del>c</del>')
+        self.assertEqual(convert_inline(u'[text](http://example.com)'),
+                         u'[[http://example.com|text]]')
+        self.assertEqual(convert_inline(u'![logo](logo.png)'),
+                         u'{{logo.png|logo}}')
+        self.assertEqual(convert_inline(u'`a**b`'), u"''%%a**b%%''")
+
+    def test_literal_italic(self):
+        self.assertEqual(convert_inline(u'a //comment// b'),
+                         u'a %%//%%comment%%//%% b')
+
+    def test_url_is_not_escaped(self):
+        self.assertEqual(convert_inline(u'see http://example.com'),
+                         u'see http://example.com')
+
+    def test_unclosed_bold(self):
+        self.assertEqual(convert_inline(u'**unclosed bold'),
+                         u'%%**%%unclosed bold')
+        self.assertEqual(convert_inline(u'a ** b'), u'a %%**%% b')
+
+    def test_literal_underline(self):
+        self.assertEqual(convert_inline(u'my__var'), u'my%%__%%var')
+        self.assertEqual(convert_inline(u'**a __b** c'),
+                         u'**a %%__%%b** c')
+
+    def test_literal_links_and_media(self):
+        self.assertEqual(convert_inline(u'[[page]] {{image}}'),
+                         u'%%[[%%page%%]]%% %%{{%%image%%}}%%')
+
+    def test_code_span_runs(self):
+        self.assertEqual(convert_inline(u'``a`b`` c'), u"''%%a`b%%'' c")
+        self.assertEqual(convert_inline(u'```a` b'), u'```a` b')
+
+    def test_unclosed_links_are_linear(self):
+        # Every unclosed [, ]( or ` used to rescan the line to its end
+        start = time.time()
+        for line in (u'[' * 40000, u'[a](' * 20000, u'`' * 40000,
+                     u'![a](b "' * 10000, u'<http://a' * 20000):
+            convert_inline(line)
+        self.assertLess(time.time() - start, 5)
+
+    def test_literal_nowiki(self):
+        self.assertEqual(convert_inline(u'100%% done'),
+                         u'100<nowiki>%%</nowiki> done')
+
+    def test_literal_footnote_and_linebreak(self):
+        self.assertEqual(convert_inline(u'f((x)) a\\\\ b'),
+                         u'f%%((%%x%%))%% a%%\\\\%% b')
+
+    def test_code_with_nowiki(self):
+        self.assertEqual(convert_inline(u'`a %% b`'),
+                         u"''%%a %%<nowiki>%%</nowiki>%% b%%''")
+        self.assertEqual(convert_inline(u'`%%`'),
+                         u"''<nowiki>%%</nowiki>''")
+
+
+class ConvertTest(unittest.TestCase):
+
+    def test_unclosed_bold_stays_in_its_line(self):
+        self.assertEqual(convert(u'**not bold\n\nnext paragraph'),
+                         u'%%**%%not bold\n\nnext paragraph')
+
+    def test_literal_table_marks(self):
+        self.assertEqual(convert(u'^ not a header\n| not a row'),
+                         u'%%^%% not a header\n%%|%% not a row')
+
+    def test_table_cell(self):
+        self.assertEqual(convert(u'| a | b |\n|---|---|\n| //x// | y |'),
+                         u'^ a ^ b ^\n| %%//%%x%%//%% | y |')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the sync of the SmartWiki documents into DokuWiki.
+
+The SmartWiki database is a SQLite file and the pages are written to a
+temporary directory, run them with:
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+import sync_wiki_doc
+
+
+class CleanIdTest(unittest.TestCase):
+
+    def test_accents(self):
+        self.assertEqual(sync_wiki_doc.clean_id(u'Über Straße'),
+                         'ueber_strasse')
+        self.assertEqual(sync_wiki_doc.clean_id(u'Café Łódź'), 'cafe_lodz')
+
+    def test_specials(self):
+        self.assertEqual(sync_wiki_doc.clean_id(u'a+b=c@d$e~f^g(h)!'),
+                         'a_b_c_d_e_f_g_h')
+        self.assertEqual(sync_wiki_doc.clean_id(u'C++ / C# : notes'),
+                         'c_c_notes')
+        self.assertEqual(sync_wiki_doc.clean_id(u'文档，说明'), u'文档_说明')
+
+    def test_trim(self):
+        self.assertEqual(sync_wiki_doc.clean_id(u' -.Notes v1.0-. '),
+                         'notes_v1.0')
+        self.assertEqual(sync_wiki_doc.clean_id(u'...'), 'untitled')
+
+    def test_media_id(self):
+        self.assertEqual(sync_wiki_doc.media_id(u'2018/Résumé (1).PDF'),
+                         'smartwiki:2018:resume_1_.pdf')
+
+
+class DocTreeTest(unittest.TestCase):
+
+    def test_suffixed_name_does_not_take_a_sibling_name(self):
+        # doc_id, parent_id, project_id, doc_name, doc_sort, has_page
+        tree = sync_wiki_doc.DocTree([(3, 0, 1, u'foo_12', 0, True),
+                                      (5, 0, 1, u'Foo', 0, True),
+                                      (12, 0, 1, u'foo', 0, True)])
+        self.assertEqual(tree.path(3), 'project_1/foo_12.txt')
+        self.assertEqual(tree.path(5), 'project_1/foo.txt')
+        self.assertEqual(tree.path(12), 'project_1/foo_12_2.txt')
+
+    def test_names_are_unique_among_siblings(self):
+        tree = sync_wiki_doc.DocTree([(1, 0, 1, u'a', 0, True),
+                                      (2, 0, 1, u'A', 0, True),
+                                      (3, 0, 1, u'a_2', 0, True),
+                                      (4, 0, 1, u'a_2_2', 0, True),
+                                      (5, 0, 1, u'start', 0, True)])
+        names = [tree.name(doc_id) for doc_id in range(1, 6)]
+        self.assertEqual(len(set(names)), len(names))
+        self.assertNotIn(sync_wiki_doc.INDEX_PAGE, names)
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pages_path = os.path.join(self.path, 'pages')
+        os.mkdir(self.pages_path)
+        self.saved = dict((name, getattr(sync_wiki_doc, name)) for name in (
+            'SQLALCHEMY_DATABASE_URI', 'DOKU_PATH', 'DOKU_PAGES_PATH',
+            '_ENGINE', '_SESSION_MAKER'))
+        sync_wiki_doc.SQLALCHEMY_DATABASE_URI = 'sqlite:///%s' % \
+            os.path.join(self.path, 'smartwiki.db')
+        sync_wiki_doc.DOKU_PATH = self.path
+        sync_wiki_doc.DOKU_PAGES_PATH = self.pages_path
+        sync_wiki_doc._ENGINE = None
+        sync_wiki_doc._SESSION_MAKER = None
+        sync_wiki_doc.Base.metadata.create_all(sync_wiki_doc._get_engine())
+        self.session = sync_wiki_doc.get_session()
+        self.version = datetime(2018, 1, 1)
+
+    def tearDown(self):
+        self.session.close()
+        sync_wiki_doc._ENGINE.dispose()
+        for name, value in self.saved.items():
+            setattr(sync_wiki_doc, name, value)
+        shutil.rmtree(self.path)
+
+    def next_version(self):
+        self.version += timedelta(hours=1)
+        return self.version
+
+    def sync(self):
+        return sync_wiki_doc.sw_to_dw(
+            manifest_file=os.path.join(self.path, 'manifest.db'), owner='',
+            search_index=False, media=False)
+
+    def read_page(self, file_name):
+        with open(os.path.join(self.pages_path, file_name)) as page:
+            return page.read()
+
+    def add_document(self, doc_id, doc_name, doc_content, parent_id=0):
+        self.session.add(sync_wiki_doc.WKDocument(
+            doc_id=doc_id, doc_name=doc_name, parent_id=parent_id,
+            project_id=1, doc_sort=0, doc_content=doc_content, create_at=1,
+            version=self.next_version()))
+        self.session.commit()
+
+    def test_failed_write_is_retried(self):
+        self.add_document(1, u'Guide', u'old text')
+        self.sync()
+        self.assertIn('old text', self.read_page('project_1/guide.txt'))
+
+        doc = self.session.query(sync_wiki_doc.WKDocument).get(1)
+        doc.doc_content = u'new text'
+        doc.version = self.next_version()
+        self.session.commit()
+        # The watermark moves past the failed edit
+        self.add_document(2, u'Notes', u'notes')
+        write = sync_wiki_doc.PageWriter.write
+
+        def failing_write(writer, file_name, content):
+            if file_name == 'project_1/guide.txt':
+                raise IOError('disk full')
+            return write(writer, file_name, content)
+
+        sync_wiki_doc.PageWriter.write = failing_write
+        try:
+            stats = self.sync()
+        finally:
+            sync_wiki_doc.PageWriter.write = write
+        self.assertEqual(stats.failed, 1)
+        self.assertIn('old text', self.read_page('project_1/guide.txt'))
+
+        # No new edit, the watermark moved on but the page is pending
+        self.sync()
+        self.assertIn('new text', self.read_page('project_1/guide.txt'))
+
+    def test_failed_sync_finishes_the_writer(self):
+        self.add_document(1, u'Guide', u'text')
+        render_page = sync_wiki_doc.render_page
+        finish = sync_wiki_doc.PageWriter.finish
+        finished = []
+
+        def failing_render(doc_id, body):
+            raise RuntimeError('render failed')
+
+        def recording_finish(writer):
+            finished.append(writer)
+            return finish(writer)
+
+        sync_wiki_doc.render_page = failing_render
+        sync_wiki_doc.PageWriter.finish = recording_finish
+        try:
+            self.assertRaises(RuntimeError, self.sync)
+        finally:
+            sync_wiki_doc.render_page = render_page
+            sync_wiki_doc.PageWriter.finish = finish
+        self.assertEqual(len(finished), 1)
+
+    def test_start_page_links_the_page_of_its_document(self):
+        self.add_document(1, u'Guide', u'text')
+        self.add_document(2, u'Install', u'steps', parent_id=1)
+        self.sync()
+        self.assertIn('[[:project_1:guide|Guide]]',
+                      self.read_page('project_1/guide/start.txt'))
+
+        # Known from the manifest when the document is not synced again
+        self.add_document(3, u'Upgrade', u'steps', parent_id=1)
+        self.sync()
+        self.assertIn('[[:project_1:guide|Guide]]',
+                      self.read_page('project_1/guide/start.txt'))
+
+        doc = self.session.query(sync_wiki_doc.WKDocument).get(1)
+        doc.doc_content = u''
+        doc.version = self.next_version()
+        self.session.commit()
+        self.sync()
+        self.assertNotIn('[[:project_1:guide|Guide]]',
+                         self.read_page('project_1/guide/start.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
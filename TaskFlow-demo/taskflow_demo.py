@@ -1,19 +1,63 @@
 #!/usr/bin/env python
+# Demo of a TaskFlow workflow: call Jim, Joe and JmilkFan for their new
+# numbers, then collect the new numbers.
+#
+# The flow is a graph flow, the order of the tasks follows from the
+# values they require and provide. The three calls do not depend on each
+# other, they run at the same time on the parallel engine and the
+# collect task runs once all of them are done:
+#
+#    python taskflow_demo.py [-e serial|parallel] [-w 4] [--delay 1] [--fail]
+#
+# Every call sleeps --delay seconds like a slow remote call, --fail makes
+# the JmilkFan call fail to show the revert of the calls done. To compare
+# the time of the serial and the parallel engine on the same flow:
+#
+#    python taskflow_demo.py --compare [-w 4] [--delay 1]
+#
+# With a persistence backend the state of every task is saved in a
+# logbook as the flow runs. When the process dies mid-flow, the next run
+# resumes the unfinished flow of the logbook, the tasks done are not run
+# again. --crash kills the process once the calls are done:
+#
+#    python taskflow_demo.py -b sqlite:////tmp/taskflow_demo.db --crash
+#    python taskflow_demo.py -b sqlite:////tmp/taskflow_demo.db
+#
+# The backend is a SQLite database (sqlite:///FILE) or a directory
+# (dir:///DIR). --new starts a new flow even if one is unfinished, --list
+# shows the flows of the logbooks, --purge removes the finished ones.
+
+from concurrent import futures
+import contextlib
+import optparse
+import os
+import sys
+import time
 
 import taskflow.engines
-from taskflow.patterns import linear_flow as lt
+from taskflow.patterns import graph_flow as gf
+from taskflow.persistence import backends
+from taskflow.persistence import models
+from taskflow import states
 from taskflow import task
 from taskflow.types import failure as task_failed
+from taskflow.utils import persistence_utils as p_utils
 
+ENGINES = ('serial', 'parallel')
+WORKERS = 4
+DELAY = 1.0
+BOOK_NAME = 'taskflow-demo'
+# A flow in one of these states is not resumed
+FINISHED = (states.SUCCESS, states.REVERTED, states.FAILURE)
 
-class CallJim(task.Task):
 
+class CallJim(task.Task):
 
     default_provides = set(['jim_new_number'])
 
-    def execute(self, jim_number, *args, **kwargs):
+    def execute(self, jim_number, delay, *args, **kwargs):
         print "Calling Jim %s." % jim_number
-        print '=' * 10
+        time.sleep(delay)
         jim_new_number = jim_number + 'new'
 
         return {'jim_new_number': jim_new_number}
@@ -29,85 +73,252 @@ class CallJim(task.Task):
 
 class CallJoe(task.Task):
 
-    default_provides = set(['joe_new_number', 'jim_new_number'])
+    default_provides = set(['joe_new_number'])
 
-    def execute(self, joe_number, jim_new_number, *args, **kwargs):
-        print "Calling jim %s." % jim_new_number
+    def execute(self, joe_number, delay, *args, **kwargs):
         print "Calling Joe %s." % joe_number
-        print '=' * 10
+        time.sleep(delay)
         joe_new_number = joe_number + 'new'
 
-        return {'jim_new_number': jim_new_number,
-                'joe_new_number': joe_new_number}
+        return {'joe_new_number': joe_new_number}
 
     def revert(self, result, *args, **kwargs):
         if isinstance(result, task_failed.Failure):
             print "joe result"
             return None
 
-        jim_new_number = result['jim_new_number']
         joe_new_number = result['joe_new_number']
-
         print "Calling joe %s and apologizing." % joe_new_number
 
 
 class CallJmilkFan(task.Task):
 
-    default_provides = set(['new_numbers'])
+    default_provides = set(['jmilkfan_new_number'])
 
-    def execute(self, jim_new_number, joe_new_number, jmilkfan_number,
-                *args, **kwargs):
-        print "Calling jim %s" % jim_new_number
-        print "Calling joe %s" % joe_new_number
-        print "Calling jmilkfan %s" % jmilkfan_number
-        print '=' * 10
+    def execute(self, jmilkfan_number, delay, fail, *args, **kwargs):
+        print "Calling jmilkfan %s." % jmilkfan_number
+        time.sleep(delay)
+        if fail:
+            raise ValueError('Error')
         jmilkfan_new_number = jmilkfan_number + 'new'
 
-        raise ValueError('Error')
-        new_numbers =  {'jim_new_number': jim_new_number,
-                        'joe_new_number': joe_new_number,
-                        'jmilkfan_new_number': jmilkfan_new_number}
-
-        return {'new_numbers': new_numbers}
+        return {'jmilkfan_new_number': jmilkfan_new_number}
 
     def revert(self, result, *args, **kwargs):
         if isinstance(result, task_failed.Failure):
             print "jmilkfan result"
             return None
 
-        jim_new_number = result['jim_new_number']
-        joe_new_number = result['joe_new_number']
         jmilkfan_new_number = result['jmilkfan_new_number']
-
         print "Calling jmilkfan %s and apologizing." % jmilkfan_new_number
 
 
-def get_flow(flow, numbers):
+class CollectNumbers(task.Task):
+
+    default_provides = set(['new_numbers'])
+
+    def execute(self, jim_new_number, joe_new_number, jmilkfan_new_number,
+                crash, *args, **kwargs):
+        if crash:
+            print "Crashing before collecting the numbers."
+            sys.stdout.flush()
+            os._exit(1)
+        new_numbers = {'jim_new_number': jim_new_number,
+                       'joe_new_number': joe_new_number,
+                       'jmilkfan_new_number': jmilkfan_new_number}
+
+        return {'new_numbers': new_numbers}
+
+
+def get_backend(uri):
+    """Fetch the persistence backend of uri, its schema up to date"""
+
+    conf = {'connection': uri}
+    if uri.startswith('dir://') or uri.startswith('file://'):
+        # The directory backends take their directory apart from the uri
+        conf['path'] = uri.split('://', 1)[1]
+    backend = backends.fetch(conf)
+    with contextlib.closing(backend.get_connection()) as conn:
+        conn.upgrade()
+    return backend
+
+
+def get_book(backend, name=BOOK_NAME):
+    """Get the logbook name of the backend, created if needed"""
+
+    with contextlib.closing(backend.get_connection()) as conn:
+        for book in conn.get_logbooks():
+            if book.name == name:
+                return book
+        book = models.LogBook(name)
+        conn.save_logbook(book)
+    return book
+
+
+def get_flow_detail(backend, book, flow_api, resume=True):
+    """Get the flow detail of an unfinished run of the flow, or a new one"""
+
+    if resume:
+        for flow_detail in book:
+            if flow_detail.name == flow_api.name and \
+                    flow_detail.state not in FINISHED:
+                resumed = (flow_detail.uuid, book.name)
+                print "Resuming flow %s of logbook %s." % resumed
+                return flow_detail
+    return p_utils.create_flow_detail(flow_api, book=book, backend=backend)
+
+
+def get_flow(flow, numbers, engine='parallel', executor=None,
+             workers=WORKERS, backend=None, resume=True):
+    """Load the flow on an engine
+
+    executor of the parallel engine is a futures executor, without it the
+    engine runs the tasks on its own pool of threads. Without backend the state
+    of the flow is in memory, with it the flow is saved in its logbook and
+    with resume an unfinished flow of the logbook is resumed.
+    """
+
     flow_name = flow
-    flow_api = lt.Flow(flow_name)
+    flow_api = gf.Flow(flow_name)
 
+    # No links, the graph flow orders the tasks by requires and provides
     flow_api.add(CallJim(),
                  CallJoe(),
-                 CallJmilkFan())
+                 CallJmilkFan(),
+                 CollectNumbers())
+
+    options = {}
+    if engine == 'parallel':
+        options = {'max_workers': workers}
+        if executor is not None:
+            options['executor'] = executor
+    if backend is not None:
+        book = get_book(backend)
+        options.update(backend=backend, book=book,
+                       flow_detail=get_flow_detail(backend, book, flow_api,
+                                                   resume))
+    return taskflow.engines.load(flow_api, store=numbers, engine=engine,
+                                 **options)
+
+
+def list_flows(backend):
+    """Print the flows of the logbooks of the backend and their state"""
+
+    with contextlib.closing(backend.get_connection()) as conn:
+        for book in conn.get_logbooks():
+            print "Logbook %s (%s):" % (book.name, book.uuid)
+            for flow_detail in book:
+                flow = (flow_detail.name, flow_detail.uuid, flow_detail.state)
+                print "  flow %s %s %s" % flow
+
+
+def purge_flows(backend):
+    """Destroy the logbooks whose flows are all finished"""
+
+    with contextlib.closing(backend.get_connection()) as conn:
+        for book in conn.get_logbooks():
+            if all(flow_detail.state in FINISHED for flow_detail in book):
+                conn.destroy_logbook(book.uuid)
+                print "Destroyed logbook %s (%s)." % (book.name, book.uuid)
+
+
+def run_flow(numbers, engine, workers, backend=None, resume=True):
+    """Run the flow, return (new_numbers, elapsed seconds)"""
+
+    pool = None
+    if engine == 'parallel':
+        # A pool of the engine is shut down with the flow, waiting for its
+        # idle workers, which is not the time of the flow.
+        pool = futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        flow_engine = get_flow(flow='taskflow-demo', numbers=numbers,
+                               engine=engine, executor=pool,
+                               workers=workers, backend=backend,
+                               resume=resume)
+        start_time = time.time()
+        flow_engine.run()
+        elapsed = time.time() - start_time
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return flow_engine.storage.fetch('new_numbers'), elapsed
+
+
+def parse_args():
+    p = optparse.OptionParser()
+    p.add_option('-e', '--engine', choices=ENGINES, default='parallel',
+                 help='Engine running the flow, Such as [%s], default is '
+                      'parallel' % '|'.join(ENGINES))
+    p.add_option('-w', '--workers', type='int', default=WORKERS,
+                 help='Workers of the parallel engine, default is %d'
+                      % WORKERS)
+    p.add_option('--delay', type='float', default=DELAY,
+                 help='Seconds every call takes, default is %g' % DELAY)
+    p.add_option('--fail', action='store_true', default=False,
+                 help='Make the JmilkFan call fail and revert the flow')
+    p.add_option('--compare', action='store_true', default=False,
+                 help='Run the flow on the serial and the parallel engine '
+                      'and compare their time')
+    p.add_option('-b', '--backend',
+                 help='Persistence backend saving the flows, such as '
+                      'sqlite:///FILE or dir:///DIR, default is in memory')
+    p.add_option('--new', action='store_true', default=False,
+                 help='Start a new flow, do not resume an unfinished one')
+    p.add_option('--crash', action='store_true', default=False,
+                 help='Kill the process once the calls are done')
+    p.add_option('--list', action='store_true', default=False,
+                 help='List the flows of the backend and exit')
+    p.add_option('--purge', action='store_true', default=False,
+                 help='Destroy the logbooks of the backend whose flows are '
+                      'finished and exit')
+    options, _ = p.parse_args()
+    if (options.list or options.purge) and not options.backend:
+        p.error('--list and --purge need a --backend')
+    if options.workers < 1:
+        p.error('--workers must be at least 1')
+    if options.delay < 0:
+        p.error('--delay must not be negative')
+    return options
 
-    return taskflow.engines.load(flow_api,
-                                 engine_conf={'engine': 'serial'},
-                                 store=numbers)
 
 def main():
+    options = parse_args()
+    backend = None
+    if options.backend:
+        backend = get_backend(options.backend)
+        if options.list or options.purge:
+            if options.purge:
+                purge_flows(backend)
+            list_flows(backend)
+            return
     numbers = {'jim_number': '1'*6,
                'joe_number': '2'*6,
-               'jmilkfan_number': '3'*6}
+               'jmilkfan_number': '3'*6,
+               'delay': options.delay,
+               'fail': options.fail,
+               'crash': options.crash}
+    engines = ENGINES if options.compare else (options.engine,)
+    # The compared runs start new flows, a resumed one skips its tasks done
+    resume = not (options.new or options.compare)
+    results = []
     try:
-        flow_engine = get_flow(flow='taskflow-demo',
-                               numbers=numbers)
-
-        flow_engine.run()
+        for engine in engines:
+            new_numbers, elapsed = run_flow(numbers, engine,
+                                            options.workers, backend,
+                                            resume)
+            results.append((engine, elapsed))
     except Exception:
         print "TaskFlow Failed!"
         raise
 
-    new_numbers = flow_engine.storage.fetch('new_numbers')
+    print "New numbers: %s" % new_numbers
+    for engine, elapsed in results:
+        if engine == 'parallel':
+            engine = 'parallel (%d workers)' % options.workers
+        print "%-36s %8.2fs" % (engine, elapsed)
+    if len(results) == 2:
+        speedup = results[0][1] / max(results[1][1], 1e-6)
+        print "Speedup of the parallel engine: %.2fx" % speedup
 
 
 if __name__ == '__main__':